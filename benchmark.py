@@ -0,0 +1,85 @@
+import logging, math, time
+import numpy as np
+import pandas as pd
+from bvStructure import *
+
+def _best_time(kernel, repeats:int) -> tuple[float, np.ndarray]:
+    """
+        Runs a kernel several times, returning the fastest time in seconds and the map from the last run.
+    """
+
+    best = math.inf
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = kernel()
+        best = min(best, time.perf_counter() - start)
+
+    return best, result
+
+def kernel_benchmark(inputFile:str, resolution:float = 0.1, repeats:int = 3) -> pd.DataFrame:
+    """
+        Times the map kernels against each other on one structure, with lone pairs added. Every kernel is compiled on a
+        small grid first, so only the calculation itself is timed. Each kernel is run several times and the fastest
+        run is kept, as the slower runs only measure other load on the machine. \n
+
+        Returns a dataframe with one row per kernel, giving its time, its speed in voxels per second, its speedup over
+        the reference kernel for the same method, and the largest difference from the reference map.
+    """
+
+    crystal = BVStructure.from_file(inputFile, bvse=True)
+    crystal.prepare(lonePairs=True)
+    selectedSites = crystal.bufferedSites[crystal.bufferedSites["ion"] != crystal.conductor]
+
+    bondIons, coulIons = crystal._create_bond_site_array(selectedSites), crystal._create_coul_site_array(selectedSites, True)
+    bvIons, penIons = crystal._create_bv_array(selectedSites), crystal._create_bv_penalty_array(selectedSites, 0.05)
+
+    # The reference BVSM kernel reads past the end of an empty penalty array, so give it no rows instead
+    if penIons.size == 0:
+        penIons = np.zeros((0, 5))
+
+    bvseArgs = (crystal.rCutoff, 1, crystal.SCREENING_FACTOR)
+    groupedIons = group_site_array(bondIons, 3) + group_site_array(coulIons, 4)
+    bvsmArgs = (crystal.rCutoff, crystal.conductor.ox_state, 1, bvIons, penIons)
+
+    # Each method's kernels and their arguments between the lattice vectors and the map, with the reference kernel first
+    kernels = {
+        "bvse": {
+            "bvse_map": (bvse_map, bvseArgs + (bondIons, coulIons)),
+            "bvse_map_fused": (bvse_map_fused, bvseArgs + (bondIons, coulIons)),
+            "bvse_map_grouped": (bvse_map_grouped, bvseArgs + groupedIons),
+            "bvse_map_scatter": (bvse_map_scatter, bvseArgs + (bondIons, coulIons)),
+            "bvse_map_fft": (bvse_map_fft, bvseArgs + (bondIons, coulIons))
+        },
+        "bvsm": {
+            "bvsm_map": (bvsm_map, bvsmArgs),
+            "bvsm_map_fused": (bvsm_map_fused, bvsmArgs),
+            "bvsm_map_scatter": (bvsm_map_scatter, bvsmArgs),
+            "bvsm_map_fft": (bvsm_map_fft, bvsmArgs)
+        }
+    }
+
+    # Compile every kernel on a small grid
+    smallGrid = np.full(3, 7)
+    for methodKernels in kernels.values():
+        for kernel, args in methodKernels.values():
+            kernel(smallGrid, crystal.vectors, *args, np.zeros(smallGrid))
+
+    crystal.setup_voxels(resolution)
+    voxelCount = int(np.prod(crystal.voxelNumbers))
+    logging.info(f"Benchmarking on a {crystal.voxelNumbers} grid of {voxelCount} voxels, with {len(selectedSites)} buffered sites")
+
+    rows = []
+    for method, methodKernels in kernels.items():
+
+        reference = None
+        for name, (kernel, args) in methodKernels.items():
+
+            seconds, result = _best_time(lambda: kernel(crystal.voxelNumbers, crystal.vectors, *args, np.zeros(crystal.voxelNumbers)), repeats)
+
+            if reference is None:
+                reference = (seconds, result)
+
+            rows.append((method, name, seconds, voxelCount / seconds, reference[0] / seconds, np.abs(result - reference[1]).max()))
+            logging.info(f"{name}: {seconds:.3f} s ({reference[0] / seconds:.2f}x)")
+
+    return pd.DataFrame(rows, columns=["method", "kernel", "seconds", "voxels_per_second", "speedup", "max_difference"])
@@ -0,0 +1,191 @@
+import hashlib, json, logging, os, shutil, time
+from pathlib import Path
+from bvStructure import BVStructure, available_path
+
+def hash_file(path:str|Path) -> str:
+    """
+        Returns the SHA-256 hash of a file's contents.
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def content_key(sourcePath:str|Path, settings:dict, dbLocation:str|Path = BVStructure.DB_LOCATION) -> str:
+    """
+        Creates a key from the contents of a structure file and the parameter database, and a dictionary of settings.
+    """
+    digest = hashlib.sha256()
+    digest.update(hash_file(sourcePath).encode())
+    digest.update(hash_file(dbLocation).encode())
+    digest.update(json.dumps(settings, sort_keys=True, default=str).encode())
+    return digest.hexdigest()
+
+class PreparationCache:
+    """
+        A content-addressed cache of prepared structures. Entries are keyed by a hash of the structure file, the bond
+        valence parameter database and the settings used in preparation, so any change to these gives a new entry.
+    """
+
+    def __init__(self, cacheDir:str|Path):
+        """
+            Initialises the cache in a directory, creating the directory if needed.
+        """
+        self.cacheDir = Path(cacheDir)
+        self.cacheDir.mkdir(parents=True, exist_ok=True)
+
+    def key(self, sourcePath:str|Path, settings:dict, dbLocation:str|Path = BVStructure.DB_LOCATION) -> str:
+        """
+            Creates the key for a structure file, prepared with a dictionary of settings.
+        """
+        return content_key(sourcePath, settings, dbLocation)
+
+    def _path(self, key:str) -> Path:
+        return self.cacheDir.joinpath(key).with_suffix(".npz")
+
+    def load(self, key:str) -> BVStructure|None:
+        """
+            Loads the prepared structure stored under a key. Returns None if there is no entry or it can not be read.
+        """
+        path = self._path(key)
+
+        if not path.is_file():
+            return None
+
+        try:
+            structure = BVStructure.load_prepared(path)
+            logging.info(f"Loaded prepared structure {structure.name} from the cache")
+            return structure
+        except Exception as e:
+            logging.warning(f"Could not read cache entry {path} - {e}")
+            return None
+
+    def save(self, key:str, structure:BVStructure):
+        """
+            Stores a prepared structure under a key. The entry is written to a temporary file first, so other processes
+            never read a partially written entry.
+        """
+        path = self._path(key)
+        tempPath = path.with_name(f"{path.stem}.{os.getpid()}.tmp.npz")
+        structure.save_prepared(tempPath)
+        os.replace(tempPath, path)
+
+
+class ResultCache:
+    """
+        A cache of exported maps, so identical map calculations are never repeated. Entries are keyed by a hash of the
+        structure file, the parameter database and every map parameter. Once the cache grows beyond its maximum size, the
+        least recently used entries are removed.
+    """
+
+    MANIFEST = "manifest.json"
+
+    def __init__(self, cacheDir:str|Path, maxBytes:int = 2**30):
+        """
+            Initialises the cache in a directory, creating the directory if needed. The maximum size defaults to 1 GiB.
+        """
+        self.cacheDir = Path(cacheDir)
+        self.cacheDir.mkdir(parents=True, exist_ok=True)
+        self.maxBytes = maxBytes
+
+    def key(self, sourcePath:str|Path, settings:dict, dbLocation:str|Path = BVStructure.DB_LOCATION) -> str:
+        """
+            Creates the key for a structure file and a dictionary of all the map parameters.
+        """
+        return content_key(sourcePath, settings, dbLocation)
+
+    def _manifest(self, key:str) -> dict|None:
+        try:
+            with open(self.cacheDir.joinpath(key, self.MANIFEST), "r") as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+    def name(self, key:str) -> str|None:
+        """
+            Returns the name of the structure stored under a key, or None if there is no entry.
+        """
+        manifest = self._manifest(key)
+        return None if manifest is None else manifest["name"]
+
+    def fetch(self, key:str, outputFile:str|Path) -> list|None:
+        """
+            Copies the maps stored under a key to the requested output file. Maps that were written with a suffix added to
+            the output file name (e.g. one per conductor) are copied with the same suffix. Returns the list of paths
+            written, or None if there is no entry.
+        """
+        manifest = self._manifest(key)
+        if manifest is None:
+            return None
+
+        outputFile = Path(outputFile)
+        entryPath = self.cacheDir.joinpath(key)
+        written = []
+
+        for storedName, suffix in manifest["files"]:
+            path = available_path(outputFile.with_name(outputFile.stem + suffix))
+            shutil.copyfile(entryPath.joinpath(storedName), path)
+            written.append(path)
+
+        # Mark the entry as recently used
+        os.utime(entryPath)
+        logging.info(f"Copied {len(written)} cached map(s) for {manifest['name']}")
+        return written
+
+    def store(self, key:str, outputFile:str|Path, writtenPaths:dict, name:str):
+        """
+            Stores the maps written for a requested output file under a key, then removes old entries if the cache is
+            too large. The maps are given as a dictionary of the paths written, keyed by the paths that were asked for.
+            The suffix of each map is found from the path asked for, so a map renamed to avoid overwriting another file
+            (e.g. 'out-0.cube') is still fetched under the requested name. The entry is assembled in a temporary directory
+            first, so other processes never see a partial entry.
+        """
+        outputFile = Path(outputFile)
+        entryPath = self.cacheDir.joinpath(key)
+        if entryPath.is_dir():
+            return
+
+        tempPath = self.cacheDir.joinpath(f"{key}.{os.getpid()}.tmp")
+        tempPath.mkdir()
+        files = []
+
+        for i, (requested, path) in enumerate(writtenPaths.items()):
+            requested, path = Path(requested), Path(path)
+            suffix = (requested.stem[len(outputFile.stem):] if requested.stem.startswith(outputFile.stem) else f"-{requested.stem}") + requested.suffix
+            storedName = f"{i}{path.suffix}"
+            shutil.copyfile(path, tempPath.joinpath(storedName))
+            files.append((storedName, suffix))
+
+        with open(tempPath.joinpath(self.MANIFEST), "w") as f:
+            json.dump({"name": name, "files": files, "created": time.time()}, f)
+
+        try:
+            os.rename(tempPath, entryPath)
+        except OSError:
+            # Another process stored the same entry first
+            shutil.rmtree(tempPath, ignore_errors=True)
+
+        self.evict()
+
+    def size(self) -> int:
+        """
+            Returns the total size of the cache in bytes.
+        """
+        return sum(f.stat().st_size for f in self.cacheDir.rglob("*") if f.is_file())
+
+    def evict(self):
+        """
+            Removes the least recently used entries until the cache is no larger than its maximum size.
+        """
+        entries = [(entry.stat().st_mtime, entry) for entry in self.cacheDir.iterdir() if entry.is_dir() and not entry.name.endswith(".tmp")]
+        entries.sort()
+        total = self.size()
+
+        for _, entry in entries:
+            if total <= self.maxBytes:
+                break
+            entrySize = sum(f.stat().st_size for f in entry.rglob("*") if f.is_file())
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= entrySize
+            logging.info(f"Evicted {entry.name} from the result cache")
@@ -1,4 +1,4 @@
-import math, logging, sys
+import json, math, logging, sys
 import numpy as np
 import pandas as pd
 from fileIO import *
@@ -16,63 +16,104 @@ class BVStructure:
     SCREENING_FACTOR = 0.75 # Factor for the ERFC
     LONE_PAIR_RADIUS = 1
     LONE_PAIR_CHARGE = -2
+    CORE_RADIUS = 1. # Radius in angstroms of the sphere around each ion whose voxels are excluded by a core mask
+    CORE_SENTINEL = 1000. # Value given to the voxels excluded by a core mask, far above any energy or mismatch a conductor could pass through
+    CLOSE_CONTACT_BVS = 100. # Bond valence sum given to a site closer than 1 Å to a counter-ion, which has no meaningful sum
+    PYRAMID_FACTORS = (2, 4, 12) # Downsampling factors of the coarser levels written with a map pyramid, which all divide the voxel numbers made by setup_voxels
+    SHARED_DB = None # A database connection used by every structure instead of opening their own, such as an in-memory copy held by a long-running service
 
     # --TESTED--
-    def __init__(self, inputStr:str, name:str, bvse:bool=False):
+    def __init__(self, inputStr:str, name:str, bvse:bool=False, conductors:list = None):
         """
             Initialises a BVStructure object using an input string generated by the fileIO module.
             Optional parameter to create dictionary for all BV parameters, in preperation for doing
-            vector sums later in the program. Defaults to false.
+            vector sums later in the program. Defaults to false. A list of conducting ions can also be
+            given, which overrides the conductor in the input file and allows one map per conductor to
+            be made in a single pass.
         """
         
         lines = inputStr.splitlines()
 
-        # Set starting cutoff radius, should be altered later in code
-        self.rCutoff = 6
-
         # Extract header data from the input file
-        self.conductor = Ion(element = lines[0].split("\t")[0], ox_state = int(lines[0].split("\t")[1]))
-        self.params = tuple(map(float, lines[1].split("\t")))
+        conductor = Ion(element = lines[0].split("\t")[0], ox_state = int(lines[0].split("\t")[1]))
+        params = tuple(map(float, lines[1].split("\t")))
         extraParams = lines[2].split("\t")
-        self.volume = float(extraParams[0])
-        self.vectors = np.zeros((3,3))
-        self.name = name
+        volume = float(extraParams[0])
+        vectors = np.zeros((3,3))
         
         for i in range(3,6):
             cols = lines[i].split("\t")
             for j in range(3):
-                self.vectors[i-3][j] = float(cols[j])
+                vectors[i-3][j] = float(cols[j])
 
-        self.inverseVectors = np.linalg.inv(self.vectors)
-
-        # Setup the sites dataframe
-        self.sites = pd.DataFrame(columns=["label","ion","ox_state","lp","coords"])
-    
-        # Fill the sites dataframe. If there is a value error, throw exception
+        # Read the site rows. If there is a value error, throw exception
+        siteRows = []
         try:
 
             for i in range(7, len(lines)):
                 data = lines[i].split("\t")
-                self.sites.loc[data[1]] = [data[0], Ion(data[2], round(float(data[3]))), round(float(data[3])), bool(int(data[4])), np.array((float(data[5]), float(data[6]), float(data[7])))]
+                # Files written before occupancies were supported have no occupancy column
+                occ = float(data[8]) if len(data) > 8 and data[8].strip() != "" else 1.
+                siteRows.append([data[0], data[1], data[2], round(float(data[3])), bool(int(data[4])), np.array((float(data[5]), float(data[6]), float(data[7]))), occ])
             
         except ValueError:
-            raise Exception("Value Error When Interpreting Input File - Are there disordered sites?")
+            raise Exception("Value Error When Interpreting Input File - every site row needs a numeric oxidation state, lone pair flag (0 or 1), cartesian coordinates and (optionally) occupancy")
+
+        self._setup(name, conductor, params, volume, vectors, siteRows, bvse, conductors)
+
+    def _setup(self, name:str, conductor:Ion, params:tuple, volume:float, vectors:np.ndarray, siteRows:list, bvse:bool, conductors:list):
+        """
+            Sets up the structure from its component parts, regardless of where they were read from. The site rows should
+            be in the format [label, p1 label, element, oxidation state, lone pair, cartesian coordinates, occupancy].
+            Sites with an occupancy of zero contribute nothing, so they are left out.
+        """
+
+        # Set starting cutoff radius, should be altered later in code
+        self.rCutoff = 6
+
+        # If a list of conductors is given, the first one takes the place of the conductor in the file
+        if conductors:
+            self.conductors = [c if isinstance(c, Ion) else Ion.from_string(c) for c in conductors]
+            self.conductor = self.conductors[0]
+        else:
+            self.conductor = conductor
+            self.conductors = [self.conductor]
+
+        self.params = params
+        self.volume = volume
+        self.vectors = vectors
+        self.name = name
+        self.inverseVectors = np.linalg.inv(self.vectors)
+
+        # Setup the sites dataframe
+        self.sites = pd.DataFrame(columns=["label","ion","ox_state","lp","coords","occ"])
+
+        for label, p1Label, element, os, lp, coords, occ in siteRows:
+            if float(occ) < 0:
+                raise Exception(f"The site {p1Label} of {name} has a negative occupancy ({occ})")
+            elif float(occ) == 0:
+                logging.warning(f"The site {p1Label} of {name} has an occupancy of zero, so it has been left out")
+                continue
+            self.sites.loc[p1Label] = [label, Ion(element, round(os)), round(os), bool(lp), coords, float(occ)]
 
         logging.debug(self.sites)
 
+        # Site arrays made for the kernels, which are kept until the buffered sites change
+        self.siteArrays = {}
+
         # Get the needed bond valence parameters from the database
-        self.db = BVDatabase(self.DB_LOCATION)
-        self.bvParams = self.create_param_dict(self.conductor, bvse)
+        self.db = self.open_database()
+        self.bvParams = self.create_param_dict(self.conductors, bvse)
 
         # Find the effective charges of ions in the structure
         self.chargeList = self.find_effective_charges()
-        
 
     # --TESTED--
     @classmethod
-    def from_file(cls, path:str|Path, bvse = False):
+    def from_file(cls, path:str|Path, bvse = False, conductors:list = None):
         """
-            Initialises a BVStructure object from an input file
+            Initialises a BVStructure object from an input file. Optionally accepts a list of conductors to
+            use in place of the one specified in the file.
         """
 
         if isinstance(path, str):
@@ -86,7 +127,7 @@ class BVStructure:
             with open(path, "r") as f:
                 contents = f.read()
                 if len(contents) > 5: 
-                    return BVStructure(contents, name = path.stem, bvse = bvse)     
+                    return BVStructure(contents, name = path.stem, bvse = bvse, conductors = conductors)     
                 else: 
                     logging.fatal(f"The file at {path} was malformed. Quitting.")
                     sys.exit()
@@ -94,6 +135,43 @@ class BVStructure:
             logging.fatal(f"The file at {path} could not be found. Quitting.")
             sys.exit()
 
+    @classmethod
+    def from_structure(cls, struct:pmg.Structure, conductor:str|Ion, name:str, bvse = False, conductors:list = None, inpOutput:str|Path = None):
+        """
+            Initialises a BVStructure object directly from a pymatgen structure, without an input file. Optionally accepts
+            a list of conductors and a location to also write an input file to, as a record of the structure used.
+        """
+
+        if not isinstance(conductor, Ion):
+            conductor = Ion.from_string(conductor)
+
+        siteRows, osWarning, partialWarning = structure_site_rows(struct)
+
+        if inpOutput is not None:
+            write_input_file(Path(inpOutput), struct, conductor, siteRows)
+
+        if partialWarning:
+            logging.info(f"The structure {name} has partially occupied sites - their contributions are weighted by occupancy")
+        if osWarning:
+            logging.warning(f"Oxidation States of {name} have been set to maximum (due to limitations with pymatgen)")
+
+        lattice = struct.lattice
+        params = (lattice.a, lattice.b, lattice.c, lattice.alpha, lattice.beta, lattice.gamma)
+
+        structure = cls.__new__(cls)
+        structure._setup(name, conductor, params, lattice.volume, np.array(lattice.matrix), siteRows, bvse, conductors)
+        return structure
+
+    @classmethod
+    def from_cif(cls, path:str|Path, conductor:str|Ion, bvse = False, conductors:list = None, inpOutput:str|Path = None):
+        """
+            Initialises a BVStructure object from a cif file, parsing it once in memory. The structure is named after the
+            structural formula in the cif. Accepts the same optional arguments as from_structure.
+        """
+
+        struct, formula = read_structure(Path(path))
+        return cls.from_structure(struct, conductor, formula, bvse = bvse, conductors = conductors, inpOutput = inpOutput)
+
     # --TESTED--   
     def translate_coord(self, coord:np.ndarray, shift:tuple|np.ndarray) -> np.ndarray:
         """
@@ -126,30 +204,32 @@ class BVStructure:
         return (start <= point).all() and (point <= end).all()
     
     # --TESTED--
-    def create_param_dict(self, conductor:Ion, bvse = False):
+    def create_param_dict(self, conductor:Ion|list, bvse = False):
         """
-            Method that fetches bond valence parameters for all species in the structure and the specified ion. This method populates the bvParams dictionary and sets a cutoff radius using the values stored in the database.
+            Method that fetches bond valence parameters for all species in the structure and the specified ion (or list of ions). This method populates the bvParams dictionary and sets a cutoff radius using the values stored in the database. When there are several conductors, the cutoff radius for each is stored in conductorCutoffs and the largest is used for the structure.
         """
 
         bvParams = {}
-        maxCutoff = 0
+        self.conductorCutoffs = {}
+        conductors = conductor if isinstance(conductor, list) else [conductor]
 
-        # For every ion that is not the conductor (currently assuming only one)
-        # Drops additional ions after the first one
-        for ion in self.sites.drop_duplicates(subset=["label"])["ion"]:
+        # Every ion species in the structure, including species that share a site
+        ions = list(dict.fromkeys(self.sites["ion"]))
 
-            if ion == conductor:
-                continue
+        # Fetch the parameters of every conductor and ion pair in one query
+        pairs = [(conductor, ion) for conductor in conductors for ion in ions if ion != conductor]
+        pairParams = self.db.get_bv_params_many(pairs, bvse=bvse)
 
-            # Define the dictionary key
-            dictKey = f"{conductor}.{ion}"
+        for conductor in conductors:
 
-            # Check if parameters are already fetched
-            if dictKey in bvParams:
-                continue
+            maxCutoff = 0
 
-            else:
-                params = self.db.get_bv_params(conductor, ion, bvse=bvse)
+            for ion in ions:
+
+                if ion == conductor:
+                    continue
+
+                params = pairParams[(conductor, ion)]
                 if params is None:
                     continue
 
@@ -157,9 +237,11 @@ class BVStructure:
                 elif params.r_cutoff is not None:
                     maxCutoff = max(maxCutoff, params.r_cutoff)
 
-                bvParams[dictKey] = params
+                bvParams[f"{conductor}.{ion}"] = params
+
+            self.conductorCutoffs[conductor] = maxCutoff
 
-        self.rCutoff = maxCutoff
+        self.rCutoff = max(self.conductorCutoffs.values())
         return bvParams
 
     def get_bv_param(self, ion1:Ion, ion2:Ion):
@@ -211,28 +293,40 @@ class BVStructure:
         """
 
         # Create a copy of the sites dataframe to add to
-        self.bufferedSites = pd.DataFrame(columns=["label","ion","ox_state","lp","coords"])
+        self.bufferedSites = pd.DataFrame(columns=["label","ion","ox_state","lp","coords","occ"])
+        self.siteArrays = {}
 
         # For every site in the core cell
         for site in self.sites.itertuples():
-
-            # For every cell that needs to be expanded to
-            # Range if buffer area is 3, creates area from -1 -> 1; if 5, -2 -> 2 
-            # Note - range function does not include last number ∴ must have ceiling function for upper limit
-            for h in range(- math.floor(self.bufferArea[0]/2), math.ceil(self.bufferArea[0]/2)):
-                for k in range(- math.floor(self.bufferArea[1]/2), math.ceil(self.bufferArea[1]/2)):
-                    for l in range(- math.floor(self.bufferArea[2]/2), math.ceil(self.bufferArea[2]/2)):
-
-                        # Find its new site in the translated cell
-                        newCoord = self.translate_coord(site.coords, (h,k,l))
-                        
-                        # If the site is outwith the required area, disregard it
-                        if self.inside_space(self.reqFracStart, self.reqFracEnd, self._frac_from_cart(newCoord)):
-                            self.bufferedSites.loc[f"{site.Index}({h}{k}{l})"] = [site.label, site.ion, site.ox_state, site.lp, newCoord]
+            self._buffer_site(site)
 
         logging.debug("Buffered sites have been generated:")
         logging.debug(self.bufferedSites)
 
+    def _buffer_site(self, site) -> list:
+        """
+            Adds every image of a core cell site that lies within the required area to the buffered sites. The site should
+            be a named tuple from the sites dataframe. Returns the list of buffered site labels added.
+        """
+        added = []
+
+        # For every cell that needs to be expanded to
+        # Range if buffer area is 3, creates area from -1 -> 1; if 5, -2 -> 2 
+        # Note - range function does not include last number ∴ must have ceiling function for upper limit
+        for h in range(- math.floor(self.bufferArea[0]/2), math.ceil(self.bufferArea[0]/2)):
+            for k in range(- math.floor(self.bufferArea[1]/2), math.ceil(self.bufferArea[1]/2)):
+                for l in range(- math.floor(self.bufferArea[2]/2), math.ceil(self.bufferArea[2]/2)):
+
+                    # Find its new site in the translated cell
+                    newCoord = self.translate_coord(site.coords, (h,k,l))
+                    
+                    # If the site is outwith the required area, disregard it
+                    if self.inside_space(self.reqFracStart, self.reqFracEnd, self._frac_from_cart(newCoord)):
+                        self.bufferedSites.loc[f"{site.Index}({h}{k}{l})"] = [site.label, site.ion, site.ox_state, site.lp, newCoord, site.occ]
+                        added.append(f"{site.Index}({h}{k}{l})")
+
+        return added
+
     def setup_voxels(self, resolution:float):
         """
             Setup the map array to store data for each voxel. Requires a resolution to have been set in the structure.
@@ -246,6 +340,41 @@ class BVStructure:
 
         # Initalise a map of dimensions that match the number of voxels
         self.map = np.zeros(self.voxelNumbers)
+        self.mapSettings = None
+        self.coreMask = None
+
+    def create_core_mask(self, radius:float = None) -> np.ndarray:
+        """
+            Marks the voxels within a radius (CORE_RADIUS by default) of any ion other than the conductor, where the
+            energies are meaningless and irrelevant to conduction. The maps made afterwards skip these voxels entirely and
+            give them the value CORE_SENTINEL. The spheres are stamped around the core cell sites, wrapping across the
+            cell edges, which covers the same voxels as stamping around every buffered site. The mask is cleared when the
+            voxels are set up again, and stamped again when sites are changed. Returns the mask.
+        """
+
+        radius = self.CORE_RADIUS if radius is None else radius
+        self.coreRadius = radius
+        coreSites = self.sites[self.sites["ion"] != self.conductor]
+        siteCoords = np.array(coreSites["coords"].tolist(), dtype=float).reshape(-1, 3)
+
+        self.coreMask = stamp_core_mask(self.voxelNumbers, self.vectors, self.inverseVectors, siteCoords, radius, np.zeros(self.voxelNumbers, dtype=np.bool_))
+        logging.info(f"Core mask excludes {self.coreMask.mean():.1%} of the voxels of {self.name}")
+        return self.coreMask
+
+    def apply_core_mask(self):
+        """
+            Gives the masked voxels of every map the sentinel value, for maps whose kernels do not skip them.
+        """
+
+        if getattr(self, "coreMask", None) is None:
+            return
+
+        self.map[self.coreMask] = self.CORE_SENTINEL
+        for conductorMap in getattr(self, "conductorMaps", {}).values():
+            conductorMap[self.coreMask] = self.CORE_SENTINEL
+        for channels in getattr(self, "channelMaps", {}).values():
+            for channelMap in channels.values():
+                channelMap[self.coreMask] = self.CORE_SENTINEL
 
     def calc_voxel_cartesian(self, shift:np.ndarray):
         """
@@ -293,6 +422,123 @@ class BVStructure:
         logging.info("Successful initalisation of the map")
         logging.debug(self.bufferedSites)
 
+    def prepare(self, lonePairs:bool = False):
+        """
+            Completes all of the setup for a map that does not depend on the resolution - finding the buffered sites and
+            optionally creating the lone pair dummy sites. The prepared structure can be saved with save_prepared.
+        """
+
+        self.define_buffer_area()
+        self.find_buffer_sites()
+
+        if lonePairs:
+            self.create_lone_pairs()
+
+    def save_prepared(self, path:str|Path):
+        """
+            Saves a prepared structure to a compressed numpy file, including the buffered sites, parameters, effective
+            charges and any site arrays already made for the kernels. The structure can be restored with load_prepared.
+        """
+
+        arrays = {
+            "name": np.array(self.name),
+            "conductors": np.array([str(conductor) for conductor in self.conductors]),
+            "conductorCutoffs": np.array([self.conductorCutoffs[conductor] for conductor in self.conductors]),
+            "params": np.array(self.params),
+            "volume": np.array(self.volume),
+            "vectors": self.vectors,
+            "rCutoff": np.array(self.rCutoff),
+            "bufferArea": self.bufferArea,
+            "reqVolStart": self.reqVolStart,
+            "reqVolEnd": self.reqVolEnd,
+            "chargeIons": np.array([str(ion) for ion in self.chargeList]),
+            "charges": np.array(list(self.chargeList.values()), dtype=float),
+        }
+
+        # Bond valence parameters are stored as rows, with missing values as NaN
+        paramKeys = [key for key, value in self.bvParams.items() if value is not None]
+        arrays["paramKeys"] = np.array(paramKeys, dtype=str)
+        arrays["paramValues"] = np.array([[np.nan if value is None else value for value in self.bvParams[key]] for key in paramKeys], dtype=float).reshape(len(paramKeys), len(BVDatabase.bvparam._fields))
+
+        for prefix, sites in (("sites", self.sites), ("bufferedSites", self.bufferedSites)):
+            arrays[f"{prefix}.index"] = np.array(sites.index, dtype=str)
+            arrays[f"{prefix}.label"] = np.array(sites["label"], dtype=str)
+            arrays[f"{prefix}.element"] = np.array([ion.element for ion in sites["ion"]], dtype=str)
+            arrays[f"{prefix}.os"] = np.array(sites["ox_state"], dtype=int)
+            arrays[f"{prefix}.lp"] = np.array(sites["lp"], dtype=bool)
+            arrays[f"{prefix}.coords"] = np.array(list(sites["coords"]), dtype=float).reshape(len(sites), 3)
+            arrays[f"{prefix}.occ"] = np.array(sites["occ"], dtype=float)
+
+        for key, siteArrays in self.siteArrays.items():
+            for i, siteArray in enumerate(siteArrays):
+                arrays[f"siteArrays.{key}.{i}"] = siteArray
+
+        np.savez_compressed(path, **arrays)
+
+    @classmethod
+    def load_prepared(cls, path:str|Path):
+        """
+            Restores a structure saved by save_prepared, without reading an input file or looking up any parameters. The
+            voxels still need to be setup with setup_voxels before a map is made.
+        """
+
+        structure = cls.__new__(cls)
+
+        with np.load(path, allow_pickle=False) as data:
+
+            structure.name = str(data["name"])
+            structure.conductors = [Ion.from_string(conductor) for conductor in data["conductors"]]
+            structure.conductor = structure.conductors[0]
+            structure.conductorCutoffs = dict(zip(structure.conductors, data["conductorCutoffs"].tolist()))
+            structure.params = tuple(data["params"].tolist())
+            structure.volume = float(data["volume"])
+            structure.vectors = data["vectors"]
+            structure.inverseVectors = np.linalg.inv(structure.vectors)
+            structure.rCutoff = float(data["rCutoff"])
+            structure.bufferArea = data["bufferArea"]
+            structure.reqVolStart = data["reqVolStart"]
+            structure.reqFracStart = structure._frac_from_cart(structure.reqVolStart)
+            structure.reqVolEnd = data["reqVolEnd"]
+            structure.reqFracEnd = structure._frac_from_cart(structure.reqVolEnd)
+            structure.findCoreCell = np.vectorize(lambda x: math.floor(x/2))
+            structure.chargeList = {Ion.from_string(ion): charge for ion, charge in zip(data["chargeIons"], data["charges"].tolist())}
+
+            structure.bvParams = {}
+            for key, values in zip(data["paramKeys"], data["paramValues"]):
+                structure.bvParams[str(key)] = BVDatabase.bvparam(*[None if math.isnan(value) else value for value in values.tolist()])
+
+            for prefix in ("sites", "bufferedSites"):
+                sites = pd.DataFrame({
+                    "label": data[f"{prefix}.label"].tolist(),
+                    "ion": [Ion(element, os) for element, os in zip(data[f"{prefix}.element"].tolist(), data[f"{prefix}.os"].tolist())],
+                    "ox_state": data[f"{prefix}.os"],
+                    "lp": data[f"{prefix}.lp"],
+                    "coords": list(data[f"{prefix}.coords"]),
+                    "occ": data[f"{prefix}.occ"] if f"{prefix}.occ" in data.files else np.ones(len(data[f"{prefix}.index"])),
+                }, index=data[f"{prefix}.index"].tolist())
+                setattr(structure, prefix, sites)
+
+            # Site arrays are stored as numbered members of a tuple under each key
+            siteArrays = {}
+            for name in data.files:
+                if name.startswith("siteArrays."):
+                    key, i = name[len("siteArrays."):].rsplit(".", 1)
+                    siteArrays.setdefault(key, {})[int(i)] = data[name]
+            structure.siteArrays = {key: tuple(members[i] for i in sorted(members)) for key, members in siteArrays.items()}
+
+        structure.db = cls.open_database()
+        return structure
+
+    @classmethod
+    def open_database(cls) -> BVDatabase:
+        """
+            Returns the connection to the parameter database that a structure should use - the shared connection if one
+            has been set, otherwise a new read only connection.
+        """
+        if cls.SHARED_DB is not None:
+            return cls.SHARED_DB
+        return BVDatabase(cls.DB_LOCATION, readOnly=True, immutable=True)
+
     def _linear_penalty(self, charge:int, distance:float, penaltyK:float):
         return penaltyK * (self.conductor.ox_state * charge)*(1/distance - 1/self.rCutoff)
     
@@ -311,6 +557,9 @@ class BVStructure:
         elif fType in ["quadratic", "quad", "q", "2"]:
             penFunc = self._quadratic_penalty
 
+        # Maps made without JIT can not be updated incrementally
+        self.mapSettings = None
+
         # Removes all conducting ions from the structure
         selectedAtoms = self.bufferedSites[self.bufferedSites["ion"] != self.conductor]
 
@@ -346,10 +595,10 @@ class BVStructure:
                                 # Otherwise, calculated the BV value and add it to the total
                                 else:
                                     bvParam = self.conductor_bv_param(ionSite["ion"])
-                                    bvSum += calc_bv(bvParam.r0, ri, bvParam.ib)
+                                    bvSum += ionSite["occ"] * calc_bv(bvParam.r0, ri, bvParam.ib)
 
                         elif penalty != 0 :
-                            penaltySum += penFunc(-2, ri, penalty)
+                            penaltySum += ionSite["occ"] * penFunc(-2, ri, penalty)
 
                     # Update the map
                     if only_penalty:
@@ -369,6 +618,9 @@ class BVStructure:
                 2 - Only Coulombic Energy
         """
 
+        # Maps made without JIT can not be updated incrementally
+        self.mapSettings = None
+
         # Removes all conducting ions from the structure
         selectedAtoms = self.bufferedSites[self.bufferedSites["ion"] != self.conductor]
 
@@ -409,15 +661,15 @@ class BVStructure:
                                 # Otherwise, calculated the BV value and add it to the total
                                 else:
                                     params = self.conductor_bv_param(ionSite["ion"])
-                                    Ebond += calc_Ebond(params.d0, params.rmin, ri, params.ib)
+                                    Ebond += ionSite["occ"] * calc_Ebond(params.d0, params.rmin, ri, params.ib)
 
                         elif mode > 0:
 
                             if ionSite["label"][:2] == "lp":
-                                Ecoul += calc_Ecoul(self.conductor.ox_state, -2, ri, conductorRadius, self.LONE_PAIR_RADIUS, self.SCREENING_FACTOR)
+                                Ecoul += ionSite["occ"] * calc_Ecoul(self.conductor.ox_state, -2, ri, conductorRadius, self.LONE_PAIR_RADIUS, self.SCREENING_FACTOR)
                             else:
                                 params = self.bvParams[self.conductor_bv_param(ionSite["ion"])]
-                                Ecoul += calc_Ecoul(self.conductor.ox_state, ionSite["ion"].ox_state, ri, params.i1r, params.i2r, self.SCREENING_FACTOR) 
+                                Ecoul += ionSite["occ"] * calc_Ecoul(self.conductor.ox_state, ionSite["ion"].ox_state, ri, params.i1r, params.i2r, self.SCREENING_FACTOR) 
 
 
                     self.map[h][k][l] = Ebond + Ecoul
@@ -437,20 +689,100 @@ class BVStructure:
         selectedSites = self.bufferedSites[self.bufferedSites["ion"] != self.conductor]
 
         # Create arrays of all ions with all necessary information -> removing the need for class methods etc.
-        bvIons = self._create_bv_array(selectedSites)
-        penIons = self._create_bv_penalty_array(selectedSites, penalty)
+        bvIons, penIons = self.site_arrays(f"bvsm-{penalty}", lambda: (self._create_bv_array(selectedSites), self._create_bv_penalty_array(selectedSites, penalty)))
 
         # Do the calculation
-        self.map = bvsm_map(self.voxelNumbers, self.vectors, self.rCutoff, self.conductor.ox_state, mode, bvIons, penIons, self.map)
+        self.map = bvsm_map_fused(self.voxelNumbers, self.vectors, self.rCutoff, self.conductor.ox_state, mode, bvIons, penIons, self.map, getattr(self, "coreMask", None), self.CORE_SENTINEL)
+        self.mapSettings = {"method": "bvsm", "mode": mode, "penalty": penalty}
+        logging.info(f"Succesful map creation for {self.name}")
+
+    def populate_map_bvsm_scatter(self, mode = 1, penalty:float = 0.05):
+        """
+            Populates the map with bond valence sum mismatch data by looping over the sites, as in
+            populate_map_bvse_scatter. Gives the same map as populate_map_bvsm_jit.
+        """
+
+        selectedSites = self.bufferedSites[self.bufferedSites["ion"] != self.conductor]
+        bvIons, penIons = self.site_arrays(f"bvsm-{penalty}", lambda: (self._create_bv_array(selectedSites), self._create_bv_penalty_array(selectedSites, penalty)))
+
+        self.map = bvsm_map_scatter(self.voxelNumbers, self.vectors, self.rCutoff, self.conductor.ox_state, mode, bvIons, penIons, self.map, getattr(self, "coreMask", None), self.CORE_SENTINEL)
+        self.mapSettings = {"method": "bvsm", "mode": mode, "penalty": penalty}
+        logging.info(f"Succesful map creation for {self.name}")
+
+    def populate_map_bvsm_fft(self, mode = 1, penalty:float = 0.05):
+        """
+            Populates the map with bond valence sum mismatch data by FFT convolution, as in populate_map_bvse_fft.
+        """
+
+        selectedSites = self.bufferedSites[self.bufferedSites["ion"] != self.conductor]
+        bvIons, penIons = self.site_arrays(f"bvsm-{penalty}", lambda: (self._create_bv_array(selectedSites), self._create_bv_penalty_array(selectedSites, penalty)))
+
+        self.map = bvsm_map_fft(self.voxelNumbers, self.vectors, self.rCutoff, self.conductor.ox_state, mode, bvIons, penIons, self.map, getattr(self, "coreMask", None), self.CORE_SENTINEL)
+        self.mapSettings = {"method": "bvsm", "mode": mode, "penalty": penalty}
         logging.info(f"Succesful map creation for {self.name}")
 
+    def populate_bvsm_fields(self):
+        """
+            Calculates the raw bond valence sum field and the penalty field for a unit penalty constant in a single pass.
+            As the penalty is linear in the penalty constant, maps for any penalty constant can then be found cheaply
+            using penalty_sweep_map. The fields are stored in bvsField and penaltyField.
+        """
+
+        # Removes all conducting ions from the structure
+        selectedSites = self.bufferedSites[self.bufferedSites["ion"] != self.conductor]
+
+        bvIons = self._create_bv_array(selectedSites)
+        penIons = self._create_bv_penalty_array(selectedSites, 1)
+
+        self.bvsField = np.zeros(self.voxelNumbers)
+        self.penaltyField = np.zeros(self.voxelNumbers)
+        bvsm_fields(self.voxelNumbers, self.vectors, self.rCutoff, self.conductor.ox_state, bvIons, penIons, self.bvsField, self.penaltyField)
+        logging.info(f"Succesful BVSM field creation for {self.name}")
+
+    def penalty_sweep_map(self, penalty:float, mode = 1) -> np.ndarray:
+        """
+            Returns the BVSM map for a particular penalty constant, using the fields made by populate_bvsm_fields. Mode
+            settings match populate_map_bvsm_jit:
+
+                0 - Normal BVSM
+                1 - BVSM + Penalty
+                2 - Only Penalty Function
+        """
+
+        if mode == 0:
+            return np.abs(self.bvsField - abs(self.conductor.ox_state))
+        elif mode == 1:
+            return np.abs(self.bvsField - abs(self.conductor.ox_state)) + penalty * self.penaltyField
+        else:
+            return penalty * self.penaltyField
+
+    def penalty_sweep(self, penalties:list, mode = 1, threshold:float = 0.1) -> pd.DataFrame:
+        """
+            Finds summary statistics of the BVSM map for every penalty constant in a list. The fields are calculated if
+            they have not been already. The fraction of voxels with a value below the threshold is also found.
+            Returns a dataframe with one row per penalty constant.
+        """
+
+        if not hasattr(self, "bvsField"):
+            self.populate_bvsm_fields()
+
+        stats = pd.DataFrame(columns=["min", "p05", "median", "mean", "max", "std", "frac_below"])
+
+        for penalty in penalties:
+            sweepMap = self.penalty_sweep_map(penalty, mode)
+            p05, median = np.percentile(sweepMap, (5, 50))
+            stats.loc[penalty] = [sweepMap.min(), p05, median, sweepMap.mean(), sweepMap.max(), sweepMap.std(), np.count_nonzero(sweepMap < threshold) / sweepMap.size]
+
+        stats.index.name = "penalty_constant"
+        return stats
+
     def _create_bv_array(self, selectedSites):
         """
             Method to setup an array containing all necessary information for a bond valence sum calculation. The array has the following format:
 
                 [i][0-2] - Site Coordinates \n
                 [i][3] - Inverse b parameter \n
-                [i][4] - r0 parameter \n
+                [i][4] - r0 parameter, shifted by ln(occupancy)/b^-1 so the bond valence is weighted by the occupancy \n
         """
 
         # Select the sites that of oppisite charge to the conducting ion
@@ -463,7 +795,7 @@ class BVStructure:
             siteInfo[0:3] = site["coords"].copy()
             params = self.conductor_bv_param(site["ion"])
             siteInfo[3] = params.ib
-            siteInfo[4] = params.r0
+            siteInfo[4] = params.r0 + math.log(site["occ"]) / params.ib
             outList.append(siteInfo)
 
         # Convert from list to numpy array. If the list is empty, ensure the right shape is retained.
@@ -479,7 +811,7 @@ class BVStructure:
 
                 [i][0-2] - Site Coordinates \n
                 [i][3] - Lone Pair Charge \n
-                [i][4] - Penalty  \n
+                [i][4] - Penalty, weighted by the occupancy  \n
         """
 
         selectedSites = selectedSites[(selectedSites["ox_state"] * self.conductor.ox_state) > 0]
@@ -488,7 +820,7 @@ class BVStructure:
             siteInfo = np.zeros(5)
             siteInfo[0:3] = site["coords"].copy() 
             siteInfo[3] = self.LONE_PAIR_CHARGE
-            siteInfo[4] = penalty
+            siteInfo[4] = penalty * site["occ"]
             outList.append(siteInfo)
         out = np.array(outList)
         if out.shape[0] == 0:
@@ -506,19 +838,75 @@ class BVStructure:
         # Removes all conducting ions from the structure
         selectedSites = self.bufferedSites[self.bufferedSites["ion"] != self.conductor]
 
-        bondIons = self._create_bond_site_array(selectedSites)
-        coulIons = self._create_coul_site_array(selectedSites, effectiveCharge)
+        bondIons, coulIons = self.site_arrays(f"bvse-{int(effectiveCharge)}", lambda: (self._create_bond_site_array(selectedSites), self._create_coul_site_array(selectedSites, effectiveCharge)))
+
+        self.map = bvse_map_fused(self.voxelNumbers, self.vectors, self.rCutoff, mode, self.SCREENING_FACTOR, bondIons, coulIons, self.map, getattr(self, "coreMask", None), self.CORE_SENTINEL)
+        self.mapSettings = {"method": "bvse", "mode": mode, "effectiveCharge": effectiveCharge}
+        logging.info(f"Succesful map creation for {self.name}")
+
+    def populate_map_bvse_scatter(self, mode = 1, effectiveCharge = True):
+        """
+            Populates the map with BVSE data by looping over the sites and adding each one's energy to the voxels within
+            its cutoff (see bvse_map_scatter). Gives the same map as populate_map_bvse_jit, and is faster on fine grids or
+            for structures with few sites.
+        """
+
+        selectedSites = self.bufferedSites[self.bufferedSites["ion"] != self.conductor]
+        bondIons, coulIons = self.site_arrays(f"bvse-{int(effectiveCharge)}", lambda: (self._create_bond_site_array(selectedSites), self._create_coul_site_array(selectedSites, effectiveCharge)))
+
+        self.map = bvse_map_scatter(self.voxelNumbers, self.vectors, self.rCutoff, mode, self.SCREENING_FACTOR, bondIons, coulIons, self.map, getattr(self, "coreMask", None), self.CORE_SENTINEL)
+        self.mapSettings = {"method": "bvse", "mode": mode, "effectiveCharge": effectiveCharge}
+        logging.info(f"Succesful map creation for {self.name}")
+
+    def populate_map_bvse_fft(self, mode = 1, effectiveCharge = True):
+        """
+            Populates the map with BVSE data by FFT convolution of the unit cell's sites with each species' energy
+            (see bvse_map_fft). Its cost does not grow with the number of sites, but it only matches
+            populate_map_bvse_jit away from the sites.
+        """
+
+        selectedSites = self.bufferedSites[self.bufferedSites["ion"] != self.conductor]
+        bondIons, coulIons = self.site_arrays(f"bvse-{int(effectiveCharge)}", lambda: (self._create_bond_site_array(selectedSites), self._create_coul_site_array(selectedSites, effectiveCharge)))
+
+        self.map = bvse_map_fft(self.voxelNumbers, self.vectors, self.rCutoff, mode, self.SCREENING_FACTOR, bondIons, coulIons, self.map, getattr(self, "coreMask", None), self.CORE_SENTINEL)
+        self.mapSettings = {"method": "bvse", "mode": mode, "effectiveCharge": effectiveCharge}
+        logging.info(f"Succesful map creation for {self.name}")
+
+    def populate_map_bvse_grouped(self, mode = 1, effectiveCharge = True):
+        """
+            Populates the map with BVSE data from site arrays grouped by species (see group_site_array), which streams
+            through contiguous coordinates and skips the sites out of the cutoff in z. Gives the same map as
+            populate_map_bvse_jit up to rounding, as the energies are summed in a different order.
+        """
+
+        selectedSites = self.bufferedSites[self.bufferedSites["ion"] != self.conductor]
+
+        def builder():
+            bondIons, coulIons = self._create_bond_site_array(selectedSites), self._create_coul_site_array(selectedSites, effectiveCharge)
+            return group_site_array(bondIons, 3) + group_site_array(coulIons, 4)
+
+        siteArrays = self.site_arrays(f"bvse-grouped-{int(effectiveCharge)}", builder)
 
-        self.map = bvse_map(self.voxelNumbers, self.vectors, self.rCutoff, mode, self.SCREENING_FACTOR, bondIons, coulIons, self.map)
+        self.map = bvse_map_grouped(self.voxelNumbers, self.vectors, self.rCutoff, mode, self.SCREENING_FACTOR, *siteArrays, self.map, getattr(self, "coreMask", None), self.CORE_SENTINEL)
+        self.mapSettings = {"method": "bvse", "mode": mode, "effectiveCharge": effectiveCharge}
         logging.info(f"Succesful map creation for {self.name}")
 
+    def site_arrays(self, key:str, builder) -> tuple:
+        """
+            Returns the tuple of site arrays stored under a key, using the builder function to create them if they have not
+            been made since the buffered sites last changed. Keys describe the kernel and settings, e.g. 'bvse-1'.
+        """
+        if key not in self.siteArrays:
+            self.siteArrays[key] = tuple(builder())
+        return self.siteArrays[key]
+
     def _create_bond_site_array(self, selectedSites):
         """
             Creates an array of any site that will be used for bonding energy calculations. Resulting array
             has the following structure:
             
                 [i][0-2] = site coordinates \n
-                [i][3] = d0 bv parameter \n
+                [i][3] = d0 bv parameter, weighted by the occupancy \n
                 [i][4] = rmin bv parameter \n
                 [i][5] = b^-1 bv parameter \n
         """
@@ -528,7 +916,7 @@ class BVStructure:
             siteInfo = np.zeros(6)
             siteInfo[0:3] = site["coords"].copy()
             params = self.conductor_bv_param(site["ion"])
-            siteInfo[3] = params.d0
+            siteInfo[3] = params.d0 * site["occ"]
             siteInfo[4] = params.rmin
             siteInfo[5] = params.ib
             outList.append(siteInfo)
@@ -544,7 +932,7 @@ class BVStructure:
 
                 [i][0-2] = site coordinate \n
                 [i][3] = conducting ion charge \n
-                [i][4] = fixed ion charge \n
+                [i][4] = fixed ion charge, weighted by the occupancy \n
                 [i][5-6] = ionic radii \n
         """
 
@@ -561,7 +949,7 @@ class BVStructure:
             if site["ion"].element != "LP":
                 params = self.conductor_bv_param(site["ion"])
                 if effectiveCharge:
-                    siteInfo[3] = self.chargeList[self.conductor]
+                    siteInfo[3] = self.conductor_charge(self.conductor)
                     siteInfo[4] = self.chargeList[site.ion]
                 else:
                     siteInfo[3] = site["ion"].ox_state
@@ -570,12 +958,15 @@ class BVStructure:
                 siteInfo[6] = params.i2r
             else:
                 if effectiveCharge:
-                    siteInfo[3] = self.chargeList[self.conductor]
+                    siteInfo[3] = self.conductor_charge(self.conductor)
                 else:   
                     siteInfo[3] = self.conductor.ox_state 
                 siteInfo[4] = self.LONE_PAIR_CHARGE
                 siteInfo[5] = conductorRadius
                 siteInfo[6] = self.LONE_PAIR_RADIUS
+
+            # The Coulombic energy is linear in the charge, so partially occupied sites are weighted through it
+            siteInfo[4] *= site["occ"]
             outList.append(siteInfo)
 
         # Convert from list to numpy array. If the list is empty, ensure the right shape is retained.
@@ -584,78 +975,272 @@ class BVStructure:
             out = np.array([[]])
         return out
 
+    def populate_map_bvse_multi(self, mode = 1, effectiveCharge = True):
+        """
+            Populates one BVSE map for every conductor in the structure, using a single pass over the voxels. The maps
+            are stored in the conductorMaps dictionary, with the map of the first conductor also stored as the main map.
+            Mode Settings:
+                0 - Only Bonding Energy
+                1 - Bonding + Coulombic Energy
+                2 - Only Coulombic Energy
+        """
+
+        siteCoords, siteParams = self.site_arrays(f"multi-{int(effectiveCharge)}", lambda: self._create_multi_site_arrays(self.bufferedSites, effectiveCharge))
+        cutoffs = np.array([self.conductorCutoffs[conductor] for conductor in self.conductors], dtype=float)
+        maps = np.zeros((len(self.conductors),) + tuple(self.voxelNumbers))
+
+        maps = bvse_multi_map(self.voxelNumbers, self.vectors, cutoffs, mode, self.SCREENING_FACTOR, siteCoords, siteParams, maps)
+
+        self.conductorMaps = {conductor: maps[i] for i, conductor in enumerate(self.conductors)}
+        self.map = maps[0]
+        self.apply_core_mask()
+        self.mapSettings = {"method": "bvse-multi", "mode": mode, "effectiveCharge": effectiveCharge}
+        logging.info(f"Succesful map creation for {self.name} with conductors {', '.join(map(str, self.conductors))}")
+
+    def populate_map_bvse_channels(self, effectiveCharge = True):
+        """
+            Populates the bonding and Coulombic energy maps of every conductor as seperate channels from a single kernel run.
+            The channels are stored in the channelMaps dictionary under the keys 'bond', 'coul' and 'total', meaning the
+            maps of modes 0, 1 and 2 can all be exported without any further computation.
+        """
+
+        siteCoords, siteParams = self.site_arrays(f"multi-{int(effectiveCharge)}", lambda: self._create_multi_site_arrays(self.bufferedSites, effectiveCharge))
+        cutoffs = np.array([self.conductorCutoffs[conductor] for conductor in self.conductors], dtype=float)
+        maps = np.zeros((len(self.conductors), 2) + tuple(self.voxelNumbers))
+
+        maps = bvse_channel_map(self.voxelNumbers, self.vectors, cutoffs, self.SCREENING_FACTOR, siteCoords, siteParams, maps)
+
+        self.channelMaps = {}
+        self.conductorMaps = {}
+        for i, conductor in enumerate(self.conductors):
+            self.channelMaps[conductor] = {"bond": maps[i][0], "coul": maps[i][1], "total": maps[i][0] + maps[i][1]}
+            self.conductorMaps[conductor] = self.channelMaps[conductor]["total"]
+
+        self.map = self.conductorMaps[self.conductor]
+        self.apply_core_mask()
+        self.mapSettings = {"method": "bvse-channels", "effectiveCharge": effectiveCharge}
+        logging.info(f"Succesful channel map creation for {self.name}")
+
+    def _create_multi_site_arrays(self, selectedSites, effectiveCharge):
+        """
+            Creates the arrays used to calculate the maps of several conductors at once. The site coordinates are shared
+            between all conductors, whilst the parameters are stored for every conductor and site:
+
+                coords[i][0-2] = site coordinates \n
+                params[c][i][0] = site type for the conductor - 0 to ignore, BOND_SITE or COUL_SITE \n
+                params[c][i][1-3] = d0, rmin and b^-1 bv parameters, for a bonding site \n
+                params[c][i][1-4] = conducting ion charge, fixed ion charge and ionic radii, for a repulsive site \n
+            The d0 parameter and fixed ion charge are weighted by the occupancy of the site.
+        """
+
+        coords = np.zeros((len(selectedSites), 3))
+        params = np.zeros((len(self.conductors), len(selectedSites), 5))
+        conductorRadii = [self.db.get_radius(conductor) for conductor in self.conductors]
+
+        for i, site in enumerate(selectedSites.itertuples()):
+
+            coords[i] = site.coords
+
+            for c, conductor in enumerate(self.conductors):
+
+                # Conducting ions are removed from the structure for their own map
+                if site.ion == conductor:
+                    continue
+
+                elif site.ox_state * conductor.ox_state < 0:
+
+                    # Lone pairs only act as a repulsive site for conductors with the same charge sign
+                    if site.ion.element == "LP":
+                        continue
+
+                    bvParam = self.get_bv_param(conductor, site.ion)
+                    params[c][i] = (BOND_SITE, bvParam.d0 * site.occ, bvParam.rmin, bvParam.ib, 0)
+
+                elif site.ion.element != "LP":
+                    bvParam = self.get_bv_param(conductor, site.ion)
+                    if effectiveCharge:
+                        params[c][i] = (COUL_SITE, self.conductor_charge(conductor), self.chargeList[site.ion] * site.occ, bvParam.i1r, bvParam.i2r)
+                    else:
+                        params[c][i] = (COUL_SITE, site.ion.ox_state, conductor.ox_state * site.occ, bvParam.i1r, bvParam.i2r)
+
+                else:
+                    if effectiveCharge:
+                        params[c][i] = (COUL_SITE, self.conductor_charge(conductor), self.LONE_PAIR_CHARGE * site.occ, conductorRadii[c], self.LONE_PAIR_RADIUS)
+                    else:
+                        params[c][i] = (COUL_SITE, conductor.ox_state, self.LONE_PAIR_CHARGE * site.occ, conductorRadii[c], self.LONE_PAIR_RADIUS)
+
+        return coords, params
+
+    def conductor_charge(self, conductor:Ion):
+        """
+            Returns the effective charge of a conducting ion. If the conductor is not present in the structure, it has no
+            effective charge, so the formal oxidation state is used instead.
+        """
+        if conductor in self.chargeList:
+            return self.chargeList[conductor]
+        else:
+            logging.warning(f"The conductor {conductor} is not in the structure - using its oxidation state as the effective charge")
+            return conductor.ox_state
+
     def _delta_bv(self, value:float, ion:str):
         if ion == "F-" or ion == "Na+":
             result = abs(value - 1)
             return result
         
-    def export_map(self, path:Path|str):
+    def map_values(self, conductor:Ion = None, channel:str = None) -> tuple[Ion, np.ndarray]:
+        """
+            Returns a conductor and its map - the main map if no conductor is given, the conductor's map made by
+            populate_map_bvse_multi if one is, or a channel made by populate_map_bvse_channels if a channel is given.
+        """
+
+        if conductor is None:
+            conductor = self.conductor
+            valueMap = self.map
+        else:
+            valueMap = self.conductorMaps[conductor]
+
+        if channel is not None:
+            valueMap = self.channelMaps[conductor][channel]
+
+        return conductor, valueMap
+
+    def export_map(self, path:Path|str, conductor:Ion = None, channel:str = None, pyramid:bool = False):
         """
             Exports the produced map to a file. The file name should end with the supported formats - either .grd or .cube.
+            The map exported for a conductor or channel is chosen as in map_values. If pyramid is set, downsampled copies of
+            the map are written alongside it (see export_pyramid). Returns the path that the map was written to.
         """
 
-        if isinstance(path, str):
-            path = Path(path)
+        conductor, valueMap = self.map_values(conductor, channel)
+        path = available_path(path)
 
-        if path.is_file():
-            for i in range(100):
-                trialPath = path.with_stem(f"{path.stem}-{i}")
-                if not trialPath.is_file():
-                    path = trialPath
-                    break
-            
-            logging.info(f"File already exists - writing to file {path} instead")
+        if path.suffix not in (".grd", ".cube"):
+            logging.error("Unsupported export file type (.grd or .cube supported), exporting a temp.grd file instead in home directory")
+            path = Path("temp.grd")
 
-        if path.suffix == ".grd":
-            self._export_grd(path)
+        if pyramid:
+            self.export_pyramid(path, conductor, valueMap)
         elif path.suffix == ".cube":
-            self._export_cube(path)
+            self._export_cube(path, conductor, valueMap)
         else:
-            logging.error("Unsupported export file type (.grd or .cube supported), exporting a temp.grd file instead in home directory")
-            self._export_grd("temp.grd")
+            self._export_grd(path, conductor, valueMap)
+
+        return path
+
+    def export_pyramid(self, path:Path, conductor:Ion, valueMap:np.ndarray, factors:tuple = None) -> list:
+        """
+            Exports a map together with downsampled levels of it, written next to the map as '<name>-<factor>x' files of
+            the same format. Each voxel of a level holds the lowest value of the block of voxels it covers, so a low
+            energy pathway is never hidden in a coarse level. A level is only written if its factor divides the number of
+            voxels along every axis, so that its voxels lie at the start of the blocks they cover - otherwise, positions
+            read from the level (e.g. by find_sites) would be wrong. 
+
+
+            Every level is built in a single pass over the map, one slab of the coarsest block's thickness at a time,
+            with each level reduced from the one before it. A '<name>-pyramid.json' manifest lists the levels with the
+            coarsest first, so tools can open a small level before loading the full map. 
+
+
+            Returns the paths of the manifest, then the levels from coarsest to the full map.
+        """
+
+        factors = sorted(self.PYRAMID_FACTORS if factors is None else factors)
+        if any(factor % previous != 0 for previous, factor in zip([1] + factors, factors)):
+            raise Exception(f"Each pyramid factor must be a multiple of the one before it - given {factors}")
+
+        dividing = [factor for factor in factors if (self.voxelNumbers % factor == 0).all()]
+        if len(dividing) < len(factors):
+            logging.warning(f"The pyramid factors {[factor for factor in factors if factor not in dividing]} do not divide the {self.voxelNumbers} voxel grid, so those levels are not written")
+        factors = dividing
+
+        levelPaths = {1: path}
+        for factor in factors:
+            levelPaths[factor] = available_path(path.with_stem(f"{path.stem}-{factor}x"))
+
+        levelShapes = {factor: self.voxelNumbers // factor for factor in levelPaths}
+        writeHeader, separator = (self._cube_header, "\n") if path.suffix == ".cube" else (self._grd_header, "  ")
+
+        files = {factor: open(levelPath, "w") for factor, levelPath in levelPaths.items()}
+        try:
+            for factor, file in files.items():
+                writeHeader(file, conductor, levelShapes[factor])
+
+            slabThickness = factors[-1] if factors else 1
+            for start in range(0, self.voxelNumbers[0], slabThickness):
+
+                level, previous = valueMap[start:start + slabThickness], 1
+                for factor in [1] + factors:
+                    level = _block_minimum(level, factor // previous)
+                    previous = factor
+                    if start > 0:
+                        files[factor].write(separator)
+                    level.tofile(files[factor], separator)
+
+        finally:
+            for file in files.values():
+                file.close()
+
+        manifestPath = available_path(path.with_name(f"{path.stem}-pyramid.json"))
+        levels = [{"factor": factor, "file": levelPaths[factor].name, "voxels": levelShapes[factor].tolist()} for factor in sorted(levelPaths, reverse=True)]
+        with open(manifestPath, "w") as f:
+            json.dump({"name": self.name, "reduction": "min", "levels": levels}, f, indent=4)
 
-    def _export_grd(self, path:Path):
+        return [manifestPath] + [levelPaths[factor] for factor in sorted(levelPaths, reverse=True)]
+
+    def _grd_header(self, file, conductor:Ion, voxelNumbers:np.ndarray):
+        """
+            Writes the header of a grd file for a map with the given number of voxels.
+        """
+
+        for ion in self.sites.groupby("ion", sort=False).size().items():
+            file.write(ion.__str__())
+        file.write("    Conducting:%s\n" % (conductor.element))
+
+        file.write("%f %f %f %f %f %f\n" % self.params)
+        file.write("%i %i %i\n" % tuple(voxelNumbers.tolist()))
+
+    def _export_grd(self, path:Path, conductor:Ion, valueMap:np.ndarray):
         """
             Exports the map to a grd file.
         """
 
         with open(path, 'w') as file:
 
-            for ion in self.sites.groupby("ion", sort=False).size().items():
-                file.write(ion.__str__())
-            file.write("    Conducting:%s\n" % (self.conductor.element))
+            self._grd_header(file, conductor, self.voxelNumbers)
+            valueMap.tofile(file,"  ")
+
+    def _cube_header(self, file, conductor:Ion, voxelNumbers:np.ndarray):
+        """
+            Writes the header and atoms of a cube file for a map with the given number of voxels.
+        """
+
+        total = 0
+        elementDict = {}
+
+        for ion in self.sites.groupby("ion", sort=False).size().items():
+            file.write(ion[0].__str__())
+            total += ion[1]
+            elementDict[ion[0].element] = self.db.get_atomic_no(ion[0].element)
+        file.write("\nConducting = %s ; sf = 0.750000;\n" % (conductor.__str__()))
+
+        file.write("%i  0.000000   0.000000   0.000000\n" % (total))
 
-            file.write("%f %f %f %f %f %f\n" % self.params)
-            file.write("%i %i %i\n" % tuple(self.voxelNumbers.tolist()))
+        for i in range(3):
+            voxelVector = self.vectors[i]/(voxelNumbers[i] * self.BOHR_IN_ANGSTROM)
+            file.write("%i  %7.6f   %7.6f   %7.6f\n" % ((voxelNumbers[i],) + tuple(voxelVector)))
 
-            self.map.tofile(file,"  ")
+        for site in self.sites.itertuples():
+            file.write("%i %7.6f    %7.6f   %7.6f   %7.6f\n" % ((elementDict[site.ion.element], self.chargeList[site.ion]) + tuple(site.coords/self.BOHR_IN_ANGSTROM)))
 
-    def _export_cube(self, path:Path):
+    def _export_cube(self, path:Path, conductor:Ion, valueMap:np.ndarray):
         """
             Exports the map to a cube file.
         """
         
         with open(path, "w") as file:
             
-            total = 0
-            elementDict = {}
-
-            for ion in self.sites.groupby("ion", sort=False).size().items():
-                file.write(ion[0].__str__())
-                total += ion[1]
-                elementDict[ion[0].element] = self.db.get_atomic_no(ion[0].element)
-            file.write("\nConducting = %s ; sf = 0.750000;\n" % (self.conductor.__str__()))
-
-            file.write("%i  0.000000   0.000000   0.000000\n" % (total))
-
-            for i in range(3):
-                voxelVector = self.vectors[i]/(self.voxelNumbers[i] * self.BOHR_IN_ANGSTROM)
-                file.write("%i  %7.6f   %7.6f   %7.6f\n" % ((self.voxelNumbers[i],) + tuple(voxelVector)))
-
-            for site in self.sites.itertuples():
-                file.write("%i %7.6f    %7.6f   %7.6f   %7.6f\n" % ((elementDict[site.ion.element], self.chargeList[site.ion]) + tuple(site.coords/self.BOHR_IN_ANGSTROM)))
-            
-            self.map.tofile(file, "\n")
+            self._cube_header(file, conductor, self.voxelNumbers)
+            valueMap.tofile(file, "\n")
             
 
     def reset_map(self):
@@ -663,6 +1248,21 @@ class BVStructure:
             Resets the map back to its blank state, filled with zeroes.
         """
         self.map = np.zeros(self.voxelNumbers)
+        self.mapSettings = None
+
+    def release_maps(self):
+        """
+            Drops every map, field and mask of the structure, keeping the prepared sites, so a structure held in memory
+            only costs its setup. setup_voxels must be called again before the next map is made.
+        """
+        self.map = None
+        self.mapSettings = None
+        self.coreMask = None
+        self.conductorMaps = {}
+        self.channelMaps = {}
+        for field in ("bvsField", "penaltyField"):
+            if hasattr(self, field):
+                delattr(self, field)
 
     # Can't use pycifrw, as starfile code has errors 
     def export_cif(self, outFile:str):
@@ -732,40 +1332,311 @@ class BVStructure:
             else:
                 params = self.get_bv_param(fixedSite.ion, targetSite["ion"])
                 vbv = bvsFunction(params.r0, ri, params.ib, vector)
-                vbvSum += vbv
+                vbvSum += fixedSite.occ * vbv
 
         return vbvSum
 
-    def create_lone_pairs(self, distance:int = 1):
+    def all_site_bvs(self, sites:pd.DataFrame = None) -> tuple[np.ndarray, np.ndarray]:
         """
-            Method that creates dummy sites representing lone pairs in the structure. Accepts optional argument to set the distance these lone pairs should be from the atom that they reside on.
+            Finds the scalar and vector bond valence sums for every site in the unit cell in one call, using a compiled
+            routine over arrays of the buffered sites. Lone pair dummy sites are not included. A selection of rows of the
+            sites dataframe can be given to only find the sums of those sites. Returns a tuple of a numpy array of the
+            scalar sums and a numpy array of the vector sums, both in the same order as the (selected) sites dataframe.
+            As in find_site_bvs, any site closer than 1 Å to a counter-ion is given a sum of 100.
         """
 
-        # Create a dictionary of the lone pair sites and the unit vector representing their direction.
-        lpSiteDict = {}
+        if sites is None:
+            sites = self.sites
 
-        lonePairIon = Ion("LP", -2)
-        
-        for site in self.sites[self.sites["lp"]].itertuples():
-            vbvs = self.find_site_bvs(site.Index, vector=True)
-            magVbvs = np.linalg.norm(vbvs)
-            if magVbvs > self.LONE_PAIR_STRENGTH_CUTOFF:
-                lpNormVec = vbvs / magVbvs
-                lpSiteDict[site.Index] = lpNormVec
+        bufferedSites = self.bufferedSites[self.bufferedSites["ion"].map(lambda ion: ion.element != "LP")]
+
+        # Give every ion an integer index, so the parameters can be stored in a table
+        ions = list(dict.fromkeys(list(sites["ion"]) + list(bufferedSites["ion"])))
+        ionIndex = {ion: i for i, ion in enumerate(ions)}
+        targetIons = set(sites["ion"])
+
+        # Tables of r0 and b^-1 parameters for every pair of ions. Pairs without parameters are left as NaN.
+        r0Table = np.full((len(ions), len(ions)), np.nan)
+        ibTable = np.full((len(ions), len(ions)), np.nan)
+        for i, targetIon in enumerate(ions):
+            if targetIon not in targetIons:
+                continue
+            for j, fixedIon in enumerate(ions):
+                if targetIon.ox_state * fixedIon.ox_state < 0:
+                    try:
+                        params = self.get_bv_param(fixedIon, targetIon)
+                    except MissingParameterError:
+                        continue
+                    r0Table[i][j] = params.r0
+                    ibTable[i][j] = params.ib
+
+        targetCoords = np.stack(sites["coords"].to_numpy())
+        targetSpecies = np.array([ionIndex[ion] for ion in sites["ion"]])
+        targetOs = sites["ox_state"].to_numpy(dtype=float)
+        bufferCoords = np.stack(bufferedSites["coords"].to_numpy())
+        bufferSpecies = np.array([ionIndex[ion] for ion in bufferedSites["ion"]])
+        bufferOs = bufferedSites["ox_state"].to_numpy(dtype=float)
+        bufferOcc = bufferedSites["occ"].to_numpy(dtype=float)
+
+        scalarSums = np.zeros(len(sites))
+        vectorSums = np.zeros((len(sites), 3))
+        site_bvs_all(targetCoords, targetSpecies, targetOs, bufferCoords, bufferSpecies, bufferOs, bufferOcc, r0Table, ibTable, self.rCutoff, scalarSums, vectorSums)
+
+        # A NaN sum means a pair of ions within the cutoff had no parameters
+        if np.isnan(scalarSums).any():
+            missing = sites.index[np.isnan(scalarSums)].tolist()
+            raise MissingParameterError(f"The sites {missing} have neighbours that are not on the BV Parameters Database")
+
+        return scalarSums, vectorSums
+
+    def site_bvs_deviations(self) -> np.ndarray:
+        """
+            Finds the deviation of every site's bond valence sum from the magnitude of its oxidation state. Requires the
+            buffered sites to have been found. Sites closer than 1 Å to a counter-ion have no meaningful sum, so their
+            deviation is NaN. Returns a numpy array in the same order as the sites dataframe.
+        """
+        scalarSums, _ = self.all_site_bvs()
+        deviations = scalarSums - np.abs(self.sites["ox_state"].to_numpy(dtype=float))
+        deviations[scalarSums == self.CLOSE_CONTACT_BVS] = np.nan
+        return deviations
+
+    def global_instability_index(self, deviations:np.ndarray = None) -> float:
+        """
+            Calculates the global instability index - the root mean square of the bond valence sum deviations of every
+            site in the unit cell. The deviations can be provided if they have already been found. Sites with a NaN
+            deviation (see site_bvs_deviations) are left out, and NaN is returned if no site is left.
+        """
+        if deviations is None:
+            deviations = self.site_bvs_deviations()
+
+        deviations = deviations[~np.isnan(deviations)]
+        if len(deviations) == 0:
+            return math.nan
+        return math.sqrt(np.mean(deviations**2))
+
+    def create_lone_pairs(self, distance:int = 1):
+        """
+            Method that creates dummy sites representing lone pairs in the structure. Accepts optional argument to set the distance these lone pairs should be from the atom that they reside on.
+        """
+
+        # Create a dictionary of the lone pair sites and the unit vector representing their direction.
+        lpSiteDict = {}
+
+        lonePairIon = Ion("LP", -2)
+
+        # Only the sites that can have lone pairs are needed, so parameters missing for the other sites do not matter
+        lpSites = self.sites[self.sites["lp"]]
+        if len(lpSites) > 0:
+            _, vectorSums = self.all_site_bvs(lpSites)
+
+        for i, site in enumerate(lpSites.itertuples()):
+            vbvs = vectorSums[i]
+            magVbvs = np.linalg.norm(vbvs)
+            if magVbvs > self.LONE_PAIR_STRENGTH_CUTOFF:
+                lpNormVec = vbvs / magVbvs
+                lpSiteDict[site.Index] = lpNormVec
 
         # For each of these sites in the buffered array, add a lone pair dummy site.
         for site in self.bufferedSites[self.bufferedSites["lp"]].itertuples():
             p1Label = site.Index.split("(")[0]
             if p1Label in lpSiteDict.keys():
-                self.bufferedSites.loc["lp" + site.Index] = [f"lp{site.label}", lonePairIon, -2, 0, site.coords + lpSiteDict[p1Label]*distance]
+                self.bufferedSites.loc["lp" + site.Index] = [f"lp{site.label}", lonePairIon, -2, 0, site.coords + lpSiteDict[p1Label]*distance, site.occ]
+
+        self.siteArrays = {}
 
         logging.debug(self.bufferedSites)
 
+    def add_site(self, p1Label:str, label:str, ion:Ion, coords:np.ndarray, lp:bool = False, occ:float = 1.):
+        """
+            Adds a site to the structure, given its label in the core cell (e.g. 'F9'), its label, ion, cartesian
+            coordinates and occupancy. If a BVSE map has been made, the contribution of the new site is added to it only within the cutoff
+            sphere of each of its images, rather than recalculating the whole map. Lone pair dummy sites are not created.
+        """
+
+        if p1Label in self.sites.index:
+            raise Exception(f"The site {p1Label} is already in the structure")
+        if occ <= 0:
+            raise Exception(f"The occupancy of {p1Label} must be greater than zero - {occ} was given")
+
+        self.sites.loc[p1Label] = [label, ion, ion.ox_state, lp, np.asarray(coords, dtype=float), float(occ)]
+        added = self._buffer_site(next(self.sites.loc[[p1Label]].itertuples()))
+
+        self._update_sites(self.bufferedSites.iloc[0:0], self.bufferedSites.loc[added])
+        logging.info(f"Added site {p1Label} to {self.name}")
+
+    def remove_site(self, p1Label:str):
+        """
+            Removes a site from the structure, for example to create a vacancy, along with its lone pair dummy sites. If a
+            BVSE map has been made, the contribution of the site is subtracted only within the cutoff sphere of each image.
+        """
+
+        if p1Label not in self.sites.index:
+            raise Exception(f"The site {p1Label} is not in the structure")
+
+        removed = self.bufferedSites.loc[self._site_images(p1Label) + self._site_images(p1Label, lonePairs=True)]
+
+        self.sites = self.sites.drop(p1Label)
+        self.bufferedSites = self.bufferedSites.drop(removed.index)
+
+        self._update_sites(removed, self.bufferedSites.iloc[0:0])
+        logging.info(f"Removed site {p1Label} from {self.name}")
+
+    def modify_site(self, p1Label:str, ion:Ion = None, coords:np.ndarray = None, occ:float = None):
+        """
+            Changes the ion (and so the oxidation state), the cartesian coordinates and/or the occupancy of a site. Any lone pair dummy
+            sites move with the site. If a BVSE map has been made, it is updated only within the cutoff sphere of the old
+            and new images of the site.
+        """
+
+        if p1Label not in self.sites.index:
+            raise Exception(f"The site {p1Label} is not in the structure")
+        if occ is not None and occ <= 0:
+            raise Exception(f"The occupancy of {p1Label} must be greater than zero - {occ} was given. Use remove_site to remove the site.")
+
+        site = self.sites.loc[p1Label]
+        ion = site["ion"] if ion is None else ion
+        coords = site["coords"] if coords is None else np.asarray(coords, dtype=float)
+        shift = coords - site["coords"]
+
+        imageLabels = self._site_images(p1Label)
+        lpLabels = self._site_images(p1Label, lonePairs=True)
+        removed = self.bufferedSites.loc[imageLabels + lpLabels]
+        lonePairs = self.bufferedSites.loc[lpLabels]
+
+        self.bufferedSites = self.bufferedSites.drop(removed.index)
+        self.sites.at[p1Label, "ion"] = ion
+        self.sites.at[p1Label, "ox_state"] = ion.ox_state
+        self.sites.at[p1Label, "coords"] = coords
+        if occ is not None:
+            self.sites.at[p1Label, "occ"] = float(occ)
+        added = self._buffer_site(next(self.sites.loc[[p1Label]].itertuples()))
+
+        # Lone pairs are only kept for images that are still within the required area
+        for lpLabel, lonePair in lonePairs.iterrows():
+            if lpLabel[2:] in added:
+                self.bufferedSites.loc[lpLabel] = [lonePair["label"], lonePair["ion"], lonePair["ox_state"], lonePair["lp"], lonePair["coords"] + shift, self.sites.at[p1Label, "occ"]]
+                added.append(lpLabel)
+
+        self._update_sites(removed, self.bufferedSites.loc[added])
+        logging.info(f"Modified site {p1Label} in {self.name}")
+
+    def move_lone_pair(self, p1Label:str, direction:np.ndarray, distance:float = 1):
+        """
+            Moves the lone pair dummy sites of a site to lie the given distance along a direction vector from every image
+            of the site. If a BVSE map has been made, it is updated only within the cutoff sphere of the old and new
+            lone pair sites.
+        """
+
+        lpLabels = self._site_images(p1Label, lonePairs=True)
+
+        if len(lpLabels) == 0:
+            raise Exception(f"The site {p1Label} does not have any lone pair dummy sites")
+
+        removed = self.bufferedSites.loc[lpLabels]
+        offset = np.asarray(direction, dtype=float) / np.linalg.norm(direction) * distance
+
+        for lpLabel in lpLabels:
+            self.bufferedSites.at[lpLabel, "coords"] = self.bufferedSites.at[lpLabel[2:], "coords"] + offset
+
+        self._update_sites(removed, self.bufferedSites.loc[lpLabels])
+        logging.info(f"Moved the lone pairs of {p1Label} in {self.name}")
+
+    def set_frame(self, coords:np.ndarray, vectors:np.ndarray = None):
+        """
+            Moves every core cell site to new cartesian coordinates, given in the order of the sites dataframe, and
+            optionally changes the lattice vectors, e.g. for each frame of a molecular dynamics trajectory. The bond
+            valence parameters, effective charges, cutoff radius and site types are all kept. The buffered sites must be
+            found again with prepare before the next map is made. The number of voxels is not changed, so the maps of
+            every frame share one grid.
+        """
+
+        coords = np.asarray(coords, dtype=float)
+        if coords.shape != (len(self.sites), 3):
+            raise Exception(f"A frame of {self.name} needs coordinates for {len(self.sites)} sites - {coords.shape[0]} were given")
+
+        if vectors is not None:
+            self.vectors = np.array(vectors, dtype=float)
+            self.inverseVectors = np.linalg.inv(self.vectors)
+            lengths = np.linalg.norm(self.vectors, axis=1)
+            angles = [math.degrees(math.acos(np.dot(self.vectors[j], self.vectors[k]) / (lengths[j] * lengths[k]))) for j, k in ((1, 2), (0, 2), (0, 1))]
+            self.params = tuple(lengths.tolist()) + tuple(angles)
+            self.volume = abs(np.linalg.det(self.vectors))
+
+        self.sites["coords"] = pd.Series(list(coords), index=self.sites.index, dtype=object)
+        self.siteArrays = {}
+        self.mapSettings = None
+
+        if getattr(self, "coreMask", None) is not None:
+            self.create_core_mask(self.coreRadius)
+
+    def _site_images(self, p1Label:str, lonePairs:bool = False) -> list:
+        """
+            Returns the labels of the buffered images of a core cell site, or of its lone pair dummy sites.
+        """
+        prefix = f"lp{p1Label}(" if lonePairs else f"{p1Label}("
+        return [label for label in self.bufferedSites.index if label.startswith(prefix)]
+
+    def _update_sites(self, removed:pd.DataFrame, added:pd.DataFrame):
+        """
+            Updates the map after buffered sites have been removed and/or added, by subtracting the contributions of the
+            removed sites and adding those of the new sites within their cutoff spheres. Only maps made with
+            populate_map_bvse_jit can be updated - other maps will need to be made again. The effective charges are found
+            again for the new structure. If a map with Coulombic energies uses them and any have changed, every site
+            contributes differently, so the map is made again in full.
+        """
+
+        # The stored site arrays no longer match the buffered sites, and the core mask is stamped around the sites again
+        self.siteArrays = {}
+        oldMask = getattr(self, "coreMask", None)
+        if oldMask is not None:
+            self.create_core_mask(self.coreRadius)
+
+        newCharges = self.find_effective_charges()
+        chargesChanged = any(ion in self.chargeList and not math.isclose(charge, self.chargeList[ion]) for ion, charge in newCharges.items())
+        self.chargeList = newCharges
+
+        mapSettings = getattr(self, "mapSettings", None)
+
+        if mapSettings is None or mapSettings["method"] != "bvse":
+            if mapSettings is not None:
+                logging.warning(f"Incremental updates are only implemented for BVSE maps made with JIT - the {mapSettings['method']} map has not been updated")
+                self.mapSettings = None
+            return
+
+        if chargesChanged and mapSettings["effectiveCharge"] and mapSettings["mode"] > 0:
+            logging.warning(f"The effective charges of {self.name} have changed, so the whole map is made again")
+            self.map = np.zeros(self.voxelNumbers)
+            self.populate_map_bvse_jit(mode=mapSettings["mode"], effectiveCharge=True)
+            return
+
+        for sign, changed in ((-1., removed), (1., added)):
+
+            # Conducting ions are not part of the map
+            changed = changed[changed["ion"] != self.conductor]
+            if len(changed) == 0:
+                continue
+
+            bondIons = self._create_bond_site_array(changed)
+            coulIons = self._create_coul_site_array(changed, mapSettings["effectiveCharge"])
+            bvse_update_map(self.voxelNumbers, self.vectors, self.inverseVectors, self.rCutoff, mapSettings["mode"], self.SCREENING_FACTOR, bondIons, coulIons, sign, self.map)
+
+        # Voxels that have left the core mask were never calculated, so they are found in full, skipping every other voxel
+        if oldMask is not None:
+            released = oldMask & ~self.coreMask
+            if released.any():
+                selectedSites = self.bufferedSites[self.bufferedSites["ion"] != self.conductor]
+                bondIons, coulIons = self._create_bond_site_array(selectedSites), self._create_coul_site_array(selectedSites, mapSettings["effectiveCharge"])
+                releasedMap = bvse_map_fused(self.voxelNumbers, self.vectors, self.rCutoff, mapSettings["mode"], self.SCREENING_FACTOR, bondIons, coulIons, np.zeros(self.voxelNumbers), ~released, self.CORE_SENTINEL)
+                self.map[released] = releasedMap[released]
+
+        self.apply_core_mask()
+
     def find_effective_charges(self):
 
         chargeDf = pd.DataFrame(columns=["V","n","N"])
 
-        for ion, N in self.sites.groupby("ion", sort=False).size().items():
+        # Partially occupied sites count by their occupancy
+        for ion, N in self.sites.groupby("ion", sort=False)["occ"].sum().items():
             chargeDf.loc[ion] = [ion.ox_state, self.db.get_period(ion), N]
 
         chargeDf["part"] = chargeDf["V"] * chargeDf["N"] / np.sqrt(chargeDf["n"])
@@ -783,8 +1654,159 @@ class BVStructure:
         return out
 
 
+def available_path(path:Path|str) -> Path:
+    """
+        Returns a path that can be written to without overwriting a file. If the path already exists, a number is appended
+        to the file name.
+    """
+
+    if isinstance(path, str):
+        path = Path(path)
+
+    if path.is_file():
+        for i in range(100):
+            trialPath = path.with_stem(f"{path.stem}-{i}")
+            if not trialPath.is_file():
+                path = trialPath
+                break
+        
+        logging.info(f"File already exists - writing to file {path} instead")
+
+    return path
+
+def group_site_array(siteArray:np.ndarray, paramColumns:int) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+        Reorganises a site array (such as from _create_bond_site_array) into a structure of arrays grouped by species,
+        where every site in a group shares the same parameters. Returns: 
+
+
+            coords - The coordinates with the shape [x, y, z][site], with the sites of each group next to each other 
+
+            offsets - The first site of each group, followed by the number of sites 
+
+            params - The parameter columns of each group, with the shape [group][parameter] 
+
+    """
+
+    if siteArray.size == 0:
+        return np.zeros((3, 0)), np.zeros(1, dtype=np.int64), np.zeros((0, paramColumns))
+
+    params, groups = np.unique(siteArray[:, 3:3 + paramColumns], axis=0, return_inverse=True)
+    groups = groups.reshape(-1)
+    order = np.lexsort((siteArray[:, 2], groups))
+
+    coords = np.ascontiguousarray(siteArray[order, :3].T)
+    offsets = np.concatenate(([0], np.cumsum(np.bincount(groups, minlength=len(params))))).astype(np.int64)
+
+    return coords, offsets, params
+
+def _block_minimum(values:np.ndarray, factor:int) -> np.ndarray:
+    """
+        Reduces an array by a factor along every axis, keeping the lowest value of each block. The last block along an
+        axis is smaller if the factor does not divide its length.
+    """
+
+    if factor == 1:
+        return values
+
+    for axis in range(values.ndim):
+        values = np.minimum.reduceat(values, np.arange(0, values.shape[axis], factor), axis=axis)
+
+    return values
+
+
+def cell_site_array(siteArray:np.ndarray, inverseVectors:np.ndarray) -> np.ndarray:
+    """
+        Reduces a site array of buffered sites to one row per site of the unit cell, with the coordinates replaced by
+        fractional coordinates in [0, 1). Images of a site are recognised by their wrapped coordinates and parameters.
+    """
+
+    fracCoords = np.round((siteArray[:, :3] @ inverseVectors) % 1, 8) % 1
+    return np.unique(np.column_stack((fracCoords, siteArray[:, 3:])), axis=0)
+
+def deposit_sites(voxelNos:np.ndarray, fracCoords:np.ndarray) -> np.ndarray:
+    """
+        Spreads sites onto the periodic voxel grid, each over the 4x4x4 voxels around it with cubic Lagrange weights.
+        Convolving the grid with a kernel then interpolates the kernel at each site's exact position, which is accurate
+        to fourth order in the voxel size rather than the second order of cloud-in-cell weights.
+    """
+
+    scaled = fracCoords * voxelNos
+    corner = np.floor(scaled).astype(np.int64)
+    w = scaled - corner
+
+    # The weights of the voxels one before to two after the corner, with the shape [voxel][site][axis]
+    weights = np.stack((-w*(w - 1)*(w - 2)/6, (w + 1)*(w - 1)*(w - 2)/2, -(w + 1)*w*(w - 2)/2, (w + 1)*w*(w - 1)/6))
+
+    # Every pairing of the weights along the three axes, with the shape [h][k][l][site]
+    offsets = np.stack(np.meshgrid(*[np.arange(-1, 3)] * 3, indexing="ij"), axis=-1)
+    voxels = np.ravel_multi_index(np.moveaxis((corner + offsets[..., None, :]) % voxelNos, -1, 0), voxelNos)
+    products = weights[:, None, None, :, 0] * weights[None, :, None, :, 1] * weights[None, None, :, :, 2]
+
+    return np.bincount(voxels.reshape(-1), weights=products.reshape(-1), minlength=int(np.prod(voxelNos))).reshape(voxelNos)
+
+def fft_map(voxelNos:np.ndarray, vectors:np.ndarray, cutoff:float, term:int, siteArray:np.ndarray, paramColumns:int, constants:np.ndarray) -> np.ndarray:
+    """
+        Sums one term (numbered as in scatter_sites) of every site over the voxels within the cutoff, as a periodic
+        convolution. The sites of the unit cell are grouped by their parameters, and each group's density (see
+        deposit_sites) is convolved with the group's kernel (see periodic_kernel) by FFT. The cost grows with the number
+        of voxels and groups, but not with the number of sites.
+    """
+
+    voxelNos = tuple(int(n) for n in voxelNos)
+    if siteArray.size == 0:
+        return np.zeros(voxelNos)
+
+    cellSites = cell_site_array(siteArray, np.linalg.inv(vectors))
+    params, groups = np.unique(cellSites[:, 3:3 + paramColumns], axis=0, return_inverse=True)
+    groups = groups.reshape(-1)
+
+    total = np.zeros((voxelNos[0], voxelNos[1], voxelNos[2] // 2 + 1), dtype=complex)
+    for g in range(len(params)):
+        density = deposit_sites(np.array(voxelNos), cellSites[groups == g, :3])
+        kernel = periodic_kernel(np.array(voxelNos), vectors, cutoff, term, params[g], constants, np.zeros(voxelNos))
+        total += np.fft.rfftn(density) * np.fft.rfftn(kernel)
+
+    return np.fft.irfftn(total, s=voxelNos, axes=(0, 1, 2))
+
+def bvse_map_fft(voxelNos:np.ndarray, vectors:np.ndarray, cutoff:float, mode:int, screeningFactor:float, bondIons:np.ndarray, coulIons:np.ndarray, resultMap:np.ndarray, mask:np.ndarray = None, sentinel:float = 0.):
+    """
+        Calculates the BVSE at every voxel by FFT convolution (see fft_map), with the same arguments as bvse_map_fused.
+        The map is close to bvse_map away from the sites, with errors falling as the fourth power of the voxel size,
+        but not within a few voxels of a site. Masked voxels are calculated, then given the sentinel value.
+    """
+
+    constants = np.array((screeningFactor,))
+    resultMap[...] = 0.
+    if mode < 2:
+        resultMap += fft_map(voxelNos, vectors, cutoff, 0, bondIons, 3, constants)
+    if mode > 0:
+        resultMap += fft_map(voxelNos, vectors, cutoff, 1, coulIons, 4, constants)
+
+    if mask is not None:
+        resultMap[mask] = sentinel
+    return resultMap
+
+def bvsm_map_fft(voxelNos:np.ndarray, vectors:np.ndarray, cutoff:float, conductorOs:int, mode:int, bvIons:np.ndarray, penIons:np.ndarray, resultMap:np.ndarray, mask:np.ndarray = None, sentinel:float = 0.):
+    """
+        Calculates the BVSM at every voxel by FFT convolution, with the same arguments as bvsm_map_fused. The bond
+        valence sum and the penalty function are each convolved, then combined as in voxel_bvsm.
+    """
+
+    constants = np.array((float(conductorOs),))
+    bvs = fft_map(voxelNos, vectors, cutoff, 2, bvIons, 2, constants) if mode < 2 else abs(conductorOs)
+    penaltySum = fft_map(voxelNos, vectors, cutoff, 3, penIons, 2, constants) if mode > 0 else 0.
+
+    resultMap[...] = np.abs(bvs - abs(conductorOs)) + penaltySum
+    if mask is not None:
+        resultMap[mask] = sentinel
+    return resultMap
+
 # ----- JITED FUNCTIONS -----
 
+BOND_SITE = 1 # Site type flag for a site that forms bonds with the conductor
+COUL_SITE = 2 # Site type flag for a site that repels the conductor
+
 @njit(cache=True)
 def calc_bv(r0:float, ri:float, ib:float, vector = None) -> float :
     """
@@ -811,6 +1833,61 @@ def calc_vector_bv(r0: float, ri:float, ib:float, vector:np.ndarray) -> np.ndarr
     """
     return calc_bv(r0, ri, ib) * vector / ri
 
+@njit(cache=True)
+def site_bvs_all(targetCoords:np.ndarray, targetSpecies:np.ndarray, targetOs:np.ndarray, bufferCoords:np.ndarray, bufferSpecies:np.ndarray, bufferOs:np.ndarray, bufferOcc:np.ndarray, r0Table:np.ndarray, ibTable:np.ndarray, cutoff:float, scalarSums:np.ndarray, vectorSums:np.ndarray):
+    """
+        Calculates the scalar and vector bond valence sums of every target site against the buffered sites. Arguments: \n
+        targetCoords, bufferCoords - Arrays of site coordinates, in the format [[x, y, z]] \n
+        targetSpecies, bufferSpecies - The index of each site's ion in the parameter tables \n
+        targetOs, bufferOs - The oxidation state of each site \n
+        bufferOcc - The occupancy of each buffered site, which weights its bond valence \n
+        r0Table, ibTable - Tables of the r0 and b^-1 parameters, indexed by [target ion][buffered ion] \n
+        cutoff - The radius cutoff \n
+        scalarSums, vectorSums - Arrays that the results are written to.
+    """
+
+    cutoff2 = cutoff**2
+
+    for t in range(targetCoords.shape[0]):
+
+        bvSum = 0.
+        vx = 0.
+        vy = 0.
+        vz = 0.
+
+        for i in range(bufferCoords.shape[0]):
+
+            # Only sites of opposite charge contribute to the sum
+            if targetOs[t] * bufferOs[i] >= 0:
+                continue
+
+            dx = targetCoords[t][0] - bufferCoords[i][0]
+            dy = targetCoords[t][1] - bufferCoords[i][1]
+            dz = targetCoords[t][2] - bufferCoords[i][2]
+            r2 = dx*dx + dy*dy + dz*dz
+
+            if r2 > cutoff2:
+                continue
+
+            ri = math.sqrt(r2)
+
+            # If the seperation is less than 1 Å, the sum is set to a very high value so the site is disregarded
+            if ri < 1:
+                bvSum = 100.
+                vx = vy = vz = 100.
+                break
+
+            bv = bufferOcc[i] * calc_bv(r0Table[targetSpecies[t]][bufferSpecies[i]], ri, ibTable[targetSpecies[t]][bufferSpecies[i]])
+            bvSum += bv
+            vx += bv * dx / ri
+            vy += bv * dy / ri
+            vz += bv * dz / ri
+
+        scalarSums[t] = bvSum
+        vectorSums[t][0] = vx
+        vectorSums[t][1] = vy
+        vectorSums[t][2] = vz
+
 @njit(float64(float64, float64, float64, float64),cache=True)
 def calc_Ebond(d0:float, rmin:float, ri:float, ib:float) -> float:
     """
@@ -902,6 +1979,551 @@ def bvse_map(voxelNos:np.ndarray, vectors:np.ndarray, cutoff:float, mode:int, sc
 
     return resultMap
 
+@njit(cache=True)
+def axis_positions(voxelNos:np.ndarray, vectors:np.ndarray) -> np.ndarray:
+    """
+        Tabulates the contribution of each voxel index along each axis to a voxel's cartesian position, so positions can be
+        built up one axis at a time without any arrays being made per voxel. Returns an array of shape
+        [axis][index][x, y, z]. Summing the rows for h, k and l in that order gives the same position as voxel_bvse.
+    """
+
+    positions = np.zeros((3, voxelNos.max(), 3))
+    for i in range(3):
+        for n in range(voxelNos[i]):
+            for j in range(3):
+                positions[i][n][j] = (n/voxelNos[i]) * vectors[i][j]
+
+    return positions
+
+@njit(cache=True)
+def stamp_core_mask(voxelNos:np.ndarray, vectors:np.ndarray, inverseVectors:np.ndarray, siteCoords:np.ndarray, radius:float, mask:np.ndarray):
+    """
+        Marks every voxel within a radius of any of the sites in a mask. Only the voxels in the box around each sphere
+        are checked, with voxel indices beyond the cell wrapped back into it.
+    """
+
+    radius2 = radius * radius
+
+    # The half-width of a sphere in voxels along each axis
+    extents = np.zeros(3)
+    for i in range(3):
+        extents[i] = radius * math.sqrt(inverseVectors[0, i]**2 + inverseVectors[1, i]**2 + inverseVectors[2, i]**2) * voxelNos[i]
+
+    for s in range(siteCoords.shape[0]):
+
+        centre = np.zeros(3)
+        for i in range(3):
+            centre[i] = (siteCoords[s, 0] * inverseVectors[0, i] + siteCoords[s, 1] * inverseVectors[1, i] + siteCoords[s, 2] * inverseVectors[2, i]) * voxelNos[i]
+
+        for h in range(math.floor(centre[0] - extents[0]), math.ceil(centre[0] + extents[0]) + 1):
+            for k in range(math.floor(centre[1] - extents[1]), math.ceil(centre[1] + extents[1]) + 1):
+                for l in range(math.floor(centre[2] - extents[2]), math.ceil(centre[2] + extents[2]) + 1):
+
+                    r2 = 0.
+                    for j in range(3):
+                        position = (h/voxelNos[0]) * vectors[0, j] + (k/voxelNos[1]) * vectors[1, j] + (l/voxelNos[2]) * vectors[2, j]
+                        r2 += (position - siteCoords[s, j])**2
+
+                    if r2 < radius2:
+                        mask[h % voxelNos[0], k % voxelNos[1], l % voxelNos[2]] = True
+
+    return mask
+
+@njit(cache=True)
+def bvse_map_fused(voxelNos:np.ndarray, vectors:np.ndarray, cutoff:float, mode:int, screeningFactor:float, bondIons:np.ndarray, coulIons:np.ndarray, resultMap:np.ndarray, mask:np.ndarray = None, sentinel:float = 0.):
+    """
+        Calculates the BVSE at every voxel, giving the same map as bvse_map. The voxel positions are built up along each
+        axis from a table, distances are compared with the cutoff while still squared, and nothing is allocated inside the
+        loops. The site arrays have the same format as for voxel_bvse. If a mask is given, the voxels set in it are
+        skipped and given the sentinel value instead.
+    """
+    return bvse_tile(voxelNos, vectors, cutoff, mode, screeningFactor, bondIons, coulIons, np.zeros(3, dtype=np.int64), voxelNos.astype(np.int64), resultMap, mask, sentinel)
+
+@njit(cache=True)
+def bvse_tile(voxelNos:np.ndarray, vectors:np.ndarray, cutoff:float, mode:int, screeningFactor:float, bondIons:np.ndarray, coulIons:np.ndarray, lower:np.ndarray, upper:np.ndarray, resultMap:np.ndarray, mask:np.ndarray = None, sentinel:float = 0.):
+    """
+        Calculates the BVSE of the voxels in one tile of the map, from the lower voxel index up to (but not including) the
+        upper voxel index on each axis, as in bvse_map_fused. The rest of the result map is left untouched.
+    """
+
+    positions = axis_positions(voxelNos, vectors)
+    cutoff2 = cutoff * cutoff
+    bondCount = bondIons.shape[0] if mode < 2 and bondIons.size > 0 else 0
+    coulCount = coulIons.shape[0] if mode > 0 and coulIons.size > 0 else 0
+
+    for h in range(lower[0], upper[0]):
+        for k in range(lower[1], upper[1]):
+
+            # The part of the position shared by the whole row of voxels
+            rowX = positions[0][h][0] + positions[1][k][0]
+            rowY = positions[0][h][1] + positions[1][k][1]
+            rowZ = positions[0][h][2] + positions[1][k][2]
+
+            for l in range(lower[2], upper[2]):
+
+                if mask is not None:
+                    if mask[h, k, l]:
+                        resultMap[h, k, l] = sentinel
+                        continue
+
+                x = rowX + positions[2][l][0]
+                y = rowY + positions[2][l][1]
+                z = rowZ + positions[2][l][2]
+                Ebond = 0.
+                Ecoul = 0.
+
+                for i in range(bondCount):
+                    dx = bondIons[i, 0] - x
+                    dy = bondIons[i, 1] - y
+                    dz = bondIons[i, 2] - z
+                    r2 = dx*dx + dy*dy + dz*dz
+                    if r2 <= cutoff2:
+                        Ebond += calc_Ebond(bondIons[i, 3], bondIons[i, 4], math.sqrt(r2), bondIons[i, 5])
+
+                for i in range(coulCount):
+                    dx = coulIons[i, 0] - x
+                    dy = coulIons[i, 1] - y
+                    dz = coulIons[i, 2] - z
+                    r2 = dx*dx + dy*dy + dz*dz
+                    if r2 <= cutoff2:
+                        Ecoul += calc_Ecoul(coulIons[i, 3], coulIons[i, 4], math.sqrt(r2), coulIons[i, 5], coulIons[i, 6], screeningFactor)
+
+                resultMap[h, k, l] = Ebond + Ecoul
+
+    return resultMap
+
+@njit(cache=True)
+def bvse_map_grouped(voxelNos:np.ndarray, vectors:np.ndarray, cutoff:float, mode:int, screeningFactor:float, bondCoords:np.ndarray, bondOffsets:np.ndarray, bondParams:np.ndarray, coulCoords:np.ndarray, coulOffsets:np.ndarray, coulParams:np.ndarray, resultMap:np.ndarray, mask:np.ndarray = None, sentinel:float = 0.):
+    """
+        Calculates the BVSE at every voxel from site arrays grouped by species with group_site_array, giving the same map
+        as bvse_map up to rounding. The parameters of each group are read once per voxel rather than once per site, the
+        terms that only depend on them are worked out before the loops, and the coordinates of each group are read from
+        three contiguous rows, so the inner loops stream through memory. As the sites of a group are sorted by z, only
+        the run of sites within the cutoff of the voxel in z is streamed, found by a binary search. Masked voxels are
+        skipped as in bvse_map_fused.
+    """
+
+    positions = axis_positions(voxelNos, vectors)
+    cutoff2 = cutoff * cutoff
+    bondGroups = bondParams.shape[0] if mode < 2 else 0
+    coulGroups = coulParams.shape[0] if mode > 0 else 0
+
+    # The Coulombic terms only need the product of the charges and the inverse of the screening length
+    coulCharges = np.empty(coulParams.shape[0])
+    coulScreening = np.empty(coulParams.shape[0])
+    for g in range(coulParams.shape[0]):
+        coulCharges[g] = coulParams[g, 0] * coulParams[g, 1]
+        coulScreening[g] = 1 / (screeningFactor * (coulParams[g, 2] + coulParams[g, 3]))
+
+    bondX, bondY, bondZ = bondCoords[0], bondCoords[1], bondCoords[2]
+    coulX, coulY, coulZ = coulCoords[0], coulCoords[1], coulCoords[2]
+
+    # Scratch space for the squared distances of the largest group
+    largestGroup = 0
+    for offsets in (bondOffsets, coulOffsets):
+        for g in range(offsets.shape[0] - 1):
+            largestGroup = max(largestGroup, offsets[g + 1] - offsets[g])
+    distances = np.empty(largestGroup)
+
+    for h in range(voxelNos[0]):
+        for k in range(voxelNos[1]):
+
+            rowX = positions[0][h][0] + positions[1][k][0]
+            rowY = positions[0][h][1] + positions[1][k][1]
+            rowZ = positions[0][h][2] + positions[1][k][2]
+
+            for l in range(voxelNos[2]):
+
+                if mask is not None:
+                    if mask[h, k, l]:
+                        resultMap[h, k, l] = sentinel
+                        continue
+
+                x = rowX + positions[2][l][0]
+                y = rowY + positions[2][l][1]
+                z = rowZ + positions[2][l][2]
+                energy = 0.
+
+                for g in range(bondGroups):
+                    groupZ = bondZ[bondOffsets[g]:bondOffsets[g + 1]]
+                    start = bondOffsets[g] + np.searchsorted(groupZ, z - cutoff)
+                    end = bondOffsets[g] + np.searchsorted(groupZ, z + cutoff, side="right")
+
+                    # The squared distances within the cutoff, packed to the front of the scratch space without branches
+                    inside = 0
+                    for i in range(start, end):
+                        dx = bondX[i] - x
+                        dy = bondY[i] - y
+                        dz = bondZ[i] - z
+                        r2 = dx*dx + dy*dy + dz*dz
+                        distances[inside] = r2
+                        inside += r2 <= cutoff2
+
+                    d0, rmin, ib = bondParams[g, 0], bondParams[g, 1], bondParams[g, 2]
+                    for i in range(inside):
+                        stretch = math.exp((rmin - math.sqrt(distances[i])) * ib) - 1
+                        energy += d0 * stretch * stretch - d0
+
+                for g in range(coulGroups):
+                    groupZ = coulZ[coulOffsets[g]:coulOffsets[g + 1]]
+                    start = coulOffsets[g] + np.searchsorted(groupZ, z - cutoff)
+                    end = coulOffsets[g] + np.searchsorted(groupZ, z + cutoff, side="right")
+
+                    inside = 0
+                    for i in range(start, end):
+                        dx = coulX[i] - x
+                        dy = coulY[i] - y
+                        dz = coulZ[i] - z
+                        r2 = dx*dx + dy*dy + dz*dz
+                        distances[inside] = r2
+                        inside += r2 <= cutoff2
+
+                    charges, screening = coulCharges[g], coulScreening[g]
+                    for i in range(inside):
+                        r = math.sqrt(distances[i])
+                        energy += charges / r * math.erfc(r * screening)
+
+                resultMap[h, k, l] = energy
+
+    return resultMap
+
+@njit(cache=True)
+def scatter_stencil(voxelNos:np.ndarray, vectors:np.ndarray, cutoff:float) -> np.ndarray:
+    """
+        Lists the voxels a site can reach within the cutoff, as offsets from the voxel found by rounding the site's voxel
+        index down. The site may sit anywhere in the voxel cell between that voxel and the next, so each offset is tested
+        against the centre of the cell with the cutoff widened by half of the cell's longest diagonal. Returns rows of
+        [dh, dk, lowest dl, highest dl], one for each line of voxels along the last axis, sorted by dh.
+    """
+
+    inverseVectors = np.linalg.inv(vectors)
+    steps = np.empty((3, 3))
+    for i in range(3):
+        steps[i] = vectors[i] / voxelNos[i]
+
+    halfDiagonal = 0.
+    for sk in (-1., 1.):
+        for sl in (-1., 1.):
+            halfDiagonal = max(halfDiagonal, 0.5 * math.sqrt(np.sum((steps[0] + sk*steps[1] + sl*steps[2])**2)))
+    reach = cutoff + halfDiagonal + 1e-9
+    reach2 = reach * reach
+
+    # The widest offsets needed along the first two axes
+    extents = np.zeros(2, dtype=np.int64)
+    for i in range(2):
+        extents[i] = math.ceil(reach * math.sqrt(inverseVectors[0, i]**2 + inverseVectors[1, i]**2 + inverseVectors[2, i]**2) * voxelNos[i]) + 1
+
+    lSquared = np.sum(steps[2]**2)
+    rows = np.empty(((2*extents[0] + 1) * (2*extents[1] + 1), 4), dtype=np.int64)
+    count = 0
+
+    for dh in range(-extents[0], extents[0] + 1):
+        for dk in range(-extents[1], extents[1] + 1):
+
+            # The offsets along the last axis within reach of the centre solve a quadratic in dl
+            base = (dh - 0.5)*steps[0] + (dk - 0.5)*steps[1]
+            b = np.sum(base * steps[2])
+            discriminant = b*b - lSquared * (np.sum(base**2) - reach2)
+            if discriminant < 0:
+                continue
+
+            root = math.sqrt(discriminant)
+            lowest = math.ceil((-b - root) / lSquared + 0.5)
+            highest = math.floor((-b + root) / lSquared + 0.5)
+            if lowest > highest:
+                continue
+
+            rows[count, 0], rows[count, 1], rows[count, 2], rows[count, 3] = dh, dk, lowest, highest
+            count += 1
+
+    return rows[:count].copy()
+
+@njit(cache=True)
+def scatter_sites(voxelNos:np.ndarray, inverseVectors:np.ndarray, positions:np.ndarray, stencil:np.ndarray, cutoff:float, term:int, ions:np.ndarray, constants:np.ndarray, lower:np.ndarray, upper:np.ndarray, accumulator:np.ndarray, mask:np.ndarray = None):
+    """
+        Adds one term of every site to the voxels of a tile within the cutoff of the site, visiting only the voxels in
+        the site's stencil (see scatter_stencil). Terms are 0 for bonding energy, 1 for Coulombic energy, 2 for bond
+        valence and 3 for the penalty function, with the site arrays of voxel_bvse and voxel_bvsm. The constants are the
+        screening factor for Coulombic energy, or the conductor's oxidation state for the penalty function. The
+        accumulator holds the tile only, with the tile's lower voxel at index zero, so tiles never write to the same
+        voxel and can be run side by side. Distances match the voxel-centric kernels exactly, and each voxel receives
+        the sites in order, so the sums match too.
+    """
+
+    cutoff2 = cutoff * cutoff
+    if ions.size == 0:
+        return accumulator
+
+    # The range of offsets along the first two axes, to skip sites whose stencil misses the tile
+    lowestH, highestH = stencil[:, 0].min(), stencil[:, 0].max()
+    lowestK, highestK = stencil[:, 1].min(), stencil[:, 1].max()
+
+    for i in range(ions.shape[0]):
+
+        siteH = math.floor((ions[i, 0]*inverseVectors[0, 0] + ions[i, 1]*inverseVectors[1, 0] + ions[i, 2]*inverseVectors[2, 0]) * voxelNos[0])
+        siteK = math.floor((ions[i, 0]*inverseVectors[0, 1] + ions[i, 1]*inverseVectors[1, 1] + ions[i, 2]*inverseVectors[2, 1]) * voxelNos[1])
+        siteL = math.floor((ions[i, 0]*inverseVectors[0, 2] + ions[i, 1]*inverseVectors[1, 2] + ions[i, 2]*inverseVectors[2, 2]) * voxelNos[2])
+
+        if siteH + highestH < lower[0] or siteH + lowestH >= upper[0] or siteK + highestK < lower[1] or siteK + lowestK >= upper[1]:
+            continue
+
+        for row in range(stencil.shape[0]):
+
+            h = siteH + stencil[row, 0]
+            k = siteK + stencil[row, 1]
+            if h < lower[0] or h >= upper[0] or k < lower[1] or k >= upper[1]:
+                continue
+
+            rowX = positions[0][h][0] + positions[1][k][0]
+            rowY = positions[0][h][1] + positions[1][k][1]
+            rowZ = positions[0][h][2] + positions[1][k][2]
+
+            for l in range(max(siteL + stencil[row, 2], lower[2]), min(siteL + stencil[row, 3] + 1, upper[2])):
+
+                if mask is not None:
+                    if mask[h, k, l]:
+                        continue
+
+                dx = ions[i, 0] - (rowX + positions[2][l][0])
+                dy = ions[i, 1] - (rowY + positions[2][l][1])
+                dz = ions[i, 2] - (rowZ + positions[2][l][2])
+                r2 = dx*dx + dy*dy + dz*dz
+                if r2 > cutoff2:
+                    continue
+
+                if term == 0:
+                    value = calc_Ebond(ions[i, 3], ions[i, 4], math.sqrt(r2), ions[i, 5])
+                elif term == 1:
+                    value = calc_Ecoul(ions[i, 3], ions[i, 4], math.sqrt(r2), ions[i, 5], ions[i, 6], constants[0])
+                elif term == 2:
+                    value = calc_bv(ions[i, 4], math.sqrt(r2), ions[i, 3])
+                else:
+                    value = calc_penalty(math.sqrt(r2), constants[0], ions[i, 3], ions[i, 4], cutoff)
+
+                accumulator[h - lower[0], k - lower[1], l - lower[2]] += value
+
+    return accumulator
+
+@njit(cache=True)
+def periodic_kernel(voxelNos:np.ndarray, vectors:np.ndarray, cutoff:float, term:int, params:np.ndarray, constants:np.ndarray, kernel:np.ndarray):
+    """
+        Tabulates one term of a site with the given parameters (the columns after the coordinates of its site array)
+        on the periodic voxel grid, by the displacement from the site, for fft_map. Every image of a displacement within
+        the cutoff is added. Distances below half a voxel are raised to half a voxel, so the site's own voxel stays
+        finite.
+    """
+
+    stencil = scatter_stencil(voxelNos, vectors, cutoff)
+    steps = np.empty((3, 3))
+    for i in range(3):
+        steps[i] = vectors[i] / voxelNos[i]
+
+    cutoff2 = cutoff * cutoff
+    closest = 0.5 * min(math.sqrt(np.sum(steps[0]**2)), math.sqrt(np.sum(steps[1]**2)), math.sqrt(np.sum(steps[2]**2)))
+
+    for row in range(stencil.shape[0]):
+        dh, dk = stencil[row, 0], stencil[row, 1]
+        h, k = dh % voxelNos[0], dk % voxelNos[1]
+        rowX = dh*steps[0, 0] + dk*steps[1, 0]
+        rowY = dh*steps[0, 1] + dk*steps[1, 1]
+        rowZ = dh*steps[0, 2] + dk*steps[1, 2]
+        l = stencil[row, 2] % voxelNos[2]
+
+        for dl in range(stencil[row, 2], stencil[row, 3] + 1):
+
+            dx = rowX + dl*steps[2, 0]
+            dy = rowY + dl*steps[2, 1]
+            dz = rowZ + dl*steps[2, 2]
+            r2 = dx*dx + dy*dy + dz*dz
+            voxel = l
+            l = l + 1 if l + 1 < voxelNos[2] else 0
+            if r2 > cutoff2:
+                continue
+
+            r = max(math.sqrt(r2), closest)
+            if term == 0:
+                value = calc_Ebond(params[0], params[1], r, params[2])
+            elif term == 1:
+                value = calc_Ecoul(params[0], params[1], r, params[2], params[3], constants[0])
+            elif term == 2:
+                value = calc_bv(params[1], r, params[0])
+            else:
+                value = calc_penalty(r, constants[0], params[0], params[1], cutoff)
+
+            kernel[h, k, voxel] += value
+
+    return kernel
+
+@njit(cache=True)
+def bvse_map_scatter(voxelNos:np.ndarray, vectors:np.ndarray, cutoff:float, mode:int, screeningFactor:float, bondIons:np.ndarray, coulIons:np.ndarray, resultMap:np.ndarray, mask:np.ndarray = None, sentinel:float = 0.):
+    """
+        Calculates the BVSE at every voxel by looping over the sites rather than the voxels, adding each site's energy
+        only to the voxels within its cutoff (see scatter_sites). Gives the same map as bvse_map_fused, with far fewer
+        distances found when the grid is fine or the sites sparse. Masked voxels are skipped as in bvse_map_fused.
+    """
+    return bvse_scatter_tile(voxelNos, vectors, cutoff, mode, screeningFactor, bondIons, coulIons, np.zeros(3, dtype=np.int64), voxelNos.astype(np.int64), resultMap, mask, sentinel)
+
+@njit(cache=True)
+def bvse_scatter_tile(voxelNos:np.ndarray, vectors:np.ndarray, cutoff:float, mode:int, screeningFactor:float, bondIons:np.ndarray, coulIons:np.ndarray, lower:np.ndarray, upper:np.ndarray, resultMap:np.ndarray, mask:np.ndarray = None, sentinel:float = 0.):
+    """
+        Calculates the BVSE of the voxels in one tile of the map as in bvse_map_scatter. Arguments and results match
+        bvse_tile.
+    """
+
+    positions = axis_positions(voxelNos, vectors)
+    inverseVectors = np.linalg.inv(vectors)
+    stencil = scatter_stencil(voxelNos, vectors, cutoff)
+    constants = np.array((screeningFactor,))
+
+    # The bonding and Coulombic energies are summed apart and added at the end, as in bvse_tile
+    bond = np.zeros((upper[0] - lower[0], upper[1] - lower[1], upper[2] - lower[2]))
+    coul = np.zeros(bond.shape)
+    if mode < 2:
+        scatter_sites(voxelNos, inverseVectors, positions, stencil, cutoff, 0, bondIons, constants, lower, upper, bond, mask)
+    if mode > 0:
+        scatter_sites(voxelNos, inverseVectors, positions, stencil, cutoff, 1, coulIons, constants, lower, upper, coul, mask)
+
+    for h in range(lower[0], upper[0]):
+        for k in range(lower[1], upper[1]):
+            for l in range(lower[2], upper[2]):
+                resultMap[h, k, l] = bond[h - lower[0], k - lower[1], l - lower[2]] + coul[h - lower[0], k - lower[1], l - lower[2]]
+                if mask is not None:
+                    if mask[h, k, l]:
+                        resultMap[h, k, l] = sentinel
+
+    return resultMap
+
+@njit(locals=dict(r=float64), cache=True)
+def bvse_update_map(voxelNos:np.ndarray, vectors:np.ndarray, inverseVectors:np.ndarray, cutoff:float, mode:int, screeningFactor:float, bondIons:np.ndarray, coulIons:np.ndarray, sign:float, resultMap:np.ndarray):
+    """
+        Adds (sign of 1) or subtracts (sign of -1) the BVSE contribution of a set of sites to an existing map. Only the
+        voxels inside the bounding box of each site's cutoff sphere are visited. The site arrays have the same format as
+        for bvse_map.
+    """
+
+    # The half widths of a cutoff sphere along each axis, in voxels
+    halfWidths = np.zeros(3)
+    for i in range(3):
+        halfWidths[i] = cutoff * math.sqrt(inverseVectors[0][i]**2 + inverseVectors[1][i]**2 + inverseVectors[2][i]**2) * voxelNos[i]
+
+    for siteType in range(2):
+
+        if siteType == 0:
+            ions = bondIons
+            if mode == 2 or ions.size == 0:
+                continue
+        else:
+            ions = coulIons
+            if mode == 0 or ions.size == 0:
+                continue
+
+        for i in range(ions.shape[0]):
+
+            ion = ions[i]
+            centre = np.dot(ion[:3], inverseVectors) * voxelNos
+            lower = np.zeros(3, dtype=np.int64)
+            upper = np.zeros(3, dtype=np.int64)
+
+            # Clip the bounding box to the core cell - images of the site cover the other cells
+            for j in range(3):
+                lower[j] = max(0, math.floor(centre[j] - halfWidths[j]))
+                upper[j] = min(voxelNos[j] - 1, math.ceil(centre[j] + halfWidths[j]))
+
+            for h in range(lower[0], upper[0] + 1):
+                for k in range(lower[1], upper[1] + 1):
+                    for l in range(lower[2], upper[2] + 1):
+
+                        # Voxel position, summed in the same order as voxel_bvse to give identical distances
+                        fh, fk, fl = h/voxelNos[0], k/voxelNos[1], l/voxelNos[2]
+                        dx = abs(ion[0] - (fh*vectors[0][0] + fk*vectors[1][0] + fl*vectors[2][0]))
+                        dy = abs(ion[1] - (fh*vectors[0][1] + fk*vectors[1][1] + fl*vectors[2][1]))
+                        dz = abs(ion[2] - (fh*vectors[0][2] + fk*vectors[1][2] + fl*vectors[2][2]))
+                        r = math.sqrt(dx**2 + dy**2 + dz**2)
+
+                        if r > cutoff:
+                            continue
+                        elif siteType == 0:
+                            resultMap[h][k][l] += sign * calc_Ebond(d0=ion[3], rmin=ion[4], ri=r, ib=ion[5])
+                        else:
+                            resultMap[h][k][l] += sign * calc_Ecoul(q1=ion[3], q2=ion[4], ri=r, r1=ion[5], r2=ion[6], f=screeningFactor)
+
+    return resultMap
+
+@njit(locals=dict(r=float64), cache=True)
+def voxel_bvse_multi(voxelId:np.ndarray, voxelNos:np.ndarray, vectors:np.ndarray, cutoffs:np.ndarray, mode:int, screeningFactor:float, siteCoords:np.ndarray, siteParams:np.ndarray, energies:np.ndarray):
+    """
+        Function to calculate the BVSE of several conductors at a specific point. The distance to each site is only
+        calculated once and is shared between all the conductors. Arguments: \n
+        voxelId - A 3 element numpy array indicating the voxel position in the grid. \n
+        Cutoffs - The radius cutoff for each conductor. \n
+        Mode - An integer indicating what parts of the BVSE calculation to complete. \n
+        Screening Factor - The screening factor for the Coulumbic repulsion calculation. \n
+        Site Coords - A numpy array of the coordinates of every site, in the format [[x, y, z]] \n
+        Site Params - A numpy array of the parameters of every site for each conductor, in the format
+        [[[type, d0, rmin, ib, 0]]] for bonding sites and [[[type, q1, q2, r1, r2]]] for repulsive sites \n
+        Energies - A numpy array that the energy for each conductor is written to, with the bonding energy in
+        [c][0] and the Coulombic energy in [c][1].
+    """
+
+    position = np.sum((voxelId/voxelNos).reshape(3,1) * vectors, axis=0)
+    maxCutoff = cutoffs.max()
+    energies[:] = 0.
+    r = 0.
+
+    for i in range(siteCoords.shape[0]):
+
+        r = calc_distance(position, siteCoords[i], maxCutoff*2)
+
+        if r > maxCutoff:
+            continue
+
+        for c in range(siteParams.shape[0]):
+
+            params = siteParams[c][i]
+
+            if r > cutoffs[c]:
+                continue
+            elif params[0] == BOND_SITE and mode < 2:
+                energies[c][0] += calc_Ebond(d0=params[1], rmin=params[2], ri=r, ib=params[3])
+            elif params[0] == COUL_SITE and mode > 0:
+                energies[c][1] += calc_Ecoul(q1=params[1], q2=params[2], ri=r, r1=params[3], r2=params[4], f=screeningFactor)
+
+@njit(cache=True)
+def bvse_multi_map(voxelNos:np.ndarray, vectors:np.ndarray, cutoffs:np.ndarray, mode:int, screeningFactor:float, siteCoords:np.ndarray, siteParams:np.ndarray, resultMaps:np.ndarray):
+
+    energies = np.zeros((siteParams.shape[0], 2))
+
+    # For every voxel
+    for h in range(voxelNos[0]):
+        for k in range(voxelNos[1]):
+            for l in range(voxelNos[2]):
+                voxel_bvse_multi(np.array((h, k, l)), voxelNos, vectors, cutoffs, mode, screeningFactor, siteCoords, siteParams, energies)
+                for c in range(siteParams.shape[0]):
+                    resultMaps[c][h][k][l] = energies[c][0] + energies[c][1]
+
+    return resultMaps
+
+@njit(cache=True)
+def bvse_channel_map(voxelNos:np.ndarray, vectors:np.ndarray, cutoffs:np.ndarray, screeningFactor:float, siteCoords:np.ndarray, siteParams:np.ndarray, resultMaps:np.ndarray):
+    """
+        Calculates the bonding and Coulombic energies of every conductor in one pass, keeping them as seperate channels.
+        The result maps have the shape [conductor][channel][h][k][l], where channel 0 is the bonding energy and channel 1
+        is the Coulombic energy.
+    """
+
+    energies = np.zeros((siteParams.shape[0], 2))
+
+    # For every voxel
+    for h in range(voxelNos[0]):
+        for k in range(voxelNos[1]):
+            for l in range(voxelNos[2]):
+                voxel_bvse_multi(np.array((h, k, l)), voxelNos, vectors, cutoffs, 1, screeningFactor, siteCoords, siteParams, energies)
+                for c in range(siteParams.shape[0]):
+                    resultMaps[c][0][h][k][l] = energies[c][0]
+                    resultMaps[c][1][h][k][l] = energies[c][1]
+
+    return resultMaps
+
 @njit(locals=dict(r=float64), cache=True)
 def voxel_bvsm(voxelId:np.ndarray, voxelNos:np.ndarray, vectors:np.ndarray, cutoff:float, conductorOs:int, mode:int, bvIons:np.ndarray , penIons:np.ndarray):
     """
@@ -953,6 +2575,152 @@ def voxel_bvsm(voxelId:np.ndarray, voxelNos:np.ndarray, vectors:np.ndarray, cuto
 
     return abs(bvs - abs(conductorOs)) + penaltySum
 
+@njit(cache=True)
+def bvsm_map_fused(voxelNos:np.ndarray, vectors:np.ndarray, cutoff:float, conductorOs:int, mode:int, bvIons:np.ndarray, penIons:np.ndarray, resultMap:np.ndarray, mask:np.ndarray = None, sentinel:float = 0.):
+    """
+        Calculates the BVSM at every voxel, giving the same map as bvsm_map. Positions are built up along each axis and
+        distances compared while squared, as in bvse_map_fused. The site arrays have the same format as for voxel_bvsm.
+        Masked voxels are skipped as in bvse_map_fused.
+    """
+    return bvsm_tile(voxelNos, vectors, cutoff, conductorOs, mode, bvIons, penIons, np.zeros(3, dtype=np.int64), voxelNos.astype(np.int64), resultMap, mask, sentinel)
+
+@njit(cache=True)
+def bvsm_tile(voxelNos:np.ndarray, vectors:np.ndarray, cutoff:float, conductorOs:int, mode:int, bvIons:np.ndarray, penIons:np.ndarray, lower:np.ndarray, upper:np.ndarray, resultMap:np.ndarray, mask:np.ndarray = None, sentinel:float = 0.):
+    """
+        Calculates the BVSM of the voxels in one tile of the map, from the lower voxel index up to (but not including) the
+        upper voxel index on each axis, as in bvsm_map_fused. The rest of the result map is left untouched.
+    """
+
+    positions = axis_positions(voxelNos, vectors)
+    cutoff2 = cutoff * cutoff
+    bvCount = bvIons.shape[0] if mode < 2 and bvIons.size > 0 else 0
+    penCount = penIons.shape[0] if mode > 0 and penIons.size > 0 else 0
+
+    for h in range(lower[0], upper[0]):
+        for k in range(lower[1], upper[1]):
+
+            rowX = positions[0][h][0] + positions[1][k][0]
+            rowY = positions[0][h][1] + positions[1][k][1]
+            rowZ = positions[0][h][2] + positions[1][k][2]
+
+            for l in range(lower[2], upper[2]):
+
+                if mask is not None:
+                    if mask[h, k, l]:
+                        resultMap[h, k, l] = sentinel
+                        continue
+
+                x = rowX + positions[2][l][0]
+                y = rowY + positions[2][l][1]
+                z = rowZ + positions[2][l][2]
+                bvs = 0. if mode < 2 else abs(conductorOs)
+                penaltySum = 0.
+
+                for i in range(bvCount):
+                    dx = bvIons[i, 0] - x
+                    dy = bvIons[i, 1] - y
+                    dz = bvIons[i, 2] - z
+                    r2 = dx*dx + dy*dy + dz*dz
+                    if r2 <= cutoff2:
+                        bvs += calc_bv(bvIons[i, 4], math.sqrt(r2), bvIons[i, 3])
+
+                for i in range(penCount):
+                    dx = penIons[i, 0] - x
+                    dy = penIons[i, 1] - y
+                    dz = penIons[i, 2] - z
+                    r2 = dx*dx + dy*dy + dz*dz
+                    if r2 <= cutoff2:
+                        penaltySum += calc_penalty(math.sqrt(r2), conductorOs, penIons[i, 3], penIons[i, 4], cutoff)
+
+                resultMap[h, k, l] = abs(bvs - abs(conductorOs)) + penaltySum
+
+    return resultMap
+
+@njit(cache=True)
+def bvsm_map_scatter(voxelNos:np.ndarray, vectors:np.ndarray, cutoff:float, conductorOs:int, mode:int, bvIons:np.ndarray, penIons:np.ndarray, resultMap:np.ndarray, mask:np.ndarray = None, sentinel:float = 0.):
+    """
+        Calculates the BVSM at every voxel by looping over the sites, as in bvse_map_scatter. Gives the same map as
+        bvsm_map_fused.
+    """
+    return bvsm_scatter_tile(voxelNos, vectors, cutoff, conductorOs, mode, bvIons, penIons, np.zeros(3, dtype=np.int64), voxelNos.astype(np.int64), resultMap, mask, sentinel)
+
+@njit(cache=True)
+def bvsm_scatter_tile(voxelNos:np.ndarray, vectors:np.ndarray, cutoff:float, conductorOs:int, mode:int, bvIons:np.ndarray, penIons:np.ndarray, lower:np.ndarray, upper:np.ndarray, resultMap:np.ndarray, mask:np.ndarray = None, sentinel:float = 0.):
+    """
+        Calculates the BVSM of the voxels in one tile of the map as in bvsm_map_scatter. Arguments and results match
+        bvsm_tile.
+    """
+
+    positions = axis_positions(voxelNos, vectors)
+    inverseVectors = np.linalg.inv(vectors)
+    stencil = scatter_stencil(voxelNos, vectors, cutoff)
+    constants = np.array((float(conductorOs),))
+
+    bvs = np.full((upper[0] - lower[0], upper[1] - lower[1], upper[2] - lower[2]), 0. if mode < 2 else float(abs(conductorOs)))
+    penaltySum = np.zeros(bvs.shape)
+    if mode < 2:
+        scatter_sites(voxelNos, inverseVectors, positions, stencil, cutoff, 2, bvIons, constants, lower, upper, bvs, mask)
+    if mode > 0:
+        scatter_sites(voxelNos, inverseVectors, positions, stencil, cutoff, 3, penIons, constants, lower, upper, penaltySum, mask)
+
+    for h in range(lower[0], upper[0]):
+        for k in range(lower[1], upper[1]):
+            for l in range(lower[2], upper[2]):
+                resultMap[h, k, l] = abs(bvs[h - lower[0], k - lower[1], l - lower[2]] - abs(conductorOs)) + penaltySum[h - lower[0], k - lower[1], l - lower[2]]
+                if mask is not None:
+                    if mask[h, k, l]:
+                        resultMap[h, k, l] = sentinel
+
+    return resultMap
+
+@njit(cache=True)
+def bvsm_fields(voxelNos:np.ndarray, vectors:np.ndarray, cutoff:float, conductorOs:int, bvIons:np.ndarray, penIons:np.ndarray, bvsField:np.ndarray, penaltyField:np.ndarray):
+    """
+        Calculates the raw bond valence sum and the penalty function sum at every voxel, in a single pass. The penalty
+        constants in penIons should be set to 1, so that the penalty field can be scaled to any penalty constant
+        afterwards. The array formats match voxel_bvsm, and positions are built up as in bvse_map_fused.
+    """
+
+    positions = axis_positions(voxelNos, vectors)
+    cutoff2 = cutoff * cutoff
+    bvCount = bvIons.shape[0] if bvIons.size > 0 else 0
+    penCount = penIons.shape[0] if penIons.size > 0 else 0
+
+    # For every voxel
+    for h in range(voxelNos[0]):
+        for k in range(voxelNos[1]):
+
+            rowX = positions[0][h][0] + positions[1][k][0]
+            rowY = positions[0][h][1] + positions[1][k][1]
+            rowZ = positions[0][h][2] + positions[1][k][2]
+
+            for l in range(voxelNos[2]):
+
+                x = rowX + positions[2][l][0]
+                y = rowY + positions[2][l][1]
+                z = rowZ + positions[2][l][2]
+                bvs = 0.
+                penaltySum = 0.
+
+                for i in range(bvCount):
+                    dx = bvIons[i, 0] - x
+                    dy = bvIons[i, 1] - y
+                    dz = bvIons[i, 2] - z
+                    r2 = dx*dx + dy*dy + dz*dz
+                    if r2 <= cutoff2:
+                        bvs += calc_bv(bvIons[i, 4], math.sqrt(r2), bvIons[i, 3])
+
+                for i in range(penCount):
+                    dx = penIons[i, 0] - x
+                    dy = penIons[i, 1] - y
+                    dz = penIons[i, 2] - z
+                    r2 = dx*dx + dy*dy + dz*dz
+                    if r2 <= cutoff2:
+                        penaltySum += calc_penalty(math.sqrt(r2), conductorOs, penIons[i, 3], penIons[i, 4], cutoff)
+
+                bvsField[h, k, l] = bvs
+                penaltyField[h, k, l] = penaltySum
+
 @njit(cache=True)
 def bvsm_map(voxelNos:np.ndarray, vectors:np.ndarray, cutoff:float,  conductorOs:int, mode:int, bvIons:np.ndarray, penIons:np.ndarray, resultMap:np.ndarray):
 
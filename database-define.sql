@@ -19,4 +19,8 @@ CREATE TABLE BVParam (
     ib REAL,
     cn REAL,
     r_cutoff REAL
-);
\ No newline at end of file
+);
+
+CREATE UNIQUE INDEX IF NOT EXISTS ion_symbol_os ON Ion (symbol, os);
+
+CREATE INDEX IF NOT EXISTS bvparam_ions ON BVParam (ion1, ion2);
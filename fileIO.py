@@ -2,6 +2,7 @@ import sqlite3, logging, re, collections
 import CifFile as cf
 import numpy as np
 import pymatgen.core as pmg
+from pymatgen.io.cif import CifParser
 from pathlib import Path          
 
 
@@ -71,6 +72,12 @@ class Ion:
 
 
 
+class MissingParameterError(Exception):
+    """
+        Raised when a pair of ions that should bond has no bond valence parameters in the database.
+    """
+
+
 class BVDatabase:
     """
         A class representing a connection to a bond valence parameter database. Contains all methods required to communitate with the database.
@@ -80,11 +87,24 @@ class BVDatabase:
     # Tuple for storing bond valence parameters
     bvparam = collections.namedtuple("BVParam", ['r0', 'ib', 'cn', 'r_cutoff', 'i1r', 'i2r', 'rmin', 'd0'])
 
-    def __init__(self, dbLocation:str):
-        """
-            Initialise the connection to the database using its location.
-        """
-        self.conn = sqlite3.connect(dbLocation)
+    def __init__(self, dbLocation:str, readOnly:bool = False, immutable:bool = False, inMemory:bool = False):
+        """
+            Initialise the connection to the database using its location. The connection can be read only, which also
+            stops a missing database being created. If the database is also immutable, SQLite skips all locking and change
+            detection, which is faster (especially on network filesystems) but only safe if nothing writes to the file.
+            If inMemory is set, the database is copied into memory and the file is not used again. An in-memory copy can
+            be used from any thread.
+        """
+        if inMemory:
+            source = sqlite3.connect(Path(dbLocation).resolve().as_uri() + "?mode=ro", uri=True)
+            self.conn = sqlite3.connect(":memory:", check_same_thread=False)
+            source.backup(self.conn)
+            source.close()
+        elif readOnly or immutable:
+            uri = Path(dbLocation).resolve().as_uri() + "?mode=ro" + ("&immutable=1" if immutable else "")
+            self.conn = sqlite3.connect(uri, uri=True)
+        else:
+            self.conn = sqlite3.connect(dbLocation)
         self.cursor = self.conn.cursor()
 
     def commit(self):
@@ -131,24 +151,42 @@ class BVDatabase:
         """
         return self.cursor.lastrowid
 
-    def create_database(self):
+    def create_database(self, indexes:bool = True):
         """
-            Executes a SQL script to reset the database.
+            Executes a SQL script to reset the database. The indexes can be left out, so they can be built once after a
+            bulk import with create_indexes.
         """
 
         with open(self.DATABASE_DEFINITION, "r") as script:
-            self.cursor.executescript(script.read())
+            for command in script.read().split(";"):
+                if indexes or "INDEX" not in command:
+                    self.execute(command)
+        self.commit()
+
+    def create_indexes(self):
+        """
+            Adds the indexes in the SQL script to an existing database, if they are not already present.
+        """
+
+        with open(self.DATABASE_DEFINITION, "r") as script:
+            for command in script.read().split(";"):
+                if "CREATE" in command and "INDEX" in command:
+                    self.execute(command)
+        self.commit()
         
-    def reset_database(self):
+    def reset_database(self, confirm:bool = True, indexes:bool = True) -> bool:
         """
             Method that resets the database by dropping all tables and executing a SQL script to create the database again.
+            By default the user is asked to confirm the reset first; set confirm to False to reset without asking, e.g. in
+            scripts. Returns whether the database was reset.
         """
 
         # Checks the user really wants to reset the database
-        print("Are you sure you want to reset the database? (No data can be retrieved)")
-        ans = input().lower().strip()
-        if ans != "y" and ans != 'yes':
-            return
+        if confirm:
+            print("Are you sure you want to reset the database? (No data can be retrieved)")
+            ans = input().lower().strip()
+            if ans != "y" and ans != 'yes':
+                return False
       
         # Code for dropping tables lifted from db-reset.py
         self.execute("SELECT 'drop table ' || name || ';' FROM sqlite_master WHERE type = 'table'")
@@ -162,7 +200,8 @@ class BVDatabase:
             logging.info("Succesfully Executed {c}".format(c=command))
 
         # Creates the new database
-        self.create_database()
+        self.create_database(indexes)
+        return True
 
     def get_or_insert_ion(self, ion:Ion):
         """
@@ -193,6 +232,55 @@ class BVDatabase:
 
         return self.last_row_id()
     
+    def import_bv_params(self, rows):
+        """
+            Imports bond valence parameters in bulk, in a single transaction. Rows can be any iterable (e.g. a generator
+            streaming a file) of tuples in the format (ion1, ion2, r0, b, cn, r_cutoff), where cn and r_cutoff may be None.
+            As in create_entry, only the first parameters for each ordered pair of ions are kept. Returns the number of
+            parameter sets added.
+        """
+
+        params = {}
+        for ion1, ion2, r0, b, cn, rCutoff in rows:
+            params.setdefault((ion1, ion2), (r0, b, 1/b, cn, rCutoff))
+
+        # Ions are added in the order they first appear
+        ions = list(dict.fromkeys(ion for pair in params for ion in pair))
+
+        with self.conn:
+            self.cursor.executemany("INSERT INTO Ion (symbol, os) SELECT ?, ? WHERE NOT EXISTS (SELECT 1 FROM Ion WHERE symbol = ? AND os = ?)", [(ion.element, ion.ox_state) * 2 for ion in ions])
+
+            self.execute("SELECT symbol, os, id FROM Ion")
+            ionIds = {(symbol, os): ionId for symbol, os, ionId in self.fetch_all()}
+
+            self.execute("SELECT ion1, ion2 FROM BVParam")
+            existing = set(self.fetch_all())
+
+            newRows = []
+            for (ion1, ion2), values in params.items():
+                ids = (ionIds[(ion1.element, ion1.ox_state)], ionIds[(ion2.element, ion2.ox_state)])
+                if ids not in existing:
+                    newRows.append(ids + values)
+
+            self.cursor.executemany("INSERT INTO BVParam (ion1, ion2, r0, b, ib, cn, r_cutoff) VALUES (?,?,?,?,?,?,?)", newRows)
+
+        return len(newRows)
+
+    def import_ion_info(self, rows):
+        """
+            Imports ion information in bulk, in a single transaction. Rows can be any iterable of tuples in the format
+            (ion, radii, softness, period, group, block, atomic number). Ions not yet in the database are added.
+        """
+
+        rows = [(ion.element, ion.ox_state) + tuple(values) for ion, *values in rows]
+
+        # Updating by symbol and oxidation state uses the unique index
+        self.create_indexes()
+
+        with self.conn:
+            self.cursor.executemany("INSERT INTO Ion (symbol, os) SELECT ?, ? WHERE NOT EXISTS (SELECT 1 FROM Ion WHERE symbol = ? AND os = ?)", [row[:2] * 2 for row in rows])
+            self.cursor.executemany("UPDATE Ion SET radii = ?, softness = ?, period = ?, p_group = ?, block = ?, atomic_no = ? WHERE symbol = ? AND os = ?", [row[2:] + row[:2] for row in rows])
+
     def update_bv_info(self, paramId:int, cn:float, rCutoff:float):
         """
             Updates the bond valence parameters database entry to add information on the coordination number and radius cutoff, information which is only included in the softBV parameters.
@@ -226,17 +314,6 @@ class BVDatabase:
 
         return ((b**2)/2 * 14.4 * (c*(abs(os1*os2))**(1/c)) / (rmin*np.sqrt(period1 * period2)))
     
-    def _params_error_check(self, ion1:Ion, ion2:Ion):
-        """
-            Fetches the result of get_bv_params and checks the result is well formed
-        """
-        result = self.fetch_all()
-        if result is None or len(result) == 0:
-            raise Exception(f"The combination of ions ({ion1}, {ion2}) are not on the BV Parameters Database")
-        elif len(result) != 1:
-            logging.warn(f"Multiple different database entries for the same ions ({ion1}, {ion2})")
-        return result[0]
-
     def get_bv_params(self, ion1:Ion, ion2:Ion, bvse:bool = False):
         """
             Finds the parameters for a combination of two ions and returns them.
@@ -245,41 +322,85 @@ class BVDatabase:
             
                 'r0', 'ib', 'cn', 'r_cutoff', 'i1r', 'i2r', 'rmin', 'd0'
         """
-        
-        # If the ions are bonding
-        if (ion1.ox_state * ion2.ox_state) < 0:
+        return self.get_bv_params_many([(ion1, ion2)], bvse)[(ion1, ion2)]
 
-            # Retrieve all the information from the database
-            #                    0   1  2   3   4         5         6         7            8            9          10         11        12
-            self.execute("SELECT r0, b, ib, cn, r_cutoff, i1.radii, i2.radii, i1.softness, i2.softness, i1.period, i2.period, i1.block, i2.block FROM BVParam JOIN Ion i1 JOIN Ion i2 On BVParam.ion1 = i1.id AND BVParam.ion2 = i2.id WHERE (i1.symbol = ? AND i1.os = ? AND i2.symbol = ? AND i2.os = ?) OR (i2.symbol = ? AND i2.os = ? AND i1.symbol = ? AND i1.os = ?)", (ion1.element, ion1.ox_state, ion2.element, ion2.ox_state, ion1.element, ion1.ox_state, ion2.element, ion2.ox_state,))
-            
-            result = self._params_error_check(ion1, ion2)
+    def get_bv_params_many(self, pairs:list, bvse:bool = False) -> dict:
+        """
+            Finds the parameters for a list of pairs of ions in a single query. Returns a dictionary of bvparam named
+            tuples (or None, for repelling ions when BVSE is not being done), keyed by the pairs as given.
+        """
 
-            # If BVSE is not being done, the returned parameters are simpler
-            if bvse:
+        pairs = list(dict.fromkeys(pairs))
+        bonding = [(ion1, ion2) for ion1, ion2 in pairs if (ion1.ox_state * ion2.ox_state) < 0]
+        params = {}
 
-                if ion1.ox_state > 0: 
-                    cationOs = ion1.ox_state
-                else: 
-                    cationOs = ion2.ox_state
-                    
-                rmin = self.rmin(result[7], result[8], result[0], result[1], cationOs, result[3])
-                d0 = self.d0(result[1], ion1.ox_state, ion2.ox_state, result[11], rmin, result[9], result[10])
+        if len(bonding) > 0:
 
-                return self.bvparam(r0 = result[0], ib = result[2], cn = result[3], r_cutoff = result[4], i1r = result[5], i2r = result[6], rmin = rmin, d0 = d0)
-            
+            # The requested pairs are joined to the ions in both orders, using the indexes on Ion and BVParam
+            values = ", ".join(["(?,?,?,?,?)"] * len(bonding))
+            arguments = [value for i, (ion1, ion2) in enumerate(bonding) for value in (i, ion1.element, ion1.ox_state, ion2.element, ion2.ox_state)]
+
+            #                                 0         1        2        3                4        5                 6          7           8        9        10        11      12     13    14  15
+            self.execute(f"""WITH Request (idx, s1, o1, s2, o2) AS (VALUES {values})
+                SELECT Request.idx, BVParam.ion1 = a.id, a.radii, a.softness, a.period, a.block, b.radii, b.softness, b.period, b.block, BVParam.r0, BVParam.b, BVParam.ib, BVParam.cn, BVParam.r_cutoff, BVParam.id
+                FROM Request
+                LEFT JOIN Ion a ON a.symbol = Request.s1 AND a.os = Request.o1
+                LEFT JOIN Ion b ON b.symbol = Request.s2 AND b.os = Request.o2
+                LEFT JOIN BVParam ON (BVParam.ion1 = a.id AND BVParam.ion2 = b.id) OR (BVParam.ion1 = b.id AND BVParam.ion2 = a.id)""", arguments)
+
+            rows = {}
+            for row in self.fetch_all():
+                rows.setdefault(row[0], []).append(row)
+
+            params = {(ion1, ion2): self._bv_params_from_rows(ion1, ion2, rows.get(i, []), bvse) for i, (ion1, ion2) in enumerate(bonding)}
+
+        # Repelling ions only need their radii, which every database has (unlike the softBV columns used above)
+        for ion1, ion2 in pairs:
+            if (ion1, ion2) in params:
+                continue
+            elif bvse:
+                params[(ion1, ion2)] = self.bvparam(r0=None, ib=None, cn=None, r_cutoff=None, i1r=self.get_radius(ion1), i2r=self.get_radius(ion2), rmin=None, d0=None)
             else:
+                params[(ion1, ion2)] = None
+
+        return {pair: params[pair] for pair in pairs}
+
+    def _bv_params_from_rows(self, ion1:Ion, ion2:Ion, rows:list, bvse:bool):
+        """
+            Creates the bvparam named tuple for a pair of bonding ions from the rows found by get_bv_params_many.
+        """
+
+        rows = [row for row in rows if row[15] is not None]
+        if len(rows) == 0:
+            raise MissingParameterError(f"The combination of ions ({ion1}, {ion2}) are not on the BV Parameters Database")
+        elif len(rows) != 1:
+            logging.warning(f"Multiple different database entries for the same ions ({ion1}, {ion2})")
 
-                return self.bvparam(r0 = result[0], ib = result[2], cn = result[3], r_cutoff = result[4], i1r = None, i2r = None, rmin = None, d0 = None)
+        row = rows[0]
+        r0, b, ib, cn, rCutoff = row[10:15]
 
-        # If BVSE and ions are repelling   
-        elif bvse:
+        # Ion information in the order the ions are stored in the parameter table
+        if row[1]:
+            i1, i2 = row[2:6], row[6:10]
+        else:
+            i1, i2 = row[6:10], row[2:6]
+
+        # If BVSE is not being done, the returned parameters are simpler
+        if bvse:
+
+            if ion1.ox_state > 0: 
+                cationOs = ion1.ox_state
+            else: 
+                cationOs = ion2.ox_state
+                
+            rmin = self.rmin(i1[1], i2[1], r0, b, cationOs, cn)
+            d0 = self.d0(b, ion1.ox_state, ion2.ox_state, i1[3], rmin, i1[2], i2[2])
 
-            return self.bvparam(r0=None, ib=None, cn=None, r_cutoff=None, i1r=self.get_radius(ion1), i2r=self.get_radius(ion2), rmin=None, d0=None)
+            return self.bvparam(r0 = r0, ib = ib, cn = cn, r_cutoff = rCutoff, i1r = i1[0], i2r = i2[0], rmin = rmin, d0 = d0)
         
         else:
 
-            return None
+            return self.bvparam(r0 = r0, ib = ib, cn = cn, r_cutoff = rCutoff, i1r = None, i2r = None, rmin = None, d0 = None)
 
         
     def get_atomic_no(self, element:str):
@@ -311,58 +432,66 @@ def readCif(fileLocation:str|Path) -> cf.ReadCif:
     """
     return cf.ReadCif(str(fileLocation)).first_block()
 
-def fileToDb(fileIn:str, fileOut:str):
+def fileToDb(fileIn:str, fileOut:str, confirm:bool = False):
     """
         Converts any recognised file into a bond valence parameter database
     """
     if fileIn[-4:] == ".dat":
-        bvDatToDb(fileIn, fileOut)
+        bvDatToDb(fileIn, fileOut, confirm)
     elif fileIn[-4:] == ".cif":
-        cifToDb(fileIn, fileOut) 
+        cifToDb(fileIn, fileOut, confirm) 
     else:
         print("Data format unrecognised - Can only read .cif and .dat files")
 
-def cifToDb(fileIn:str, fileOut:str):
+def _read_dat_rows(fileIn:str):
     """
-        Convert the bond valence cif file provied on the ICuR website into a local database format for easy access.
+        Streams the rows of a softBV dat file, between its DATA_START and DATA_END lines, as lists of strings.
+    """
+
+    with open(fileIn, "r") as data:
+
+        started = False
+
+        for entry in data:
+
+            if started and entry.strip() == "DATA_END":
+                break
+            elif started:
+                row = entry.split()
+                if len(row) > 0:
+                    yield row
+            elif entry.strip() == "DATA_START":
+                started = True
+
+def cifToDb(fileIn:str, fileOut:str, confirm:bool = False):
+    """
+        Convert the bond valence cif file provied on the ICuR website into a local database format for easy access. The
+        database is reset first, asking for confirmation only if confirm is set.
     """
     
     cif = readCif(fileIn)
     bvTable = cif.GetLoop("_valence_param_atom_1")
     db = BVDatabase(fileOut)
-    db.reset_database()
 
-    for row in bvTable:
-        db.create_entry(row[0], int(row[1]), row[2], int(row[3]), float(row[4]), float(row[5]))
+    if db.reset_database(confirm, indexes=False):
+        added = db.import_bv_params((Ion(row[0], int(row[1])), Ion(row[2], int(row[3])), float(row[4]), float(row[5]), None, None) for row in bvTable)
+        db.create_indexes()
+        logging.info(f"Imported {added} bond valence parameter sets from {fileIn}")
 
     db.close()
 
-def bvDatToDb(fileIn:str, fileOut:str):
+def bvDatToDb(fileIn:str, fileOut:str, confirm:bool = False):
     """
-        Convert the bond valence dat file from softBV into a local database format
+        Convert the bond valence dat file from softBV into a local database format. The database is reset first, asking
+        for confirmation only if confirm is set.
     """
 
     db = BVDatabase(fileOut)
-    db.reset_database()
-
-    with open(fileIn, "r") as data:
 
-        started = False
-
-        while True:
-
-            entry = data.readline()
-            
-            if started and entry == "DATA_END\n":
-                break
-            elif started:
-                row =  entry.split()
-                paramId = db.create_entry(row[0], int(row[1]), row[2], int(row[3]), float(row[4]), float(row[5]))
-                db.update_bv_info(paramId, float(row[6]), float(row[7]))
-            elif entry == "DATA_START\n":
-                started = True
-            else:
-                continue
+    if db.reset_database(confirm, indexes=False):
+        added = db.import_bv_params((Ion(row[0], int(row[1])), Ion(row[2], int(row[3])), float(row[4]), float(row[5]), float(row[6]), float(row[7])) for row in _read_dat_rows(fileIn))
+        db.create_indexes()
+        logging.info(f"Imported {added} bond valence parameter sets from {fileIn}")
 
     db.close()
 
@@ -372,43 +501,77 @@ def ionDatToDb(fileIn:str, fileOut:str):
     """
 
     db = BVDatabase(fileOut)
-    
-    with open(fileIn, "r") as data:
-        
+    db.import_ion_info((Ion(row[1], int(row[2])), float(row[8]), float(row[9]), int(row[5]), int(row[6]), int(row[7]), int(row[0])) for row in _read_dat_rows(fileIn))
+    db.close()
 
-        started = False
-        while True:
-            
-            entry = data.readline()
 
-            if started and entry == "DATA_END\n":
-                break
-            elif started:
-                row = entry.split()
-                ionId = db.get_or_insert_ion(Ion(row[1], int(row[2])))
-                db.update_ion_info(ionId, float(row[8]), float(row[9]), int(row[5]), int(row[6]), int(row[7]), int(row[0]))
-            elif entry == "DATA_START\n":
-                started = True
-            else:
-                continue
+def read_structure(fileIn:Path) -> tuple:
+    """
+        Reads a cif file once with pymatgen, returning the structure and the structural formula given in the cif. If the
+        cif has no structural formula, the reduced formula of the structure is used.
+    """
 
-    db.close()
+    parser = CifParser(fileIn)
+    struct = parser.parse_structures(primitive=False)[0]
+    block = next(iter(parser.as_dict().values()))
+    formula = block.get("_chemical_formula_structural", struct.composition.reduced_formula)
 
+    return struct, formula.replace(" ", "")
 
-def create_input_from_cif(fileIn:Path, fileOut:Path, conductor:str):
+def structure_site_rows(struct:pmg.Structure) -> tuple:
     """
-        Converts a crystal structure stored in a cif into a input file for further processing. Requires the input cif,
-        the output file location and the conductor.
+        Creates a list of sites from a pymatgen structure. Each row has the format
+        [label, p1 label, element, oxidation state, lone pair, cartesian coordinates, occupancy]. Sites shared by several
+        species give one row per species, with the element appended to the p1 label. Also returns whether any oxidation
+        states had to be assumed and whether there are partially occupied sites.
     """
 
-    # Create a pymatgen object
-    struct = pmg.Structure.from_file(fileIn)
-    conductor = Ion.from_string(conductor)
+    rows = []
+    siteDict = {}
+    osWarning = False
+    partialWarning = False
 
-    if fileIn.suffix != ".cif":
-        logging.error(f"Incorrect file format. The input file should be a cif file and not a {fileIn.suffix} file")
-    elif fileOut.suffix != ".inp":
-        logging.error(f"Incorrect file format. The output file should be a inp file and not a {fileIn.suffix} file")
+    # Create an entry in the dictionary to keep track of site multiplicity
+    for site in struct.sites:
+        siteDict[site.label] = 0
+
+    # For every site, find label, element, os and cartesian coords
+    for site in struct.sites:
+
+        # The normal label and a new label for P1 symmetry
+        p1Label = f"{site.label}.{siteDict[site.label]}"
+        siteDict[site.label] += 1
+
+        if not isinstance(site.species, pmg.Composition):
+            raise Exception("Unexpected Site Contents")
+
+        if not site.is_ordered:
+            partialWarning = True
+
+        for species, occ in site.species.items():
+
+            # If only element for site defined, assume maximum oxidation state and throw warning.
+            if isinstance(species, pmg.Element):
+                element, os = species.name, species.max_oxidation_state
+                osWarning = True
+
+            # If species is defined for site, work normally
+            elif isinstance(species, pmg.Species):
+                element, os = species.element.name, species.oxi_state
+
+            # Otherwise something very unexpected has happened    
+            else:
+                raise Exception("Unexpected Site Contents")
+
+            speciesLabel = f"{p1Label}_{element}" if len(site.species) > 1 else p1Label
+            rows.append([site.label, speciesLabel, element, os, element in Ion.LONE_PAIR_ELEMENTS, np.array(site.coords), occ])
+
+    return rows, osWarning, partialWarning
+
+def write_input_file(fileOut:Path, struct:pmg.Structure, conductor:Ion, siteRows:list):
+    """
+        Writes an input file for a structure, using the site rows made by structure_site_rows.
+    """
 
     # Open output file
     with open(fileOut, "w") as f:
@@ -422,59 +585,37 @@ def create_input_from_cif(fileIn:Path, fileOut:Path, conductor:str):
                 f.write(f"{struct.lattice.matrix[i][j]}\t")
             f.write("\n")
 
-        f.write("sym_label\tp1_label\telement\tos\tlp\ta\tb\tc\n")
-        siteDict = {}
-        osWarning = False
-        disorderWarning = False
-
-        # Create an entry in the dictionary to keep track of site multiplicity
-        for site in struct.sites:
-            siteDict[site.label] = 0
+        f.write("sym_label\tp1_label\telement\tos\tlp\ta\tb\tc\tocc\n")
 
-        # For every site, add label, element, os and cartesian coords
-        for site in struct.sites:
+        # For every site, add label, element, os, cartesian coords and occupancy
+        for label, p1Label, element, os, lp, coords, occ in siteRows:
+            f.write(f"{label}\t{p1Label}\t{element}\t{os}\t{int(lp)}\t{coords[0]}\t{coords[1]}\t{coords[2]}\t{occ}\n")
 
-            # Write the normal label and then a new label for P1 symmetry
-            f.write(f"{site.label}\t{site.label}.{siteDict[site.label]}\t")
-            siteDict[site.label] += 1
+def create_input_from_cif(fileIn:Path, fileOut:Path, conductor:str, struct:pmg.Structure = None):
+    """
+        Converts a crystal structure stored in a cif into a input file for further processing. Requires the input cif,
+        the output file location and the conductor. If the cif has already been read, the pymatgen structure can be
+        given to avoid reading it again.
+    """
 
-            if isinstance(site.species, pmg.Composition):
-                
-                elements = site.species.elements
+    # Create a pymatgen object
+    if struct is None:
+        struct = pmg.Structure.from_file(fileIn)
+    conductor = Ion.from_string(conductor)
 
-                # If there are multiple elements on the site, throw warning.
-                if len(elements) != 1:
-                    f.write("##DISORDERED SITE - AMEND MANUALLY##\t")
-                    disorderWarning = True
-                
-                # If only element for site defined, assume maximum oxidation state and throw warning.
-                elif isinstance(elements[0], pmg.Element):
-                    f.write(f"{elements[0].name}\t{elements[0].max_oxidation_state}\t{int(elements[0].name in Ion.LONE_PAIR_ELEMENTS)}\t")
-                    osWarning = True
-
-                # If species is defined for site, work normally
-                elif isinstance(elements[0], pmg.Species):
-                    f.write(f"{elements[0].element}\t{elements[0].oxi_state}\t{int(elements[0].element.name in Ion.LONE_PAIR_ELEMENTS)}\t")
-
-                # Otherwise something very unexpected has happened    
-                else:
-                    raise Exception("Unexpected Site Contents")
-            
-            # If the site is only defined as a species, deal with that
-            elif isinstance(site.species, pmg.Species):
-                f.write(f"{site.species.symbol}\t{site.species.oxidation_state}\t{int(site.species.symbol in Ion.LONE_PAIR_ELEMENTS)}\t")
+    if fileIn.suffix != ".cif":
+        logging.error(f"Incorrect file format. The input file should be a cif file and not a {fileIn.suffix} file")
+    elif fileOut.suffix != ".inp":
+        logging.error(f"Incorrect file format. The output file should be a inp file and not a {fileIn.suffix} file")
 
-            else:
-                f.write("##DISORDERED SITE - AMEND MANUALLY##\t")
-                disorderWarning = True
-            
-            f.write(f"{site.coords[0]}\t{site.coords[1]}\t{site.coords[2]}\n")
+    siteRows, osWarning, partialWarning = structure_site_rows(struct)
+    write_input_file(fileOut, struct, conductor, siteRows)
 
-        if osWarning:
-            logging.warning("Oxidation States have been set to maximum (due to limitations with pymatgen). Amend input file with correct os")
+    if osWarning:
+        logging.warning("Oxidation States have been set to maximum (due to limitations with pymatgen). Amend input file with correct os")
 
-        if disorderWarning:
-            logging.warning(f"Strucutre has disordered sites - modification of ouput ({fileOut}) file is neeeded")
+    if partialWarning:
+        logging.info(f"Structure has partially occupied sites - one row per species has been written to {fileOut}, with its occupancy")
 
 
 
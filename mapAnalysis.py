@@ -0,0 +1,448 @@
+import logging
+import numpy as np
+import pandas as pd
+import pymatgen.core as pmg
+from pathlib import Path
+from bvStructure import BVStructure
+from numba import njit
+
+class VoxelMap:
+    """
+        A map of values on a periodic grid of voxels covering one unit cell, as made by BVStructure. The voxel with index
+        (h, k, l) sits at the fractional coordinates (h/nx, k/ny, l/nz). Maps can be read back from the .cube and .grd
+        files that BVStructure exports, so candidate conductor sites can be found from finished maps.
+    """
+
+    def __init__(self, values:np.ndarray, vectors:np.ndarray, structure:pmg.Structure = None, name:str = None):
+        """
+            Initialises a map from an array of values and the lattice vectors of the cell in angstroms (one per row).
+            The structure the map was made from is optional, and is only needed for symmetry analysis.
+        """
+        self.values = np.asarray(values, dtype=float)
+        self.vectors = np.asarray(vectors, dtype=float)
+        self.voxelNumbers = np.array(self.values.shape)
+        self.structure = structure
+        self.name = name
+
+    @classmethod
+    def from_structure(cls, crystal:BVStructure, valueMap:np.ndarray = None):
+        """
+            Creates a map from a structure's populated map, or another map of the same grid such as a conductor's map.
+        """
+        if valueMap is None:
+            valueMap = crystal.map
+
+        # Lone pair dummy sites are not part of the structure
+        structure = pmg.Structure(pmg.Lattice(crystal.vectors), [site.ion.element for site in crystal.sites.itertuples()], np.stack(crystal.sites["coords"].to_numpy()), coords_are_cartesian=True)
+        return cls(valueMap, crystal.vectors, structure, crystal.name)
+
+    @classmethod
+    def from_file(cls, path:str|Path):
+        """
+            Reads a map from a .cube or .grd file. The structure is only read from cube files, as grd files have no atoms.
+        """
+
+        path = Path(path)
+
+        if path.suffix == ".cube":
+            return cls._from_cube(path)
+        elif path.suffix == ".grd":
+            return cls._from_grd(path)
+        else:
+            raise Exception(f"Unsupported map file type {path.suffix} (.grd or .cube supported)")
+
+    @classmethod
+    def _from_cube(cls, path:Path):
+
+        with open(path, "r") as f:
+
+            # Two comment lines, then the number of atoms and the origin
+            f.readline()
+            f.readline()
+            atomCount = abs(int(f.readline().split()[0]))
+
+            # The number of voxels and the vector between voxels on each axis. Positive voxel numbers are in bohr.
+            voxelNumbers = np.zeros(3, dtype=int)
+            vectors = np.zeros((3,3))
+            for i in range(3):
+                cols = f.readline().split()
+                voxelNumbers[i] = int(cols[0])
+                vectors[i] = np.array(cols[1:4], dtype=float) * abs(voxelNumbers[i])
+                if voxelNumbers[i] > 0:
+                    vectors[i] *= BVStructure.BOHR_IN_ANGSTROM
+            unit = BVStructure.BOHR_IN_ANGSTROM if voxelNumbers[0] > 0 else 1.
+            voxelNumbers = np.abs(voxelNumbers)
+
+            species = []
+            coords = []
+            for i in range(atomCount):
+                cols = f.readline().split()
+                species.append(pmg.Element.from_Z(int(cols[0])))
+                coords.append(np.array(cols[2:5], dtype=float) * unit)
+
+            values = np.fromfile(f, sep=" ")
+
+        if values.size != np.prod(voxelNumbers):
+            raise Exception(f"The cube file {path} has {values.size} values, but a {voxelNumbers} grid was expected")
+
+        structure = pmg.Structure(pmg.Lattice(vectors), species, coords, coords_are_cartesian=True) if atomCount > 0 else None
+        return cls(values.reshape(voxelNumbers), vectors, structure, path.stem)
+
+    @classmethod
+    def _from_grd(cls, path:Path):
+
+        with open(path, "r") as f:
+
+            # A comment line, then the lattice parameters and the number of voxels
+            f.readline()
+            params = [float(x) for x in f.readline().split()]
+            voxelNumbers = np.array(f.readline().split(), dtype=int)
+            values = np.fromfile(f, sep=" ")
+
+        if values.size != np.prod(voxelNumbers):
+            raise Exception(f"The grd file {path} has {values.size} values, but a {voxelNumbers} grid was expected")
+
+        return cls(values.reshape(voxelNumbers), pmg.Lattice.from_parameters(*params).matrix, None, path.stem)
+
+    def frac_coords(self, indices:np.ndarray) -> np.ndarray:
+        """
+            Returns the fractional coordinates of voxels, from an array of voxel indices with one row per voxel.
+        """
+        return np.asarray(indices) / self.voxelNumbers
+
+    def cart_coords(self, fracCoords:np.ndarray) -> np.ndarray:
+        """
+            Returns the cartesian coordinates in angstroms of an array of fractional coordinates.
+        """
+        return np.asarray(fracCoords) @ self.vectors
+
+    def periodic_distances(self, fracCoords:np.ndarray, point:np.ndarray) -> np.ndarray:
+        """
+            Returns the distance in angstroms from a point to each of an array of points, using the nearest periodic image
+            of each point. Both are given in fractional coordinates.
+        """
+        delta = np.asarray(fracCoords) - point
+        delta -= np.round(delta)
+        return np.linalg.norm(delta @ self.vectors, axis=-1)
+
+    def local_minima(self, window:float = None) -> tuple[np.ndarray, np.ndarray]:
+        """
+            Finds every voxel whose value is no larger than any of its 26 neighbours, wrapping around the cell edges. The
+            neighbourhood minimum is found with a rolling minimum along each axis in turn, so the whole map is compared
+            in six array operations. Voxels at or above BVStructure.CORE_SENTINEL are masked cores, not minima, so they
+            are left out. If a window is given, only minima within that value of the lowest voxel are kept. \n
+
+            Returns an array of voxel indices (one row per minimum) and the array of their values, sorted by value.
+        """
+
+        neighbourhood = self.values
+        for axis in range(3):
+            neighbourhood = np.minimum(neighbourhood, np.minimum(np.roll(neighbourhood, 1, axis), np.roll(neighbourhood, -1, axis)))
+
+        mask = (self.values <= neighbourhood) & (self.values < BVStructure.CORE_SENTINEL)
+        if window is not None:
+            mask &= self.values <= self.values.min() + window
+
+        indices = np.argwhere(mask)
+        values = self.values[mask]
+        order = np.argsort(values, kind="stable")
+
+        return indices[order], values[order]
+
+    def cluster_minima(self, indices:np.ndarray, values:np.ndarray, tolerance:float = 0.5) -> pd.DataFrame:
+        """
+            Merges minima that lie within the tolerance (in angstroms) of a lower minimum, including across the cell
+            edges, so each candidate site is reported once at its lowest voxel. The minima should be sorted by value, as
+            given by local_minima. \n
+
+            Returns a dataframe with one row per site, giving its value, fractional and cartesian coordinates and the
+            number of minima merged into it.
+        """
+
+        fracCoords = self.frac_coords(indices)
+        remaining = np.arange(len(values))
+        sites = []
+        counts = []
+
+        while remaining.size > 0:
+            site = remaining[0]
+            close = self.periodic_distances(fracCoords[remaining], fracCoords[site]) <= tolerance
+            sites.append(site)
+            counts.append(int(close.sum()))
+            remaining = remaining[~close]
+
+        sites = np.array(sites, dtype=int)
+        siteFrac = fracCoords[sites]
+        siteCart = self.cart_coords(siteFrac)
+
+        table = pd.DataFrame({
+            "energy": values[sites],
+            "relative_energy": values[sites] - values[0],
+            "a": siteFrac[:,0], "b": siteFrac[:,1], "c": siteFrac[:,2],
+            "x": siteCart[:,0], "y": siteCart[:,1], "z": siteCart[:,2],
+            "voxels": counts
+        })
+        table.index = [f"M{i}" for i in range(len(table))]
+        table.index.name = "site"
+
+        return table
+
+    def symmetry_groups(self, table:pd.DataFrame, tolerance:float = 0.5, symprec:float = 0.1) -> np.ndarray:
+        """
+            Labels the sites in a table made by cluster_minima by symmetry, using the space group of the map's structure.
+            Sites that are mapped onto each other (within the tolerance in angstroms) by a symmetry operation share a
+            group. Returns the group number of each site, with groups numbered in order of their lowest site.
+        """
+
+        from pymatgen.symmetry.analyzer import SpacegroupAnalyzer
+
+        if self.structure is None:
+            raise Exception("The map has no structure, so its symmetry can not be found")
+
+        operations = SpacegroupAnalyzer(self.structure, symprec=symprec).get_symmetry_operations()
+        rotations = np.array([op.rotation_matrix for op in operations])
+        translations = np.array([op.translation_vector for op in operations])
+
+        fracCoords = table[["a", "b", "c"]].to_numpy()
+        groups = np.full(len(table), -1, dtype=int)
+        group = 0
+
+        for i in range(len(table)):
+            if groups[i] >= 0:
+                continue
+
+            # Every image of the site under the space group, compared with every unassigned site
+            images = rotations @ fracCoords[i] + translations
+            unassigned = np.flatnonzero(groups < 0)
+            distances = np.stack([self.periodic_distances(fracCoords[unassigned], image) for image in images])
+            groups[unassigned[(distances <= tolerance).any(axis=0)]] = group
+            groups[i] = group
+            group += 1
+
+        return groups
+
+    def find_sites(self, tolerance:float = 0.5, window:float = None, symmetry:bool = False, symprec:float = 0.1) -> pd.DataFrame:
+        """
+            Finds the candidate conductor sites of the map - its local minima, merged when they are within the tolerance
+            of each other. If symmetry is set, sites that are equivalent under the structure's space group are given the
+            same group number; otherwise every site has its own group.
+        """
+
+        indices, values = self.local_minima(window)
+        table = self.cluster_minima(indices, values, tolerance)
+        logging.info(f"Found {len(values)} local minima, merged into {len(table)} sites")
+
+        if symmetry:
+            table.insert(0, "group", self.symmetry_groups(table, tolerance, symprec))
+            logging.info(f"The sites fall into {table['group'].nunique()} symmetry-equivalent groups")
+        else:
+            table.insert(0, "group", np.arange(len(table)))
+
+        return table
+
+    def nearest_voxel(self, fracCoords:np.ndarray) -> np.ndarray:
+        """
+            Returns the index of the voxel nearest to a point in fractional coordinates, wrapped into the cell.
+        """
+        return np.round(np.asarray(fracCoords) * self.voxelNumbers).astype(int) % self.voxelNumbers
+
+    def minimum_path(self, start:np.ndarray, end:np.ndarray = None, axis:int = None) -> pd.DataFrame:
+        """
+            Finds the path between two points (in fractional coordinates) whose highest value is as low as possible, moving
+            between neighbouring voxels across the faces of the voxels, through any periodic image of the cell. Ties between
+            paths with the same barrier are broken in favour of shorter routes. The end point reached is whichever periodic
+            image of it has the lowest barrier. \n
+
+            If an axis (0, 1 or 2) is given instead of an end point, the path runs from the start point to its own image
+            one cell along that axis, so the barrier to migration through the structure along the axis is found. The map
+            is then tiled twice along the axis for the search. \n
+
+            Returns a dataframe with one row per voxel on the path, giving the distance along the path, its value and its
+            fractional and cartesian coordinates. Fractional coordinates run on into the neighbouring cells where the path
+            leaves the cell.
+        """
+
+        if (end is None) == (axis is None):
+            raise Exception("Either an end point or an axis should be given for a path, but not both")
+
+        tiles = np.ones(3, dtype=np.int64)
+        startVoxel = self.nearest_voxel(start)
+
+        if axis is None:
+            endVoxel = self.nearest_voxel(end)
+        else:
+            tiles[axis] = 2
+            endVoxel = startVoxel.copy()
+            endVoxel[axis] += self.voxelNumbers[axis]
+
+        # Voxels are numbered in the tiled grid by a single integer, which fits in 32 bits for all but the largest maps
+        gridShape = self.voxelNumbers * tiles
+        indexType = np.int32 if np.prod(gridShape) < 2**31 else np.int64
+        stepLengths = np.linalg.norm(self.vectors, axis=1) / self.voxelNumbers
+
+        path = minimax_path(self.values, tiles, np.ravel_multi_index(startVoxel, gridShape), np.ravel_multi_index(endVoxel, gridShape), stepLengths, np.full(np.prod(gridShape), -1, dtype=indexType))
+        indices = np.stack(np.unravel_index(path, gridShape), axis=1)
+
+        # Steps across a periodic boundary are unwrapped, so the coordinates follow the path continuously
+        steps = np.diff(indices, axis=0)
+        steps -= np.round(steps / gridShape).astype(int) * gridShape
+        indices = indices[0] + np.concatenate((np.zeros((1,3), dtype=int), np.cumsum(steps, axis=0)))
+
+        fracCoords = self.frac_coords(indices)
+        cartCoords = self.cart_coords(fracCoords)
+        values = self.values[tuple((indices % self.voxelNumbers).T)]
+        distances = np.concatenate(([0.], np.cumsum(np.linalg.norm(np.diff(cartCoords, axis=0), axis=1))))
+
+        table = pd.DataFrame({
+            "distance": distances, "energy": values,
+            "a": fracCoords[:,0], "b": fracCoords[:,1], "c": fracCoords[:,2],
+            "x": cartCoords[:,0], "y": cartCoords[:,1], "z": cartCoords[:,2]
+        })
+        table.index.name = "step"
+
+        logging.info(f"Found a path of {distances[-1]:.3f} A through {len(table)} voxels")
+        return table
+
+
+# ----- JITED FUNCTIONS -----
+
+@njit(cache=True)
+def _heap_push(heapKeys:np.ndarray, heapLengths:np.ndarray, heapItems:np.ndarray, size:int, key:float, length:float, item:int):
+    """
+        Pushes an item onto a binary heap ordered by key, then length. The heap arrays are doubled in size when full, so
+        the (possibly new) arrays are returned along with the new size.
+    """
+
+    if size == heapKeys.size:
+        heapKeys = np.concatenate((heapKeys, np.empty_like(heapKeys)))
+        heapLengths = np.concatenate((heapLengths, np.empty_like(heapLengths)))
+        heapItems = np.concatenate((heapItems, np.empty_like(heapItems)))
+
+    i = size
+    while i > 0:
+        parent = (i - 1) // 2
+        if key < heapKeys[parent] or (key == heapKeys[parent] and length < heapLengths[parent]):
+            heapKeys[i] = heapKeys[parent]
+            heapLengths[i] = heapLengths[parent]
+            heapItems[i] = heapItems[parent]
+            i = parent
+        else:
+            break
+
+    heapKeys[i] = key
+    heapLengths[i] = length
+    heapItems[i] = item
+
+    return heapKeys, heapLengths, heapItems, size + 1
+
+@njit(cache=True)
+def _heap_pop(heapKeys:np.ndarray, heapLengths:np.ndarray, heapItems:np.ndarray, size:int):
+    """
+        Removes the first item from a binary heap. Returns its key, length and item, and the new size of the heap.
+    """
+
+    key, length, item = heapKeys[0], heapLengths[0], heapItems[0]
+    size -= 1
+    lastKey, lastLength, lastItem = heapKeys[size], heapLengths[size], heapItems[size]
+
+    i = 0
+    while True:
+        child = 2 * i + 1
+        if child >= size:
+            break
+        if child + 1 < size and (heapKeys[child + 1] < heapKeys[child] or (heapKeys[child + 1] == heapKeys[child] and heapLengths[child + 1] < heapLengths[child])):
+            child += 1
+        if heapKeys[child] < lastKey or (heapKeys[child] == lastKey and heapLengths[child] < lastLength):
+            heapKeys[i] = heapKeys[child]
+            heapLengths[i] = heapLengths[child]
+            heapItems[i] = heapItems[child]
+            i = child
+        else:
+            break
+
+    heapKeys[i] = lastKey
+    heapLengths[i] = lastLength
+    heapItems[i] = lastItem
+
+    return key, length, item, size
+
+@njit(cache=True)
+def minimax_path(values:np.ndarray, tiles:np.ndarray, start:int, end:int, stepLengths:np.ndarray, parents:np.ndarray) -> np.ndarray:
+    """
+        Finds the path between two voxels whose highest value is lowest, by Dijkstra's algorithm with the highest value
+        so far as the cost, and the path length breaking ties. Voxels are numbered by a single integer in a periodic grid
+        made of the map tiled the given number of times along each axis. Arguments: \n
+        Values - The map. \n
+        Tiles - The number of copies of the map along each axis. \n
+        Start, End - The numbers of the first and last voxels. \n
+        Step Lengths - The distance between neighbouring voxels along each axis. \n
+        Parents - An array filled with -1, with one element per voxel of the tiled grid. Its type sets the type used for
+        voxel numbers. \n
+
+        Returns the numbers of the voxels along the path, from start to end.
+    """
+
+    nx, ny, nz = values.shape
+    sx, sy, sz = nx * tiles[0], ny * tiles[1], nz * tiles[2]
+
+    barriers = np.full(parents.size, np.inf)
+    lengths = np.full(parents.size, np.inf)
+
+    capacity = 1024
+    heapKeys = np.empty(capacity)
+    heapLengths = np.empty(capacity)
+    heapItems = np.empty(capacity, dtype=parents.dtype)
+
+    h, k, l = start // (sy * sz), (start // sz) % sy, start % sz
+    barriers[start] = values[h % nx, k % ny, l % nz]
+    lengths[start] = 0.
+    heapKeys, heapLengths, heapItems, size = _heap_push(heapKeys, heapLengths, heapItems, 0, barriers[start], 0., start)
+
+    while size > 0:
+
+        barrier, length, voxel, size = _heap_pop(heapKeys, heapLengths, heapItems, size)
+
+        # Skip entries left in the heap after a better route to the voxel was found
+        if barrier > barriers[voxel] or (barrier == barriers[voxel] and length > lengths[voxel]):
+            continue
+
+        if voxel == end:
+            break
+
+        h, k, l = voxel // (sy * sz), (voxel // sz) % sy, voxel % sz
+
+        for axis in range(3):
+            for step in (-1, 1):
+
+                nh, nk, nl = h, k, l
+                if axis == 0:
+                    nh = (h + step) % sx
+                elif axis == 1:
+                    nk = (k + step) % sy
+                else:
+                    nl = (l + step) % sz
+
+                neighbour = (nh * sy + nk) * sz + nl
+                newBarrier = max(barrier, values[nh % nx, nk % ny, nl % nz])
+                newLength = length + stepLengths[axis]
+
+                if newBarrier < barriers[neighbour] or (newBarrier == barriers[neighbour] and newLength < lengths[neighbour]):
+                    barriers[neighbour] = newBarrier
+                    lengths[neighbour] = newLength
+                    parents[neighbour] = voxel
+                    heapKeys, heapLengths, heapItems, size = _heap_push(heapKeys, heapLengths, heapItems, size, newBarrier, newLength, neighbour)
+
+    # Walk back from the end to the start
+    count = 1
+    voxel = end
+    while voxel != start:
+        voxel = parents[voxel]
+        count += 1
+
+    path = np.empty(count, dtype=np.int64)
+    voxel = end
+    for i in range(count - 1, -1, -1):
+        path[i] = voxel
+        voxel = parents[voxel]
+
+    return path
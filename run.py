@@ -1,15 +1,36 @@
-import logging, sys
+import logging, os, sys, time
 from argparse import ArgumentParser
 from datetime import datetime
 from bvStructure import *
 from fileIO import *
+from bvCache import PreparationCache, ResultCache
+from workQueue import WorkQueue
+from mapAnalysis import VoxelMap
+from benchmark import kernel_benchmark
+from tileScheduler import TileScheduler
+from service import create_server
+from trajectory import TrajectoryMaps, read_frames
 from pathlib import Path
-from shutil import copy2
+from shutil import copy2, rmtree
+from multiprocessing import Pool
 
 RESOLUTION_ARGS = {'default':0.1, 'type':float, 'help':"The target resolution of the produced map. The number of voxels will be rounded up to ensure divsibility by 12. Defaults to 0.1."}
 EC_ARGS = {'action':'store_true', 'help':'Toggles whether the effective or absolute charge is used for repulsion calculations in bond valence site energy. Defaults to absolute charge.'}
+CONDUCTORS_ARGS = {'nargs':'+', 'default':None, 'help':'One or more conducting ions to create maps for in a single pass, replacing the conductor in the input file. One map is outputted per conductor, with the conductor appended to the output file name.'}
+CHANNEL_ARGS = {'action':'store_true', 'help':'Toggles whether the bonding and Coulombic energies are stored as seperate channels from one calculation. The total, bonding only and Coulombic only maps are all outputted, with the channel appended to the output file name. Overrides the mode.'}
+PREP_CACHE_ARGS = {'default':None, 'help':'A directory to use as a cache of prepared structures. Structures prepared with the same file, parameter database and settings are loaded from the cache rather than set up again. Defaults to no cache.'}
+RESULT_CACHE_ARGS = {'default':None, 'help':'A directory to use as a cache of finished maps. If a map has already been made from the same file, parameter database and map parameters, it is copied from the cache rather than calculated again. Defaults to no cache.'}
+RESULT_CACHE_SIZE_ARGS = {'default':1024, 'type':float, 'help':'The maximum size of the result cache in MB. The least recently used maps are removed once it grows larger. Defaults to 1024.'}
+PROCESSES_ARGS = {'default':None, 'type':int, 'help':'Splits the map into tiles calculated by this many worker processes, sharing the map through shared memory. For hosts where numba threading can not be used. With --no_jit, the tiles are calculated with NumPy. Defaults to a single process.'}
+CORE_ARGS = {'default':None, 'type':float, 'help':'Excludes the voxels within this radius (in angstroms, e.g. 1) of every ion other than the conductor. The calculation skips these voxels and gives them a value of 1000. Defaults to no exclusion.'}
+PYRAMID_ARGS = {'action':'store_true', 'help':'Toggles whether 2x, 4x and 12x downsampled copies of each map are written alongside it, keeping the lowest value of each block, with a json manifest listing the coarsest first.'}
+ENGINE_ARGS = {'default':'gather', 'help':'The engine used to calculate a single map with JIT. gather loops over the voxels, finding the distance to every site from each. scatter loops over the sites, adding each one only to the voxels within its cutoff, which is faster on fine grids and for large cells. Both give the same map. fft convolves the sites of each species with its energy by FFT, which is fastest for large cells, but only approximates the map within a few voxels of the sites. For bvse, grouped is the gather engine reading the sites in blocks of one species. Defaults to gather.'}
 NJ_ARGS = {'action':'store_true', 'help':'Toggles whether just-in-time compliation is used in the calcualtion. Defaults to using JIT for large speed gains, flag turns it off.'}
 
+# The JIT engines that can calculate a single map, by their names in --engine
+BVSE_ENGINES = {"gather": BVStructure.populate_map_bvse_jit, "grouped": BVStructure.populate_map_bvse_grouped, "scatter": BVStructure.populate_map_bvse_scatter, "fft": BVStructure.populate_map_bvse_fft}
+BVSM_ENGINES = {"gather": BVStructure.populate_map_bvsm_jit, "scatter": BVStructure.populate_map_bvsm_scatter, "fft": BVStructure.populate_map_bvsm_fft}
+
 def create_input(parser:ArgumentParser, overrideArgs:list = None):
 
     parser.add_argument("cif_file", help="The structure to be analysed, in a cif file format.")
@@ -28,20 +49,42 @@ def bvsm(parser:ArgumentParser, overrideArgs:list = None):
     parser.add_argument("-n", "--no_jit", **NJ_ARGS)
     parser.add_argument("-k", "--penalty_constant", default=0.05, type=float)
     parser.add_argument("-t", "--penalty_type", default="q", choices=("q","l","quadratic","linear"))
+    parser.add_argument("-j", "--processes", **PROCESSES_ARGS)
+    parser.add_argument("-E", "--engine", choices=BVSM_ENGINES.keys(), **ENGINE_ARGS)
+    parser.add_argument("-x", "--core_radius", **CORE_ARGS)
+    parser.add_argument("-P", "--pyramid", **PYRAMID_ARGS)
+    parser.add_argument("-p", "--prep_cache", **PREP_CACHE_ARGS)
+    parser.add_argument("-R", "--result_cache", **RESULT_CACHE_ARGS)
+    parser.add_argument("-S", "--result_cache_size", **RESULT_CACHE_SIZE_ARGS)
 
     args = vars(parser.parse_args(overrideArgs))
     args.pop('function', None)
     _bvsm(**args)
 
-def _bvsm(input_file:str, output_file:str, resolution:float, mode:int, no_jit:bool, penalty_constant:float, penalty_type:str):
+def _bvsm(input_file:str, output_file:str, resolution:float, mode:int, no_jit:bool, penalty_constant:float, penalty_type:str, processes:int = None, engine:str = "gather", core_radius:float = None, pyramid:bool = False, prep_cache:str = None, result_cache:str = None, result_cache_size:float = 1024):
 
-    crystal = BVStructure.from_file(input_file, bvse=True)
-    crystal.initalise_map(resolution)
+    mapSettings = {"command": "bvsm", "resolution": resolution, "mode": mode, "no_jit": no_jit, "penalty_constant": penalty_constant, "penalty_type": penalty_type[0], "engine": engine, "core_radius": core_radius, "pyramid": pyramid}
+    resultCache, resultKey = _fetch_result(input_file, output_file, mapSettings, result_cache, result_cache_size)
+    if resultCache is not None and resultKey is None:
+        return
 
-    if mode > 0:
-        crystal.create_lone_pairs()
+    settings = {"bvse": True, "lone_pairs": mode > 0, "conductors": None}
+    crystal, cacheEntry = _prepare(input_file, lambda: BVStructure.from_file(input_file, bvse=True), settings, prep_cache)
+    crystal.setup_voxels(resolution)
+    if core_radius is not None:
+        crystal.create_core_mask(core_radius)
 
-    if no_jit:
+    if processes is not None and ("bvsm", engine) not in TileScheduler.KERNELS:
+        logging.error(f"The {engine} engine can not be split into tiles. Use the gather or scatter engine with --processes.")
+        return
+
+    if processes is not None:
+        if penalty_type[0] == "l":
+            logging.error("Linear penalty functions are not implemented for tiled maps. Remove option --processes to run.")
+            return
+        TileScheduler(processes, jit=not no_jit, engine=engine).populate_map_bvsm(crystal, mode=mode, penalty=penalty_constant)
+
+    elif no_jit:
         if mode == 0:
             crystal.populate_map_bvsm(fType=penalty_type, penalty=0)
         elif mode == 1:
@@ -50,12 +93,170 @@ def _bvsm(input_file:str, output_file:str, resolution:float, mode:int, no_jit:bo
             crystal.populate_map_bvsm(fType=penalty_type, penalty=penalty_constant, only_penalty=True)
 
     else:
-        if penalty_type == "l" or penalty_type == "linear":
+        if penalty_type[0] == "l":
             logging.error("Linear penalty functions are not implemented using JIT. Add flag --no_jit to run.")
+            return
+
+        BVSM_ENGINES[engine](crystal, mode = mode, penalty=penalty_constant)
+
+    if no_jit:
+        crystal.apply_core_mask()
+
+    writtenPaths = _export(crystal, output_file, pyramid)
+    _store_prepared(crystal, cacheEntry)
+    _store_result(resultCache, resultKey, output_file, writtenPaths, crystal.name)
+
+def _export(crystal:BVStructure, output_file:str|Path, pyramid:bool = False, conductor:Ion = None, channel:str = None) -> dict:
+    """
+        Exports a map, along with its downsampled levels if pyramid is set. Returns a dictionary of the paths written,
+        keyed by the paths that were asked for - these differ where a file was renamed to avoid overwriting another.
+    """
+
+    output_file = Path(output_file)
+    if not pyramid:
+        return {output_file: crystal.export_map(output_file, conductor=conductor, channel=channel)}
+
+    # Every file of the pyramid is named after the (possibly renamed) full map
+    basePath = available_path(output_file)
+    writtenPaths = crystal.export_pyramid(basePath, *crystal.map_values(conductor, channel))
+    return {output_file.with_name(output_file.stem + path.name[len(basePath.stem):]): path for path in writtenPaths}
+
+def _stage_time(timings:dict, stage:str, start:float):
+    """
+        Stores the seconds since the start of a stage in a dictionary of timings, if one is being kept.
+    """
+    if timings is not None:
+        timings[stage] = time.perf_counter() - start
+
+def _reset_peak_memory() -> bool:
+    """
+        Resets the peak resident memory of this process, so that the peak while processing one structure can be found
+        with _structure_peak_memory. This is only possible on Linux. Returns whether the peak was reset.
+    """
+
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+def _structure_peak_memory() -> float:
+    """
+        Returns the peak resident memory of this process in MB since it was last reset by _reset_peak_memory, or None
+        where it can not be read.
+    """
+
+    try:
+        with open("/proc/self/status", "r") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 2**10
+    except OSError:
+        pass
+
+    return None
+
+def _process_peak_memory() -> float:
+    """
+        Returns the peak resident memory of this process so far in MB, or None where it can not be read (e.g. Windows).
+        This never goes down, so it is the peak of the largest structure processed so far.
+    """
+
+    try:
+        import resource
+    except ImportError:
+        return None
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 2**20 if sys.platform == "darwin" else peak / 2**10
+
+def _prepare(sourcePath:str|Path, reader, settings:dict, prepCache:str = None) -> tuple:
+    """
+        Returns a structure prepared for making a map, and the cache entry it should be stored under once its site arrays
+        have been made. The structure is loaded from the preparation cache if possible, otherwise it is made with the
+        reader function. The cache entry is None if there is nothing to store.
+    """
+
+    if prepCache is None:
+        cache, key = None, None
+    else:
+        cache = PreparationCache(prepCache)
+        key = cache.key(sourcePath, settings)
+        crystal = cache.load(key)
+        if crystal is not None:
+            return crystal, None
+
+    crystal = reader()
+    crystal.prepare(lonePairs=settings["lone_pairs"])
+
+    return crystal, (None if cache is None else (cache, key))
+
+def _store_prepared(crystal:BVStructure, cacheEntry:tuple):
+    """
+        Stores a prepared structure in the preparation cache, if _prepare returned a cache entry for it.
+    """
+    if cacheEntry is not None:
+        cache, key = cacheEntry
+        cache.save(key, crystal)
+
+def _fetch_result(sourcePath:str|Path, output_file:str|Path, mapSettings:dict, resultCache:str = None, resultCacheSize:float = 1024) -> tuple:
+    """
+        Copies the map(s) for a structure file and map settings from the result cache to the output file, if they are stored.
+        Returns the result cache and the key the map(s) should be stored under once calculated. The key is None if the
+        map(s) were copied from the cache, and both are None if there is no cache.
+    """
 
-        crystal.populate_map_bvsm_jit(mode = mode, penalty=penalty_constant)
+    if resultCache is None:
+        return None, None
 
-    crystal.export_map(output_file)
+    cache = ResultCache(resultCache, maxBytes=int(resultCacheSize * 2**20))
+    key = cache.key(sourcePath, mapSettings | {"suffix": Path(output_file).suffix})
+
+    if cache.fetch(key, output_file) is not None:
+        return cache, None
+
+    return cache, key
+
+def _store_result(cache:ResultCache, key:str, output_file:str|Path, writtenPaths:dict, name:str):
+    """
+        Stores the map(s) written for an output file in the result cache, if _fetch_result returned a key for them.
+    """
+    if cache is not None and key is not None and len(writtenPaths) > 0:
+        cache.store(key, output_file, writtenPaths, name)
+
+def bvsm_sweep(parser:ArgumentParser, overrideArgs:list = None):
+    """
+        Calculates BVSM maps for a list of penalty constants, calculating the bond valence sum and penalty fields only once.
+        Summary statistics for every penalty constant are written to a csv file next to the output file.
+    """
+
+    parser.add_argument("input_file")
+    parser.add_argument("output_file")
+    parser.add_argument("-r", "--resolution", **RESOLUTION_ARGS)
+    parser.add_argument("-m", "--mode", default=1, choices=range(0,3), type=int)
+    parser.add_argument("-k", "--penalty_constants", nargs="+", required=True, type=float, help="The penalty constants to create maps for.")
+    parser.add_argument("-t", "--threshold", default=0.1, type=float, help="Summary statistics include the fraction of voxels with a value below this threshold. Defaults to 0.1.")
+    parser.add_argument("-s", "--stats_only", action="store_true", help="Toggles whether only the summary statistics are outputted, without any maps.")
+
+    args = parser.parse_args(overrideArgs)
+
+    crystal = BVStructure.from_file(args.input_file, bvse=True)
+    crystal.initalise_map(args.resolution)
+
+    if args.mode > 0:
+        crystal.create_lone_pairs()
+
+    stats = crystal.penalty_sweep(args.penalty_constants, mode=args.mode, threshold=args.threshold)
+
+    outputPath = Path(args.output_file)
+    stats.to_csv(outputPath.with_suffix(".csv"))
+    logging.info(f"Penalty sweep statistics:\n{stats.to_string()}")
+
+    if not args.stats_only:
+        for penalty in args.penalty_constants:
+            crystal.map = crystal.penalty_sweep_map(penalty, mode=args.mode)
+            crystal.export_map(outputPath.with_stem(f"{outputPath.stem}-k{penalty}"))
 
 def bvse(parser:ArgumentParser, overrideArgs:list = None):
 
@@ -65,23 +266,223 @@ def bvse(parser:ArgumentParser, overrideArgs:list = None):
     parser.add_argument("-m", "--mode", default=1, choices=range(0,3), type=int)
     parser.add_argument("-e", "--effective_charge", **EC_ARGS)
     parser.add_argument("-n", "--no_jit", **NJ_ARGS)
+    parser.add_argument("-c", "--conductors", **CONDUCTORS_ARGS)
+    parser.add_argument("-d", "--channels", **CHANNEL_ARGS)
+    parser.add_argument("-j", "--processes", **PROCESSES_ARGS)
+    parser.add_argument("-E", "--engine", choices=BVSE_ENGINES.keys(), **ENGINE_ARGS)
+    parser.add_argument("-x", "--core_radius", **CORE_ARGS)
+    parser.add_argument("-P", "--pyramid", **PYRAMID_ARGS)
+    parser.add_argument("-p", "--prep_cache", **PREP_CACHE_ARGS)
+    parser.add_argument("-R", "--result_cache", **RESULT_CACHE_ARGS)
+    parser.add_argument("-S", "--result_cache_size", **RESULT_CACHE_SIZE_ARGS)
 
     args = vars(parser.parse_args(overrideArgs))
     args.pop('function', None)
     _bvse(**args)
 
-def _bvse(input_file:str, output_file:str, resolution:float, mode:int, effective_charge:bool, no_jit:bool):
+def _bvse(input_file:str, output_file:str, resolution:float, mode:int, effective_charge:bool, no_jit:bool, conductors:list = None, channels:bool = False, processes:int = None, engine:str = "gather", core_radius:float = None, pyramid:bool = False, prep_cache:str = None, result_cache:str = None, result_cache_size:float = 1024):
 
-    crystal = BVStructure.from_file(input_file, bvse=True)
-    crystal.initalise_map(resolution)
-    if mode > 0:
-        crystal.create_lone_pairs()
-    if no_jit:
+    mapSettings = {"command": "bvse", "resolution": resolution, "mode": mode, "effective_charge": effective_charge, "no_jit": no_jit, "conductors": conductors, "channels": channels, "engine": engine, "core_radius": core_radius, "pyramid": pyramid}
+    resultCache, resultKey = _fetch_result(input_file, output_file, mapSettings, result_cache, result_cache_size)
+    if resultCache is not None and resultKey is None:
+        return
+
+    settings = {"bvse": True, "lone_pairs": mode > 0 or channels, "conductors": conductors}
+    crystal, cacheEntry = _prepare(input_file, lambda: BVStructure.from_file(input_file, bvse=True, conductors=conductors), settings, prep_cache)
+    writtenPaths = _bvse_map(crystal, output_file, resolution, mode, effective_charge, no_jit, multi=bool(conductors), channels=channels, processes=processes, engine=engine, core_radius=core_radius, pyramid=pyramid)
+    _store_prepared(crystal, cacheEntry)
+    _store_result(resultCache, resultKey, output_file, writtenPaths, crystal.name)
+
+def _bvse_map(crystal:BVStructure, output_file:str, resolution:float, mode:int, effective_charge:bool, no_jit:bool, multi:bool = False, channels:bool = False, processes:int = None, engine:str = "gather", core_radius:float = None, pyramid:bool = False, timings:dict = None) -> list:
+    """
+        Creates and exports the BVSE map(s) of a structure that has already been prepared. If multi is set, one map is
+        exported for each of the structure's conductors. If a number of processes is given, a single map is split into
+        tiles calculated by that many processes. A single map is calculated with the named engine (see BVSE_ENGINES). If
+        a core radius is given, the voxels within it of the other ions are excluded. If pyramid is set, each map is
+        written with its downsampled levels. If a timings dictionary is given, the seconds taken to calculate the map(s)
+        are stored in it under 'map'. Returns the paths written, keyed by the paths asked for (see _export).
+    """
+
+    start = time.perf_counter()
+    crystal.setup_voxels(resolution)
+    if core_radius is not None:
+        crystal.create_core_mask(core_radius)
+
+    if (multi or channels) and no_jit:
+        logging.error("Maps for multiple conductors or channels are not implemented without JIT. Remove flag --no_jit to run.")
+        return {}
+
+    if (multi or channels) and engine != "gather":
+        logging.warning(f"Maps for multiple conductors or channels are only calculated by the gather engine - ignoring the {engine} engine")
+
+    if (multi or channels) and processes is not None:
+        logging.warning("Maps for multiple conductors or channels are not split into tiles - calculating them in a single process")
+
+    if channels:
+        crystal.populate_map_bvse_channels(effectiveCharge=effective_charge)
+        _stage_time(timings, "map", start)
+        outputPath = Path(output_file)
+        writtenPaths = {}
+        for conductor in crystal.conductors:
+            conductorPath = outputPath.with_stem(f"{outputPath.stem}-{conductor}") if multi else outputPath
+            for channel in ("total", "bond", "coul"):
+                writtenPaths |= _export(crystal, conductorPath.with_stem(f"{conductorPath.stem}-{channel}"), pyramid, conductor=conductor, channel=channel)
+        return writtenPaths
+
+    if multi:
+        crystal.populate_map_bvse_multi(mode=mode, effectiveCharge=effective_charge)
+        _stage_time(timings, "map", start)
+        outputPath = Path(output_file)
+        return {requested: path for conductor in crystal.conductors for requested, path in _export(crystal, outputPath.with_stem(f"{outputPath.stem}-{conductor}"), pyramid, conductor=conductor).items()}
+
+    if processes is not None and ("bvse", engine) not in TileScheduler.KERNELS:
+        logging.error(f"The {engine} engine can not be split into tiles. Use the gather or scatter engine with --processes.")
+        return {}
+
+    if processes is not None:
+        TileScheduler(processes, jit=not no_jit, engine=engine).populate_map_bvse(crystal, mode=mode, effectiveCharge=effective_charge)
+    elif no_jit:
         crystal.populate_map_bvse(mode=mode)
+        crystal.apply_core_mask()
     else:
-        crystal.populate_map_bvse_jit(mode = mode, effectiveCharge=effective_charge)
-    crystal.export_map(output_file)
+        BVSE_ENGINES[engine](crystal, mode = mode, effectiveCharge=effective_charge)
+    _stage_time(timings, "map", start)
+    return _export(crystal, output_file, pyramid)
+
 
+def trajectory(parser:ArgumentParser, overrideArgs:list = None):
+    """
+        Averages maps over the frames of a trajectory, reading the structure's parameters, effective charges and site
+        types once from its input file. The mean map is written to the output file and the standard deviation alongside
+        it, with '-std' appended to the file name.
+    """
+
+    parser.add_argument("input_file", help="The input file of the structure, giving the species and order of the atoms in every frame.")
+    parser.add_argument("frames", help="An XDATCAR file, or a folder of cif or POSCAR files read in order of file name.")
+    parser.add_argument("output_file")
+    parser.add_argument("-M", "--method", default="bvse", choices=("bvse", "bvsm"), help="The type of map to make. Defaults to bvse.")
+    parser.add_argument("-r", "--resolution", **RESOLUTION_ARGS)
+    parser.add_argument("-m", "--mode", default=1, choices=range(0,3), type=int)
+    parser.add_argument("-e", "--effective_charge", **EC_ARGS)
+    parser.add_argument("-k", "--penalty_constant", default=0.05, type=float, help="The penalty constant of BVSM maps. Defaults to 0.05.")
+    parser.add_argument("--start", default=0, type=int, help="The first frame to use. Defaults to 0.")
+    parser.add_argument("--stop", default=None, type=int, help="The frame to stop before. Defaults to the end of the trajectory.")
+    parser.add_argument("--step", default=1, type=int, help="Only every step-th frame is used. Defaults to 1.")
+    parser.add_argument("-f", "--per_frame", action="store_true", help="Toggles whether the map of every frame is also written, with the frame label appended to the output file name.")
+    args = parser.parse_args(overrideArgs)
+
+    crystal = BVStructure.from_file(args.input_file, bvse=True)
+    maps = TrajectoryMaps(crystal)
+    frames = read_frames(args.frames, args.start, args.stop, args.step)
+    outputPath = Path(args.output_file)
+
+    frameCallback = None
+    if args.per_frame:
+        frameCallback = lambda label, frameCrystal: frameCrystal.export_map(outputPath.with_stem(f"{outputPath.stem}-{label}"))
+
+    if args.method == "bvse":
+        count = maps.bvse(frames, args.resolution, args.mode, args.effective_charge, frameCallback)
+    else:
+        count = maps.bvsm(frames, args.resolution, args.mode, args.penalty_constant, frameCallback)
+
+    if count == 0:
+        logging.error(f"No frames were read from {args.frames}")
+        return
+
+    crystal.map = maps.mean
+    crystal.export_map(outputPath)
+    crystal.map = maps.std
+    crystal.export_map(outputPath.with_stem(f"{outputPath.stem}-std"))
+    logging.info(f"Averaged {count} frames, taking {np.mean(maps.frameTimes):.2f} s per frame")
+
+def find_sites(parser:ArgumentParser, overrideArgs:list = None):
+    """
+        Finds the candidate conductor sites of a finished map - its local minima, with minima close to each other merged -
+        and writes their energies and coordinates to a csv file.
+    """
+
+    parser.add_argument("map_file", help="The map to analyse, in a .cube or .grd file.")
+    parser.add_argument("output_file", help="The csv file to write the sites to.")
+    parser.add_argument("-t", "--tolerance", default=0.5, type=float, help="Minima within this distance (in angstroms) of a lower minimum are merged into it. Defaults to 0.5.")
+    parser.add_argument("-w", "--window", default=None, type=float, help="Only minima with an energy within this value of the lowest energy are kept. Defaults to keeping every minimum.")
+    parser.add_argument("-s", "--symmetry", action="store_true", help="Toggles whether sites equivalent under the structure's space group are labelled with the same group. Needs a cube file, or a structure given with --structure.")
+    parser.add_argument("--structure", default=None, help="A cif file of the structure the map was made from, used for the symmetry analysis instead of the atoms in the map file.")
+    parser.add_argument("--symprec", default=0.1, type=float, help="The tolerance used to find the space group of the structure. Defaults to 0.1.")
+    args = parser.parse_args(overrideArgs)
+
+    voxelMap = VoxelMap.from_file(args.map_file)
+
+    if args.structure is not None:
+        voxelMap.structure = pmg.Structure.from_file(args.structure)
+
+    if args.symmetry and voxelMap.structure is None:
+        logging.error("Symmetry analysis needs a structure - use a cube file or give a cif file with --structure")
+        sys.exit()
+
+    table = voxelMap.find_sites(tolerance=args.tolerance, window=args.window, symmetry=args.symmetry, symprec=args.symprec)
+    table.to_csv(args.output_file)
+    logging.info(f"Candidate sites:\n{table.to_string()}")
+
+def migration_path(parser:ArgumentParser, overrideArgs:list = None):
+    """
+        Finds the path with the lowest barrier through a finished map, either between two points or from a point to its
+        own image in the next cell along an axis, and writes the energy profile along it to a csv file.
+    """
+
+    parser.add_argument("map_file", help="The map to search, in a .cube or .grd file.")
+    parser.add_argument("output_file", help="The csv file to write the path and its energy profile to.")
+    parser.add_argument("-s", "--start", nargs=3, type=float, required=True, help="The fractional coordinates of the start of the path, such as a site from find_sites.")
+    endGroup = parser.add_mutually_exclusive_group(required=True)
+    endGroup.add_argument("-e", "--end", nargs=3, type=float, help="The fractional coordinates of the end of the path. The periodic image of the end with the lowest barrier is used.")
+    endGroup.add_argument("-a", "--axis", choices=("a", "b", "c"), help="Find the path from the start to its image in the next cell along this axis, giving the barrier to migration along the axis.")
+    args = parser.parse_args(overrideArgs)
+
+    voxelMap = VoxelMap.from_file(args.map_file)
+    axis = None if args.axis is None else "abc".index(args.axis)
+    table = voxelMap.minimum_path(np.array(args.start), None if args.end is None else np.array(args.end), axis)
+    table.to_csv(args.output_file)
+
+    barrierStep = table["energy"].idxmax()
+    logging.info(f"Migration barrier of {table['energy'].max() - table['energy'].min():.4f}, at fractional coordinates {table.loc[barrierStep, ['a', 'b', 'c']].to_numpy()}")
+
+def benchmark(parser:ArgumentParser, overrideArgs:list = None):
+    """
+        Times the map kernels against each other on one structure, and writes the results to a csv file.
+    """
+
+    parser.add_argument("input_file", nargs="?", default="test/betaPbF2-simplified.inp", help="The structure to time the kernels on. Defaults to test/betaPbF2-simplified.inp.")
+    parser.add_argument("-r", "--resolution", **RESOLUTION_ARGS)
+    parser.add_argument("-n", "--repeats", default=3, type=int, help="The number of times each kernel is run, keeping the fastest. Defaults to 3.")
+    parser.add_argument("-o", "--output", default=None, help="A csv file to write the results to. Defaults to only logging them.")
+    args = parser.parse_args(overrideArgs)
+
+    table = kernel_benchmark(args.input_file, args.resolution, args.repeats)
+    logging.info(f"Kernel benchmark:\n{table.to_string()}")
+
+    if args.output is not None:
+        table.to_csv(args.output, index=False)
+
+def serve(parser:ArgumentParser, overrideArgs:list = None):
+    """
+        Runs a local map service until interrupted. The service keeps the parameter database in memory, the kernels
+        compiled and recently used structures prepared, so jobs posted to it skip the start-up costs of this script.
+    """
+
+    parser.add_argument("--host", default="127.0.0.1", help="The address to listen on. Defaults to 127.0.0.1, so only local jobs are accepted.")
+    parser.add_argument("--port", default=8765, type=int, help="The port to listen on. Defaults to 8765.")
+    parser.add_argument("--max_structures", default=32, type=int, help="The number of prepared structures kept in memory. Defaults to 32.")
+    args = parser.parse_args(overrideArgs)
+
+    server = create_server(args.host, args.port, maxStructures=args.max_structures)
+    logging.info(f"Serving maps on http://{args.host}:{server.server_address[1]} - post jobs to /bvse or /bvsm")
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        logging.info("Stopping the map service")
+    finally:
+        server.server_close()
+        server.service.close()
 
 def site_bvs(parser:ArgumentParser, overrideArgs:list = None):
 
@@ -93,9 +494,12 @@ def site_bvs(parser:ArgumentParser, overrideArgs:list = None):
     crystal = BVStructure.from_file(args.input_file)
     crystal.define_buffer_area()
     crystal.find_buffer_sites()
-        
-    for site in crystal.sites.itertuples():
-        print(f"Site {site.Index} at {site.coords} = {crystal.find_site_bvs(site.Index, args.vector)}")
+
+    scalarSums, vectorSums = crystal.all_site_bvs()
+    siteSums = vectorSums if args.vector else scalarSums
+
+    for i, site in enumerate(crystal.sites.itertuples()):
+        print(f"Site {site.Index} at {site.coords} = {siteSums[i]}")
 
 def _create_dir(path:Path, name:str):
     resultPath = path.joinpath(name)
@@ -106,9 +510,16 @@ def _create_dir(path:Path, name:str):
 def bulk_bvse(parser:ArgumentParser, overrideArgs:list = None):
 
     parser.add_argument("base_path", help="The folder that the program should use for the calculations. Should contain a folder named 'cif' that contains all the structures to process. The results will be outputted to 'result.")
-    parser.add_argument("conductor", help="The conducting ion under investigation. Specified in the format (ELEMENT)(CHARGE NUMBER)(CHARGE SIGN)")
+    parser.add_argument("conductor", nargs="+", help="The conducting ion(s) under investigation. Specified in the format (ELEMENT)(CHARGE NUMBER)(CHARGE SIGN). If several are given, a map for each is made in a single pass.")
     parser.add_argument("-r", "--resolution", **RESOLUTION_ARGS)
     parser.add_argument("-e", "--effective_charge", **EC_ARGS)
+    parser.add_argument("-i", "--write_inp", action="store_true", help="Toggles whether an input file is written alongside each map, as a record of the structure used. Not written for structures loaded from the preparation cache.")
+    parser.add_argument("-p", "--prep_cache", **PREP_CACHE_ARGS)
+    parser.add_argument("-R", "--result_cache", **RESULT_CACHE_ARGS)
+    parser.add_argument("-S", "--result_cache_size", **RESULT_CACHE_SIZE_ARGS)
+    parser.add_argument("-w", "--worker", action="store_true", help="Toggles worker mode, where several processes (on any machines sharing the base path) split the structures between them through a work queue in 'queue'. Every worker writes to the same 'result' folder.")
+    parser.add_argument("--stale_after", default=600, type=float, help="In worker mode, the number of seconds without a heartbeat after which a claimed structure is assumed to belong to a crashed worker and is processed again. Defaults to 600.")
+    parser.add_argument("-o", "--summary", default="summary.csv", help="The name of the table in the base path that records every structure processed, with its size, the time of each stage, peak memory and whether it failed. In worker mode, each worker writes its own table with the worker appended to the name. Defaults to summary.csv.")
     args = parser.parse_args(overrideArgs)
 
     basePath = Path(args.base_path)
@@ -120,6 +531,16 @@ def bulk_bvse(parser:ArgumentParser, overrideArgs:list = None):
 
     else:
 
+        multi = len(args.conductor) > 1
+        settings = {"bvse": True, "lone_pairs": True, "conductors": args.conductor}
+        cache = None if args.prep_cache is None else PreparationCache(args.prep_cache)
+        resultCache = None if args.result_cache is None else ResultCache(args.result_cache, maxBytes=int(args.result_cache_size * 2**20))
+        mapSettings = {"command": "bulk_bvse", "resolution": args.resolution, "mode": 1, "effective_charge": args.effective_charge, "conductors": args.conductor, "suffix": ".cube"}
+
+        if args.worker:
+            _bulk_bvse_worker(basePath, cifPath, args, multi, settings, cache, resultCache, mapSettings)
+            return
+
         resultPath = basePath.joinpath("result")
         if resultPath.is_dir():
             for i in range(100):
@@ -129,26 +550,220 @@ def bulk_bvse(parser:ArgumentParser, overrideArgs:list = None):
                     break
 
         resultPath.mkdir()
+        summaryPath = available_path(basePath.joinpath(args.summary))
 
         for cifFile in cifPath.iterdir():
-            formula = readCif(cifFile)['_chemical_formula_structural'].replace(' ','')
-            # create_input_from_cif(cifFile, inpPath.joinpath(cifFile.name).with_suffix(".inp"), conductor)
+            _write_summary_row(summaryPath, _bulk_structure(cifFile, resultPath, args, multi, settings, cache, resultCache, mapSettings))
+
+        _log_summary(summaryPath)
+
+def _bulk_bvse_worker(basePath:Path, cifPath:Path, args, multi:bool, settings:dict, cache:PreparationCache, resultCache:ResultCache, mapSettings:dict):
+    """
+        Processes structures from the cif folder as one of several workers sharing a work queue. Each structure is
+        processed in a staging folder, which is only moved into the shared result folder if no other worker has taken the
+        structure over in the meantime, so every structure's results are written exactly once.
+    """
+
+    resultPath = basePath.joinpath("result")
+    resultPath.mkdir(exist_ok=True)
+    queue = WorkQueue(basePath.joinpath("queue"), staleAfter=args.stale_after)
+    stagingPath = queue.queueDir.joinpath("staging")
+    stagingPath.mkdir(exist_ok=True)
+    summaryPath = basePath.joinpath(args.summary)
+    summaryPath = summaryPath.with_stem(f"{summaryPath.stem}-{queue.worker}")
+
+    for claim in queue.claims(sorted(cifFile.name for cifFile in cifPath.iterdir())):
+        with claim:
+
+            claimPath = stagingPath.joinpath(f"{claim.item}.{claim.generation}")
+            claimPath.mkdir(exist_ok=True)
+            row = _bulk_structure(cifPath.joinpath(claim.item), claimPath, args, multi, settings, cache, resultCache, mapSettings)
+
+            if claim.is_current():
+                for formulaFolder in claimPath.iterdir():
+                    destination = _create_dir(resultPath, formulaFolder.name)
+                    for resultFile in formulaFolder.iterdir():
+                        os.replace(resultFile, available_path(destination.joinpath(resultFile.name)))
+                claim.complete()
+                logging.info(f"Worker {queue.worker} finished {claim.item}")
+            else:
+                logging.warning(f"{claim.item} was taken over by another worker - discarding these results")
+                row = row[:-2] + ("discarded", None)
+
+            _write_summary_row(summaryPath, row)
+            rmtree(claimPath, ignore_errors=True)
+
+    _log_summary(summaryPath)
+
+# The columns of the summary table written by bulk_bvse, one row per structure
+SUMMARY_COLUMNS = ["file", "formula", "sites", "buffered_sites", "voxels", "read_seconds", "prepare_seconds", "map_seconds", "write_seconds", "total_seconds", "voxels_per_second", "peak_memory_mb", "process_peak_memory_mb", "status", "error"]
+
+def _bulk_structure(cifFile:Path, resultPath:Path, args, multi:bool, settings:dict, cache:PreparationCache, resultCache:ResultCache, mapSettings:dict) -> tuple:
+    """
+        Creates the map(s) of a single structure in a bulk calculation, writing them to a folder named after its formula
+        in the result folder. Errors are logged rather than raised, so one bad structure does not stop the calculation.
+        Returns the structure's row of the summary table (see SUMMARY_COLUMNS). The status is 'ok', 'cached' if the
+        map was copied from the result cache, 'empty' if no map was written (the reason is logged), or 'failed', with the
+        type of the exception raised as the error. The peak memory of the structure is only found on Linux, but the peak
+        memory of the process so far is found on every platform other than Windows.
+    """
+
+    start = time.perf_counter()
+    timings = {}
+    formula, crystal = None, None
+    peakReset = _reset_peak_memory()
+
+    def row(status:str, error:Exception = None) -> tuple:
+        voxels = int(np.prod(crystal.voxelNumbers)) if "map" in timings else None
+        counts = (None, None) if crystal is None else (len(crystal.sites), len(crystal.bufferedSites) if hasattr(crystal, "bufferedSites") else None)
+        stages = [timings.get(stage) for stage in ("read", "prepare", "map", "write")]
+        speed = voxels / timings["map"] if voxels is not None and timings["map"] > 0 else None
+        return (cifFile.name, formula, *counts, voxels, *stages, time.perf_counter() - start, speed, _structure_peak_memory() if peakReset else None, _process_peak_memory(), status, None if error is None else type(error).__name__)
+
+    # If the map is in the result cache, nothing needs to be calculated
+    try:
+        resultKey = None if resultCache is None else resultCache.key(cifFile, mapSettings)
+        formula = None if resultCache is None else resultCache.name(resultKey)
+
+        if formula is not None:
             formulaFolder = _create_dir(resultPath, formula)
-            inpFile = formulaFolder.joinpath(formula).with_suffix(".inp")
-            cubeFile = formulaFolder.joinpath(formula).with_suffix(".cube")
+            copy2(cifFile, available_path(formulaFolder.joinpath(formula).with_suffix(".cif")))
+            resultCache.fetch(resultKey, formulaFolder.joinpath(formula).with_suffix(".cube"))
+            return row("cached")
+
+    except Exception as e:
+        logging.error(f"The following {type(e)} exception was raised when fetching {cifFile.name} from the result cache: {e}")
+        return row("failed", e)
+
+    # If the structure is in the preparation cache, the cif does not need to be read at all
+    stageStart = time.perf_counter()
+    key = None if cache is None else cache.key(cifFile, settings)
+    crystal = None if cache is None else cache.load(key)
+
+    # Otherwise, the cif is only parsed once, giving both the formula and the structure
+    if crystal is None:
+        try:
+            struct, formula = read_structure(cifFile)
+        except Exception as e:
+            logging.error(f"The following {type(e)} exception was raised when reading {cifFile.name}: {e}")
+            return row("failed", e)
+        _stage_time(timings, "read", stageStart)
+    else:
+        formula = crystal.name
+        _stage_time(timings, "prepare", stageStart)
 
-            try:
+    formulaFolder = _create_dir(resultPath, formula)
+    inpFile = formulaFolder.joinpath(formula).with_suffix(".inp") if args.write_inp else None
+    cubeFile = formulaFolder.joinpath(formula).with_suffix(".cube")
 
-                copy2(cifFile, formulaFolder.joinpath(formula).with_suffix(".cif"))
+    try:
+
+        copy2(cifFile, available_path(formulaFolder.joinpath(formula).with_suffix(".cif")))
+
+        if crystal is None:
+            stageStart = time.perf_counter()
+            crystal = BVStructure.from_structure(struct, args.conductor[0], formula, bvse=True, conductors=args.conductor if multi else None, inpOutput=inpFile)
+            crystal.prepare(lonePairs=True)
+            cacheEntry = None if cache is None else (cache, key)
+            _stage_time(timings, "prepare", stageStart)
+        else:
+            cacheEntry = None
+
+        stageStart = time.perf_counter()
+        writtenPaths = _bvse_map(crystal, cubeFile, resolution=args.resolution, mode=1, effective_charge=args.effective_charge, no_jit=False, multi=multi, timings=timings)
+        _stage_time(timings, "write", stageStart + timings.get("map", 0))
+        _store_prepared(crystal, cacheEntry)
+        _store_result(resultCache, resultKey, cubeFile, writtenPaths, formula)
+
+    except (Exception, SystemExit) as e:
+        logging.error(f"The following {type(e)} exception was raised when processing the structure {formula}: {e}")
+        return row("failed", e)
+
+    return row("ok" if len(writtenPaths) > 0 else "empty")
+
+def _write_summary_row(summaryPath:Path, row:tuple):
+    """
+        Appends a structure's row to the summary table, writing the header first if the table is new. Rows are written
+        as each structure finishes, so the table is kept even if the run is stopped.
+    """
+    pd.DataFrame([row], columns=SUMMARY_COLUMNS).to_csv(summaryPath, mode="a", header=not summaryPath.exists(), index=False)
+
+def _log_summary(summaryPath:Path):
+    """
+        Logs the number of structures that succeeded and failed, and the slowest structures, from a summary table.
+    """
+
+    if not summaryPath.exists():
+        return
+
+    table = pd.read_csv(summaryPath)
+    logging.info(f"Summary written to {summaryPath} - {table['status'].value_counts().to_dict()}")
+
+    failures = table[table["status"] == "failed"]
+    if len(failures) > 0:
+        logging.info(f"Failures by error type: {failures['error'].value_counts().to_dict()}")
+
+    slowest = table.nlargest(3, "total_seconds")[["file", "voxels", "total_seconds"]]
+    logging.info(f"Slowest structures:\n{slowest.to_string(index=False)}")
+
+def bulk_gii(parser:ArgumentParser, overrideArgs:list = None):
+    """
+        Screens every structure in a folder of cif files by finding the bond valence sum deviation of every site and the
+        global instability index. The structures are processed in parallel and the results are written to one table.
+    """
+
+    parser.add_argument("base_path", help="The folder that the program should use for the calculations. Should contain a folder named 'cif' that contains all the structures to process. The table is outputted to 'gii.csv'.")
+    parser.add_argument("conductor", help="The conducting ion under investigation, which sets the cutoff radius. Specified in the format (ELEMENT)(CHARGE NUMBER)(CHARGE SIGN)")
+    parser.add_argument("-p", "--processes", default=None, type=int, help="The number of processes to use. Defaults to the number of CPUs.")
+    parser.add_argument("-o", "--output", default="gii.csv", help="The name of the table to output in the base path. Defaults to gii.csv.")
+    args = parser.parse_args(overrideArgs)
+
+    basePath = Path(args.base_path)
+    cifPath = basePath.joinpath("cif")
+
+    if not cifPath.is_dir():
+        logging.error("The folder specified does not contain a folder called 'cif'")
+        sys.exit()
+
+    cifFiles = sorted(cifPath.glob("*.cif"))
 
-                create_input_from_cif(cifFile, inpFile, args.conductor)
+    with Pool(args.processes) as pool:
+        rows = pool.starmap(_structure_gii, [(cifFile, args.conductor) for cifFile in cifFiles], chunksize=1)
 
-                _bvse(input_file=inpFile, output_file=cubeFile, resolution=args.resolution, mode=1, effective_charge=args.effective_charge, no_jit=False)
-            
-            except Exception as e:
-                logging.error(f"The following {type(e)} exception was raised when processing the structure {formula}. The following traceback was produced:")
-                print(e)
-                continue
+    table = pd.DataFrame(rows, columns=["file", "formula", "sites", "gii", "max_deviation", "worst_site", "close_contacts", "deviations", "status", "error"])
+    table["sites"] = table["sites"].astype("Int64")
+    table.to_csv(basePath.joinpath(args.output), index=False)
+    logging.info(f"Global instability index found for {(table['status'] == 'ok').sum()} out of {len(table)} structures")
+
+def _structure_gii(cifFile:Path, conductor:str) -> tuple:
+    """
+        Finds the bond valence sum deviations and global instability index of a single structure, for bulk_gii. Sites
+        closer than 1 Å to a counter-ion are listed as close contacts and left out of the index. Any error is recorded in
+        the returned row rather than raised.
+    """
+
+    formula = None
+
+    try:
+
+        struct, formula = read_structure(cifFile)
+        crystal = BVStructure.from_structure(struct, conductor, formula)
+
+        crystal.define_buffer_area()
+        crystal.find_buffer_sites()
+        deviations = crystal.site_bvs_deviations()
+        closeContacts = ";".join(crystal.sites.index[np.isnan(deviations)])
+        siteDeviations = ";".join(f"{label}:{deviation:.3f}" for label, deviation in zip(crystal.sites.index, deviations))
+
+        if np.isnan(deviations).all():
+            return (cifFile.name, formula, len(crystal.sites), None, None, None, closeContacts, siteDeviations, "ok", None)
+
+        worst = np.nanargmax(np.abs(deviations))
+        return (cifFile.name, formula, len(crystal.sites), crystal.global_instability_index(deviations), deviations[worst], crystal.sites.index[worst], closeContacts, siteDeviations, "ok", None)
+
+    except (Exception, SystemExit) as e:
+        logging.error(f"The following {type(e)} exception was raised when processing the structure {cifFile.name}: {e}")
+        return (cifFile.name, formula, None, None, None, None, None, None, "failed", type(e).__name__)
 
 def render(parser:ArgumentParser, overrideArgs:list = None):
 
@@ -167,9 +782,22 @@ def render(parser:ArgumentParser, overrideArgs:list = None):
 
 
 def data_import(parser:ArgumentParser, overrideArgs:list = None):
+    """
+        Rebuilds a bond valence parameter database from the softBV dat files (or a bond valence cif), without any prompts.
+    """
+
+    parser.add_argument("-b", "--bv_file", default="cif-files/database_binary.dat", help="The file of bond valence parameters, either a softBV dat file or a bond valence cif. Defaults to cif-files/database_binary.dat.")
+    parser.add_argument("-u", "--ion_file", default="cif-files/database_unitary.dat", help="The softBV dat file of ion information. Defaults to cif-files/database_unitary.dat.")
+    parser.add_argument("-o", "--output", default=BVStructure.DB_LOCATION, help=f"The database to rebuild. Defaults to {BVStructure.DB_LOCATION}.")
+    parser.add_argument("-c", "--confirm", action="store_true", help="Toggles whether to ask for confirmation before the database is reset.")
+    args = parser.parse_args(overrideArgs)
 
-    bvDatToDb("cif-files/database_binary.dat", "soft-bv-params.sqlite3")
-    ionDatToDb("cif-files/database_unitary.dat", "soft-bv-params.sqlite3")
+    fileToDb(args.bv_file, args.output, args.confirm)
+
+    if Path(args.ion_file).is_file():
+        ionDatToDb(args.ion_file, args.output)
+    else:
+        logging.warning(f"The ion file {args.ion_file} does not exist, so no ion information has been imported")
 
 def buffer_export(parser:ArgumentParser, overrideArgs:list = None):
     """
@@ -212,7 +840,7 @@ if __name__ == '__main__' and len(sys.argv) > 1:
         globals()[sys.argv[1]](parser)
         logging.info(f"Program Complete - Time Taken: {(datetime.now() - start_time)}")
     except KeyError:
-        print("Invalid Function Entered. Possible options: create_input, bvsm, bvse, site_bvs, bulk_bvse, render, data_import, buffer_export")
+        print("Invalid Function Entered. Possible options: create_input, bvsm, bvsm_sweep, bvse, trajectory, find_sites, migration_path, benchmark, serve, site_bvs, bulk_bvse, bulk_gii, render, data_import, buffer_export")
 
 else:
 
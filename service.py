@@ -0,0 +1,259 @@
+import io, json, logging, os, time
+import numpy as np
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from pathlib import Path
+from urllib import request as urlrequest
+from urllib.error import HTTPError
+from bvStructure import *
+
+class MapService:
+    """
+        A long-lived worker that makes maps on request, so the start-up costs of a run.py call are only paid once. The
+        parameter database is held in memory, every kernel is compiled (or loaded from numba's cache) when the service
+        starts, and prepared structures are kept in memory, so repeated requests for the same structure skip its setup.
+        Structures are identified by their path, modification time and size, and the least recently used are dropped
+        beyond the maximum count. The maps of a structure are released once its job has been answered, so only the
+        prepared sites are kept.
+
+        A job is a dictionary of the same options as the bvse and bvsm commands:
+
+            input_file - The input file of the structure (required) \n
+            output_file - Where to write the map. If missing, the maps are returned as arrays instead \n
+            resolution, mode - As for bvse and bvsm \n
+            effective_charge, conductors, channels - BVSE only \n
+            penalty_constant, penalty_type - BVSM only (only quadratic penalties are supported) \n
+    """
+
+    def __init__(self, dbLocation:str = BVStructure.DB_LOCATION, maxStructures:int = 32):
+        """
+            Loads the parameter database into memory and shares it with every structure made in this process.
+        """
+        self.db = BVDatabase(dbLocation, inMemory=True)
+        BVStructure.SHARED_DB = self.db
+        self.maxStructures = maxStructures
+        self.structures = OrderedDict()
+        self.jobs = 0
+        self.started = time.time()
+
+    def close(self):
+        """
+            Stops sharing the in-memory database, so structures made afterwards open their own connections.
+        """
+        if BVStructure.SHARED_DB is self.db:
+            BVStructure.SHARED_DB = None
+        self.db.conn.close()
+
+    def warm_up(self):
+        """
+            Runs every map kernel once on a tiny grid with the argument types used in real jobs, so that each is compiled
+            or loaded from the cache before the first job arrives. The single site is placed beyond the cutoff.
+        """
+
+        start = time.perf_counter()
+        voxelNos = np.full(3, 2, dtype=int)
+        vectors = np.eye(3)
+        farSite = np.full((1, 7), 100.)
+
+        bvse_map_fused(voxelNos, vectors, 1., 1, BVStructure.SCREENING_FACTOR, farSite[:, :6], farSite, np.zeros(voxelNos))
+        bvsm_map_fused(voxelNos, vectors, 1., 1, 1, farSite[:, :5], farSite[:, :5], np.zeros(voxelNos))
+        bvse_multi_map(voxelNos, vectors, np.ones(1), 1, BVStructure.SCREENING_FACTOR, farSite[:, :3], np.zeros((1, 1, 5)), np.zeros((1, *voxelNos)))
+        bvse_channel_map(voxelNos, vectors, np.ones(1), BVStructure.SCREENING_FACTOR, farSite[:, :3], np.zeros((1, 1, 5)), np.zeros((1, 2, *voxelNos)))
+
+        logging.info(f"Kernels ready in {time.perf_counter() - start:.2f} s")
+
+    def structure(self, inputFile:str, settings:dict) -> BVStructure:
+        """
+            Returns a prepared structure for an input file, from memory if it has been prepared with the same settings
+            since the file last changed.
+        """
+
+        path = Path(inputFile).resolve()
+        stat = path.stat()
+        key = (str(path), stat.st_mtime_ns, stat.st_size, json.dumps(settings, sort_keys=True))
+
+        if key in self.structures:
+            self.structures.move_to_end(key)
+            return self.structures[key]
+
+        crystal = BVStructure.from_file(path, bvse=True, conductors=settings["conductors"])
+        crystal.prepare(lonePairs=settings["lone_pairs"])
+
+        self.structures[key] = crystal
+        while len(self.structures) > self.maxStructures:
+            self.structures.popitem(last=False)
+
+        return crystal
+
+    def run(self, method:str, job:dict) -> dict:
+        """
+            Runs a 'bvse' or 'bvsm' job. Returns a dictionary with the list of paths written under 'paths' if the job has
+            an output file, otherwise the maps under 'maps', keyed by '<conductor>' or '<conductor>-<channel>'.
+        """
+
+        if "input_file" not in job:
+            raise ValueError("A job needs an input_file")
+
+        resolution = float(job.get("resolution", 0.1))
+        mode = int(job.get("mode", 1))
+        outputFile = job.get("output_file")
+        start = time.perf_counter()
+
+        if method == "bvse":
+            conductors = job.get("conductors")
+            channels = bool(job.get("channels", False))
+            settings = {"bvse": True, "lone_pairs": mode > 0 or channels, "conductors": conductors}
+        elif method == "bvsm":
+            if str(job.get("penalty_type", "q")).startswith("l"):
+                raise ValueError("Linear penalty functions are not implemented using JIT, so can not be run by the service")
+            settings = {"bvse": True, "lone_pairs": mode > 0, "conductors": None}
+        else:
+            raise ValueError(f"Unknown job type {method} - bvse and bvsm are supported")
+
+        crystal = self.structure(job["input_file"], settings)
+
+        try:
+            if method == "bvse":
+                maps = self._bvse(crystal, resolution, mode, bool(job.get("effective_charge", False)), bool(conductors), channels)
+            else:
+                crystal.setup_voxels(resolution)
+                crystal.populate_map_bvsm_jit(mode=mode, penalty=float(job.get("penalty_constant", 0.05)))
+                maps = {str(crystal.conductor): (crystal.conductor, None)}
+
+            self.jobs += 1
+            result = {"name": crystal.name, "voxels": crystal.voxelNumbers.tolist(), "seconds": time.perf_counter() - start}
+
+            if outputFile is None:
+                result["maps"] = {name: self._map_array(crystal, conductor, channel) for name, (conductor, channel) in maps.items()}
+            else:
+                result["paths"] = [str(path) for path in self._export(crystal, Path(outputFile), maps, bool(job.get("conductors")))]
+        finally:
+            # Only the prepared sites are kept in memory - the returned arrays are freed once the reply has been sent
+            crystal.release_maps()
+
+        return result
+
+    def _bvse(self, crystal:BVStructure, resolution:float, mode:int, effectiveCharge:bool, multi:bool, channels:bool) -> dict:
+        """
+            Makes the BVSE map(s) of a structure, returning the conductor and channel of each map by name.
+        """
+
+        crystal.setup_voxels(resolution)
+
+        if channels:
+            crystal.populate_map_bvse_channels(effectiveCharge=effectiveCharge)
+            return {f"{conductor}-{channel}": (conductor, channel) for conductor in crystal.conductors for channel in ("total", "bond", "coul")}
+
+        if multi:
+            crystal.populate_map_bvse_multi(mode=mode, effectiveCharge=effectiveCharge)
+            return {str(conductor): (conductor, None) for conductor in crystal.conductors}
+
+        crystal.populate_map_bvse_jit(mode=mode, effectiveCharge=effectiveCharge)
+        return {str(crystal.conductor): (crystal.conductor, None)}
+
+    def _map_array(self, crystal:BVStructure, conductor:Ion, channel:str) -> np.ndarray:
+        if channel is not None:
+            return crystal.channelMaps[conductor][channel]
+        return crystal.conductorMaps[conductor] if crystal.mapSettings["method"] == "bvse-multi" else crystal.map
+
+    def _export(self, crystal:BVStructure, outputPath:Path, maps:dict, multi:bool) -> list:
+        """
+            Exports maps with the same file names as the bvse and bvsm commands.
+        """
+
+        paths = []
+        for conductor, channel in maps.values():
+            path = outputPath.with_stem(f"{outputPath.stem}-{conductor}") if multi else outputPath
+            if channel is not None:
+                path = path.with_stem(f"{path.stem}-{channel}")
+            paths.append(crystal.export_map(path, conductor=None if not multi and channel is None else conductor, channel=channel))
+
+        return paths
+
+    def status(self) -> dict:
+        return {"jobs": self.jobs, "structures": len(self.structures), "uptime": time.time() - self.started, "pid": os.getpid()}
+
+
+class _Handler(BaseHTTPRequestHandler):
+    """
+        Handles requests to the service. Jobs are posted as JSON to /bvse or /bvsm. Jobs with an output file are answered
+        with JSON; jobs without are answered with an npz archive of the maps. Errors are answered with JSON holding an
+        'error' message.
+    """
+
+    def _reply(self, code:int, body:bytes, contentType:str, headers:dict = None):
+        self.send_response(code)
+        self.send_header("Content-Type", contentType)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _reply_json(self, code:int, data:dict):
+        self._reply(code, json.dumps(data).encode(), "application/json")
+
+    def do_GET(self):
+        if self.path == "/status":
+            self._reply_json(200, self.server.service.status())
+        else:
+            self._reply_json(404, {"error": f"Unknown path {self.path}"})
+
+    def do_POST(self):
+
+        method = self.path.strip("/")
+
+        try:
+            job = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+            result = self.server.service.run(method, job)
+        except (ValueError, FileNotFoundError, KeyError) as e:
+            self._reply_json(400, {"error": f"{type(e).__name__}: {e}"})
+            return
+        except (Exception, SystemExit) as e:
+            logging.error(f"The following {type(e)} exception was raised when running a {method} job: {e}")
+            self._reply_json(500, {"error": f"{type(e).__name__}: {e}"})
+            return
+
+        if "maps" in result:
+            buffer = io.BytesIO()
+            np.savez(buffer, **result.pop("maps"))
+            self._reply(200, buffer.getvalue(), "application/octet-stream", {"X-Job": json.dumps(result)})
+        else:
+            self._reply_json(200, result)
+
+    def log_message(self, format:str, *args):
+        logging.info(f"Service request from {self.address_string()} - {format % args}")
+
+
+def create_server(host:str = "127.0.0.1", port:int = 8765, dbLocation:str = BVStructure.DB_LOCATION, maxStructures:int = 32) -> HTTPServer:
+    """
+        Creates the HTTP server for a warmed up map service. Jobs are run one at a time, in the order they arrive. Use
+        port 0 to pick any free port, which can then be read from server.server_address.
+    """
+
+    service = MapService(dbLocation, maxStructures)
+    service.warm_up()
+
+    server = HTTPServer((host, port), _Handler)
+    server.service = service
+    return server
+
+def submit(method:str, job:dict, host:str = "127.0.0.1", port:int = 8765, timeout:float = None) -> dict:
+    """
+        Submits a job to a running service and waits for it to finish. Returns the service's reply as a dictionary, with
+        any returned maps as arrays under 'maps'. Raises an exception holding the service's message if the job failed.
+    """
+
+    call = urlrequest.Request(f"http://{host}:{port}/{method}", data=json.dumps(job).encode(), headers={"Content-Type": "application/json"})
+
+    try:
+        with urlrequest.urlopen(call, timeout=timeout) as response:
+            body = response.read()
+            if response.headers.get_content_type() == "application/json":
+                return json.loads(body)
+            result = json.loads(response.headers["X-Job"])
+            with np.load(io.BytesIO(body)) as maps:
+                result["maps"] = {name: maps[name] for name in maps.files}
+            return result
+    except HTTPError as e:
+        raise Exception(f"The {method} job failed - {json.loads(e.read()).get('error')}")
@@ -0,0 +1,113 @@
+import unittest, tempfile, os
+import numpy as np
+import bvStructure, bvCache, run
+from pathlib import Path
+
+TEST_FILE = "test/betaPbF2-simplified.inp"
+
+class TestPreparationCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tempDir = tempfile.TemporaryDirectory()
+        self.cache = bvCache.PreparationCache(self.tempDir.name)
+
+    def tearDown(self):
+        self.tempDir.cleanup()
+
+    def test_key_depends_on_settings(self):
+        key1 = self.cache.key(TEST_FILE, {"lone_pairs": True})
+        key2 = self.cache.key(TEST_FILE, {"lone_pairs": False})
+        self.assertNotEqual(key1, key2)
+        self.assertEqual(key1, self.cache.key(TEST_FILE, {"lone_pairs": True}))
+
+    def test_missing_entry(self):
+        self.assertIsNone(self.cache.load(self.cache.key(TEST_FILE, {})))
+
+    def test_round_trip(self):
+
+        original = bvStructure.BVStructure.from_file(TEST_FILE, bvse=True)
+        original.prepare(lonePairs=True)
+        original.setup_voxels(0.5)
+        original.populate_map_bvse_jit(mode=1, effectiveCharge=True)
+
+        key = self.cache.key(TEST_FILE, {"lone_pairs": True})
+        self.cache.save(key, original)
+        loaded = self.cache.load(key)
+
+        self.assertEqual(loaded.name, original.name)
+        self.assertEqual(loaded.conductor, original.conductor)
+        self.assertEqual(len(loaded.bufferedSites), len(original.bufferedSites))
+        self.assertDictEqual({str(ion): charge for ion, charge in loaded.chargeList.items()}, {str(ion): charge for ion, charge in original.chargeList.items()})
+        self.assertIn("bvse-1", loaded.siteArrays)
+
+        loaded.setup_voxels(0.5)
+        loaded.populate_map_bvse_jit(mode=1, effectiveCharge=True)
+        self.assertTrue(np.array_equal(loaded.map, original.map))
+
+
+class TestResultCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tempDir = tempfile.TemporaryDirectory()
+        self.cache = bvCache.ResultCache(Path(self.tempDir.name).joinpath("cache"))
+
+    def tearDown(self):
+        self.tempDir.cleanup()
+
+    def _write_maps(self, stem:str, suffixes:list, size:int = 100) -> list:
+        paths = []
+        for suffix in suffixes:
+            path = Path(self.tempDir.name).joinpath(f"{stem}{suffix}.cube")
+            path.write_bytes(bytes(size))
+            paths.append(path)
+        return paths
+
+    def test_missing_entry(self):
+        key = self.cache.key(TEST_FILE, {"resolution": 0.5})
+        self.assertIsNone(self.cache.fetch(key, Path(self.tempDir.name).joinpath("out.cube")))
+        self.assertIsNone(self.cache.name(key))
+
+    def test_fetch_keeps_suffixes(self):
+
+        key = self.cache.key(TEST_FILE, {"conductors": ["F-", "Li+"]})
+        written = self._write_maps("first", ["-F-", "-Li+"])
+        self.cache.store(key, Path(self.tempDir.name).joinpath("first.cube"), {path: path for path in written}, "PbF2")
+
+        fetched = self.cache.fetch(key, Path(self.tempDir.name).joinpath("second.cube"))
+        self.assertListEqual([path.name for path in fetched], ["second-F-.cube", "second-Li+.cube"])
+        self.assertEqual(self.cache.name(key), "PbF2")
+
+    def test_renamed_output(self):
+
+        # The map asked for as first.cube was written to first-0.cube, as first.cube already existed
+        key = self.cache.key(TEST_FILE, {"resolution": 0.5})
+        requested = Path(self.tempDir.name).joinpath("first.cube")
+        written = self._write_maps("first", ["-0"])
+        self.cache.store(key, requested, {requested: written[0]}, "PbF2")
+
+        fetched = self.cache.fetch(key, Path(self.tempDir.name).joinpath("second.cube"))
+        self.assertListEqual([path.name for path in fetched], ["second.cube"])
+
+    def test_linear_penalty_not_cached(self):
+
+        # Linear penalties can only be used without JIT or tiles, so neither writes (or caches) a map
+        cachePath = Path(self.tempDir.name).joinpath("cache")
+        for processes in (None, 1):
+            outputFile = Path(self.tempDir.name).joinpath(f"linear-{processes}.grd")
+            run._bvsm(TEST_FILE, str(outputFile), 0.5, 1, False, 0.05, "l", processes=processes, result_cache=str(cachePath))
+            self.assertFalse(outputFile.exists())
+        self.assertListEqual(list(cachePath.rglob("*.grd")), [])
+
+    def test_eviction(self):
+
+        self.cache.maxBytes = 2500
+        keys = [self.cache.key(TEST_FILE, {"resolution": i}) for i in range(3)]
+
+        for i, key in enumerate(keys):
+            self.cache.store(key, Path(self.tempDir.name).joinpath(f"map{i}.cube"), {path: path for path in self._write_maps(f"map{i}", [""], size=1000)}, "PbF2")
+            # Give each entry a distinct last use time
+            os.utime(self.cache.cacheDir.joinpath(key), (i, i))
+
+        self.assertLessEqual(self.cache.size(), self.cache.maxBytes)
+        self.assertIsNone(self.cache.name(keys[0]))
+        self.assertEqual(self.cache.name(keys[2]), "PbF2")
@@ -0,0 +1,119 @@
+import unittest, tempfile, shutil, sqlite3
+import numpy as np
+import fileIO
+from fileIO import Ion
+from pathlib import Path
+
+DB_FILE = "soft-bv-params.sqlite3"
+
+class TestBVDatabase(unittest.TestCase):
+
+    def setUp(self):
+        self.db = fileIO.BVDatabase(DB_FILE, readOnly=True, immutable=True)
+
+    def tearDown(self):
+        self.db.conn.close()
+
+    def test_many_matches_single(self):
+
+        conductor = Ion("F", -1)
+        pairs = [(conductor, Ion(element, os)) for element, os in (("Pb", 2), ("Sn", 2), ("Na", 1), ("Cl", -1))]
+
+        for bvse in (True, False):
+            many = self.db.get_bv_params_many(pairs, bvse=bvse)
+            self.assertEqual(len(many), len(pairs))
+            for pair in pairs:
+                self.assertEqual(many[pair], self.db.get_bv_params(*pair, bvse=bvse))
+
+    def test_known_params(self):
+
+        # Values found by the original query of a single pair
+        expected = {
+            ("Pb", 2): (1.90916, 2.2075055, 2.4544862, 0.3475423, 1.66, 1.26),
+            ("Sn", 2): (1.80141, 2.1413276, 2.2754347, 0.4364474, 1.4, 1.26),
+            ("Na", 1): (1.42885, 2.1097046, 2.2752156, 0.2902625, 1.66, 1.26)
+        }
+
+        params = self.db.get_bv_params_many([(Ion("F", -1), Ion(*ion)) for ion in expected], bvse=True)
+        for ion, values in expected.items():
+            found = params[(Ion("F", -1), Ion(*ion))]
+            self.assertTrue(np.allclose((found.r0, found.ib, found.rmin, found.d0, found.i1r, found.i2r), values))
+
+        repelling = self.db.get_bv_params(Ion("F", -1), Ion("Cl", -1), bvse=True)
+        self.assertEqual((repelling.i1r, repelling.i2r), (1.26, 1.74))
+        self.assertIsNone(self.db.get_bv_params(Ion("F", -1), Ion("Cl", -1)))
+
+    def test_repelling_radii_without_softbv_columns(self):
+        db = fileIO.BVDatabase("brown-bv-params.sqlite3", readOnly=True, immutable=True)
+        params = db.get_bv_params(Ion("F", -1), Ion("Cl", -1), bvse=True)
+        self.assertEqual((params.i1r, params.i2r), (db.get_radius(Ion("F", -1)), db.get_radius(Ion("Cl", -1))))
+        db.conn.close()
+
+    def test_missing_pair(self):
+        with self.assertRaises(Exception):
+            self.db.get_bv_params_many([(Ion("F", -1), Ion("Pb", 7))])
+
+    def test_read_only(self):
+        with self.assertRaises(sqlite3.OperationalError):
+            self.db.execute("INSERT INTO Ion (symbol, os) VALUES (?,?)", ("Xx", 1))
+
+    def test_indexes(self):
+
+        with tempfile.TemporaryDirectory() as tempDir:
+            dbCopy = Path(tempDir).joinpath("copy.sqlite3")
+            shutil.copyfile(DB_FILE, dbCopy)
+
+            db = fileIO.BVDatabase(dbCopy)
+            db.execute("DROP INDEX ion_symbol_os")
+            db.create_indexes()
+            db.execute("SELECT name FROM sqlite_master WHERE type = 'index' AND name NOT LIKE 'sqlite_%'")
+            self.assertSetEqual({name for (name,) in db.fetch_all()}, {"ion_symbol_os", "bvparam_ions"})
+            db.close()
+
+
+class TestImport(unittest.TestCase):
+
+    BV_DAT = "softBV parameters\nDATA_START\nPb 2 F -1 2.03 0.37 8.0 6.5\nSn 2 F -1 1.925 0.37 6.0 6.0\nPb 2 F -1 9.99 0.5 1.0 1.0\nDATA_END\n"
+    ION_DAT = "DATA_START\n82 Pb 2 0 0 6 14 1 1.75 0.2\n9 F -1 0 0 2 17 1 1.19 0.3\n29 Cu 2 0 0 4 11 2 1.28 0.1\nDATA_END\n"
+    BV_CIF = "data_bv\nloop_\n_valence_param_atom_1\n_valence_param_atom_1_valence\n_valence_param_atom_2\n_valence_param_atom_2_valence\n_valence_param_Ro\n_valence_param_B\nPb 2 F -1 2.03 0.37\nSn 2 F -1 1.925 0.37\n"
+
+    def setUp(self):
+        self.tempDir = tempfile.TemporaryDirectory()
+        self.path = Path(self.tempDir.name)
+        self.dbFile = str(self.path.joinpath("params.sqlite3"))
+
+    def tearDown(self):
+        self.tempDir.cleanup()
+
+    def _write(self, name:str, contents:str) -> str:
+        path = self.path.joinpath(name)
+        path.write_text(contents)
+        return str(path)
+
+    def test_dat_import(self):
+
+        fileIO.bvDatToDb(self._write("binary.dat", self.BV_DAT), self.dbFile)
+        fileIO.ionDatToDb(self._write("unitary.dat", self.ION_DAT), self.dbFile)
+
+        db = fileIO.BVDatabase(self.dbFile, readOnly=True)
+        params = db.get_bv_params(Ion("Pb", 2), Ion("F", -1), bvse=True)
+
+        # Only the first parameters for a pair are kept
+        self.assertAlmostEqual(params.r0, 2.03)
+        self.assertAlmostEqual(params.r_cutoff, 6.5)
+        self.assertAlmostEqual(params.i1r, 1.75)
+        self.assertEqual(db.get_period(Ion("Cu", 2)), 4)
+
+        db.execute("SELECT COUNT(*) FROM BVParam")
+        self.assertEqual(db.fetch_one(), 2)
+        db.conn.close()
+
+    def test_cif_import(self):
+
+        fileIO.cifToDb(self._write("bv.cif", self.BV_CIF), self.dbFile)
+
+        db = fileIO.BVDatabase(self.dbFile, readOnly=True)
+        params = db.get_bv_params(Ion("Sn", 2), Ion("F", -1))
+        self.assertAlmostEqual(params.r0, 1.925)
+        self.assertAlmostEqual(params.ib, 1/0.37)
+        db.conn.close()
@@ -0,0 +1,633 @@
+import unittest, tempfile, json, filecmp, math, shutil, subprocess, sys
+import numpy as np
+import pandas as pd
+import pymatgen.core as pmg
+from pymatgen.io.cif import CifWriter
+import bvStructure
+from fileIO import Ion, MissingParameterError
+from pathlib import Path
+
+TEST_FILE = "test/betaPbF2-simplified.inp"
+
+class TestMultiConductorMaps(unittest.TestCase):
+
+    def setUp(self):
+        self.conductors = ["F-", "Na+", "Li+"]
+        self.obj = bvStructure.BVStructure.from_file(TEST_FILE, bvse=True, conductors=self.conductors)
+        self.obj.initalise_map(0.5)
+
+    def test_conductors(self):
+        self.assertEqual(len(self.obj.conductors), 3)
+        self.assertEqual(self.obj.conductor, Ion("F", -1))
+        self.assertAlmostEqual(self.obj.rCutoff, max(self.obj.conductorCutoffs.values()))
+
+    def test_multi_matches_single(self):
+
+        self.obj.populate_map_bvse_multi(mode=0, effectiveCharge=False)
+
+        for conductor in self.conductors:
+            single = bvStructure.BVStructure.from_file(TEST_FILE, bvse=True, conductors=[conductor])
+            single.initalise_map(0.5)
+            single.populate_map_bvse_jit(mode=0, effectiveCharge=False)
+            self.assertTrue(np.allclose(single.map, self.obj.conductorMaps[Ion.from_string(conductor)]))
+
+    def _lone_pair_structure(self, conductors:list, lonePairs:bool = True) -> bvStructure.BVStructure:
+        # A lead site is moved off its symmetric position, so it is given lone pairs. Every site is also moved off the
+        # voxel grid, where the Coulombic energy of the cation conductors is singular.
+        crystal = bvStructure.BVStructure.from_file(TEST_FILE, bvse=True, conductors=conductors)
+        shift = np.array((0.013, 0.021, 0.034)) @ crystal.vectors
+        crystal.sites["coords"] = [coords + shift for coords in crystal.sites["coords"]]
+        crystal.sites.at["Pb1-0", "coords"] = crystal.sites.at["Pb1-0", "coords"] + np.array((0.6, 0.3, 0.))
+        crystal.initalise_map(0.5)
+        if lonePairs:
+            crystal.create_lone_pairs()
+        return crystal
+
+    def test_multi_matches_single_with_lone_pairs(self):
+
+        multi = self._lone_pair_structure(self.conductors)
+        self.assertTrue(any(ion.element == "LP" for ion in multi.bufferedSites["ion"]))
+
+        # Lone pairs only repel anion conductors, and the single conductor kernel can not be given them for a cation
+        singles = {conductor: self._lone_pair_structure([conductor], Ion.from_string(conductor).ox_state < 0) for conductor in self.conductors}
+
+        for mode in (1, 2):
+            for effectiveCharge in (True, False):
+                multi.populate_map_bvse_multi(mode=mode, effectiveCharge=effectiveCharge)
+                for conductor, single in singles.items():
+                    single.reset_map()
+                    single.populate_map_bvse_jit(mode=mode, effectiveCharge=effectiveCharge)
+                    self.assertTrue(np.allclose(single.map, multi.conductorMaps[Ion.from_string(conductor)]), f"{conductor}, mode {mode}, effective charge {effectiveCharge}")
+
+
+class TestChannelMaps(unittest.TestCase):
+
+    def setUp(self):
+        self.obj = bvStructure.BVStructure.from_file(TEST_FILE, bvse=True)
+        self.obj.initalise_map(0.5)
+        self.obj.create_lone_pairs()
+        self.obj.populate_map_bvse_channels(effectiveCharge=True)
+
+    def test_channels_match_modes(self):
+
+        channels = self.obj.channelMaps[self.obj.conductor]
+
+        for mode, channel in ((0, "bond"), (1, "total"), (2, "coul")):
+            self.obj.reset_map()
+            self.obj.populate_map_bvse_jit(mode=mode, effectiveCharge=True)
+            self.assertTrue(np.allclose(self.obj.map, channels[channel]))
+
+
+class TestPenaltySweep(unittest.TestCase):
+
+    def setUp(self):
+        # With a cation conductor the lead sites have the same sign, so the penalty field is not zero. The sites are moved off the
+        # voxel grid, where the penalty function is singular.
+        crystal = bvStructure.BVStructure.from_file(TEST_FILE, bvse=True)
+        species = [f"{ion.element}{abs(ion.ox_state)}{'+' if ion.ox_state > 0 else '-'}" for ion in crystal.sites["ion"]]
+        fracCoords = np.stack(crystal.sites["coords"].to_numpy()) @ crystal.inverseVectors + (0.013, 0.021, 0.034)
+
+        self.obj = bvStructure.BVStructure.from_structure(pmg.Structure(pmg.Lattice(crystal.vectors), species, fracCoords), "Na+", "shifted", bvse=True)
+        self.obj.initalise_map(0.5)
+        self.obj.populate_bvsm_fields()
+
+    def test_penalty_field(self):
+        self.assertGreater(np.abs(self.obj.penaltyField).max(), 0)
+
+    def test_sweep_matches_bvsm(self):
+
+        for mode in (0, 1, 2):
+            for penalty in (0.01, 0.05, 0.2):
+                self.obj.reset_map()
+                self.obj.populate_map_bvsm_jit(mode=mode, penalty=penalty)
+                self.assertTrue(np.allclose(self.obj.map, self.obj.penalty_sweep_map(penalty, mode)))
+
+    def test_sweep_linear_in_penalty(self):
+        self.assertTrue(np.allclose(self.obj.penalty_sweep_map(0.2, 1) - self.obj.penalty_sweep_map(0.1, 1), 0.1 * self.obj.penaltyField))
+        self.assertTrue(np.allclose(self.obj.penalty_sweep_map(0.2, 2), 2 * self.obj.penalty_sweep_map(0.1, 2)))
+
+    def test_sweep_stats(self):
+        stats = self.obj.penalty_sweep([0.01, 0.05, 0.1])
+        self.assertEqual(len(stats), 3)
+        self.assertTrue((stats["min"] <= stats["max"]).all())
+        self.assertEqual(len(set(stats["mean"])), 3)
+
+
+class TestFusedKernels(unittest.TestCase):
+
+    def setUp(self):
+        self.obj = bvStructure.BVStructure.from_file(TEST_FILE, bvse=True)
+        self.obj.prepare()
+        self.obj.setup_voxels(0.4)
+        self.selectedSites = self.obj.bufferedSites[self.obj.bufferedSites["ion"] != self.obj.conductor]
+        self.args = (self.obj.voxelNumbers, self.obj.vectors, self.obj.rCutoff)
+
+    def test_bvse_matches_reference(self):
+
+        bondIons, coulIons = self.obj._create_bond_site_array(self.selectedSites), self.obj._create_coul_site_array(self.selectedSites, True)
+
+        for mode in range(3):
+            reference = bvStructure.bvse_map(*self.args, mode, self.obj.SCREENING_FACTOR, bondIons, coulIons, np.zeros(self.obj.voxelNumbers))
+            fused = bvStructure.bvse_map_fused(*self.args, mode, self.obj.SCREENING_FACTOR, bondIons, coulIons, np.zeros(self.obj.voxelNumbers))
+            self.assertTrue(np.allclose(reference, fused, rtol=1e-12, atol=0))
+
+    def test_grouped_matches_reference(self):
+
+        bondIons = self.obj._create_bond_site_array(self.selectedSites)
+        # Half occupied sites give a second bond group, and dummy sites of the conductor's sign give two Coulombic groups
+        bondIons[::2, 3] *= 0.5
+        coulIons = np.array([[1.1, 1.2, 1.3, -1, -2, 1.3, 1.0], [2.1, 2.2, 2.3, -1, -1, 1.3, 1.0], [0.4, 3.1, 1.7, -1, -2, 1.3, 1.0]])
+
+        coords, offsets, params = bvStructure.group_site_array(bondIons, 3)
+        self.assertEqual(len(params), 2)
+        self.assertTrue((np.diff(coords[2][offsets[0]:offsets[1]]) >= 0).all())
+
+        for mode in range(3):
+            reference = bvStructure.bvse_map(*self.args, mode, self.obj.SCREENING_FACTOR, bondIons, coulIons, np.zeros(self.obj.voxelNumbers))
+            grouped = bvStructure.bvse_map_grouped(*self.args, mode, self.obj.SCREENING_FACTOR, coords, offsets, params, *bvStructure.group_site_array(coulIons, 4), np.zeros(self.obj.voxelNumbers))
+            self.assertTrue(np.allclose(reference, grouped, rtol=1e-12, atol=1e-12))
+
+    def test_grouped_method(self):
+
+        self.obj.populate_map_bvse_jit(mode=1)
+        reference = self.obj.map.copy()
+        self.obj.populate_map_bvse_grouped(mode=1)
+        self.assertTrue(np.allclose(reference, self.obj.map, rtol=1e-12, atol=1e-12))
+
+    def test_bvsm_matches_reference(self):
+
+        # A dummy site of the same sign as the conductor, so the penalty is included
+        bvIons = self.obj._create_bv_array(self.selectedSites)
+        penIons = np.array([[1.1, 1.2, 1.3, self.obj.LONE_PAIR_CHARGE, 0.05]])
+
+        for mode in range(3):
+            reference = bvStructure.bvsm_map(*self.args, self.obj.conductor.ox_state, mode, bvIons, penIons, np.zeros(self.obj.voxelNumbers))
+            fused = bvStructure.bvsm_map_fused(*self.args, self.obj.conductor.ox_state, mode, bvIons, penIons, np.zeros(self.obj.voxelNumbers))
+            self.assertTrue(np.allclose(reference, fused, rtol=1e-12, atol=0))
+
+    def test_bvsm_without_penalty_sites(self):
+        self.obj.populate_map_bvsm_jit(mode=1)
+        self.assertTrue(np.isfinite(self.obj.map).all())
+
+    def test_scatter_matches_fused(self):
+
+        bondIons, coulIons = self.obj._create_bond_site_array(self.selectedSites), self.obj._create_coul_site_array(self.selectedSites, True)
+        bvIons = self.obj._create_bv_array(self.selectedSites)
+        penIons = np.array([[1.1, 1.2, 1.3, self.obj.LONE_PAIR_CHARGE, 0.05]])
+
+        # Each voxel receives the sites in the same order as the voxel-centric kernels, so the maps are identical
+        for mode in range(3):
+            fused = bvStructure.bvse_map_fused(*self.args, mode, self.obj.SCREENING_FACTOR, bondIons, coulIons, np.zeros(self.obj.voxelNumbers))
+            scatter = bvStructure.bvse_map_scatter(*self.args, mode, self.obj.SCREENING_FACTOR, bondIons, coulIons, np.zeros(self.obj.voxelNumbers))
+            self.assertTrue(np.array_equal(fused, scatter))
+
+            fused = bvStructure.bvsm_map_fused(*self.args, self.obj.conductor.ox_state, mode, bvIons, penIons, np.zeros(self.obj.voxelNumbers))
+            scatter = bvStructure.bvsm_map_scatter(*self.args, self.obj.conductor.ox_state, mode, bvIons, penIons, np.zeros(self.obj.voxelNumbers))
+            self.assertTrue(np.array_equal(fused, scatter))
+
+    def test_scatter_stencil_covers_cutoff(self):
+
+        # A skewed cell, with sites spread through one voxel cell
+        voxelNos = np.array((12, 16, 20))
+        vectors = np.array([[5., 0., 0.], [1.5, 6., 0.], [-1., 2., 7.]])
+        cutoff = 3.
+        stencil = bvStructure.scatter_stencil(voxelNos, vectors, cutoff)
+        offsets = {(row[0], row[1], dl) for row in stencil for dl in range(row[2], row[3] + 1)}
+
+        grid = np.stack(np.meshgrid(*[np.arange(-n, 2*n) for n in voxelNos], indexing="ij"), axis=-1).reshape(-1, 3)
+        positions = (grid / voxelNos) @ vectors
+        for fraction in np.random.default_rng(1).random((20, 3)):
+            site = ((np.array((3, 4, 5)) + fraction) / voxelNos) @ vectors
+            inside = grid[np.sum((positions - site)**2, axis=1) <= cutoff**2] - (3, 4, 5)
+            self.assertTrue({tuple(offset) for offset in inside} <= offsets)
+
+    def test_scatter_method(self):
+
+        self.obj.populate_map_bvse_jit(mode=1)
+        reference = self.obj.map.copy()
+        self.obj.populate_map_bvse_scatter(mode=1)
+        self.assertTrue(np.array_equal(reference, self.obj.map))
+
+        self.obj.populate_map_bvsm_jit(mode=1)
+        reference = self.obj.map.copy()
+        self.obj.populate_map_bvsm_scatter(mode=1)
+        self.assertTrue(np.array_equal(reference, self.obj.map))
+
+
+class TestMapPyramid(unittest.TestCase):
+
+    def setUp(self):
+        # 36 voxels per axis, which 8 does not divide
+        self.obj = bvStructure.BVStructure.from_file(TEST_FILE, bvse=True)
+        self.obj.initalise_map(0.2)
+        self.obj.populate_map_bvse_jit(mode=1)
+
+    def test_full_map_unchanged(self):
+
+        with tempfile.TemporaryDirectory() as tempDir:
+            for suffix in (".cube", ".grd"):
+                plain = self.obj.export_map(Path(tempDir).joinpath(f"plain{suffix}"))
+                full = self.obj.export_map(Path(tempDir).joinpath(f"pyramid{suffix}"), pyramid=True)
+                self.assertTrue(filecmp.cmp(plain, full, shallow=False))
+
+    def test_levels_hold_block_minima(self):
+
+        from mapAnalysis import VoxelMap
+
+        with tempfile.TemporaryDirectory() as tempDir:
+            path = self.obj.export_map(Path(tempDir).joinpath("map.cube"), pyramid=True)
+            with open(path.with_name("map-pyramid.json")) as f:
+                levels = json.load(f)["levels"]
+
+            self.assertListEqual([level["factor"] for level in levels], [12, 4, 2, 1])
+
+            n = self.obj.voxelNumbers
+            for level in levels:
+                factor = level["factor"]
+                expected = np.array([[[self.obj.map[h:h+factor, k:k+factor, l:l+factor].min() for l in range(0, n[2], factor)] for k in range(0, n[1], factor)] for h in range(0, n[0], factor)])
+                values = VoxelMap.from_file(path.with_name(level["file"])).values
+                self.assertListEqual(list(values.shape), level["voxels"])
+                self.assertTrue(np.allclose(values, expected))
+
+    def test_level_positions_match_blocks(self):
+
+        from mapAnalysis import VoxelMap
+
+        with tempfile.TemporaryDirectory() as tempDir:
+            path = self.obj.export_map(Path(tempDir).joinpath("map.grd"))
+            full = VoxelMap.from_file(path)
+            paths = self.obj.export_pyramid(Path(tempDir).joinpath("pyramid.grd"), self.obj.conductor, self.obj.map, factors=(2, 4, 8))
+
+            # The 8x level is left out, as its voxels could not lie at the start of their blocks
+            self.assertListEqual([levelPath.name for levelPath in paths[1:]], ["pyramid-4x.grd", "pyramid-2x.grd", "pyramid.grd"])
+
+            for levelPath, factor in zip(paths[1:], (4, 2, 1)):
+                level = VoxelMap.from_file(levelPath)
+                indices = np.indices(level.voxelNumbers).reshape(3, -1).T
+                self.assertTrue(np.allclose(level.cart_coords(level.frac_coords(indices)), full.cart_coords(full.frac_coords(indices * factor))))
+
+
+class TestCoreMask(unittest.TestCase):
+
+    def setUp(self):
+        self.obj = bvStructure.BVStructure.from_file(TEST_FILE, bvse=True)
+        self.obj.initalise_map(0.25)
+        self.obj.populate_map_bvse_jit(mode=1)
+        self.reference = self.obj.map.copy()
+
+    def test_mask_matches_brute_force(self):
+
+        mask = self.obj.create_core_mask(1.)
+
+        grid = np.stack(np.meshgrid(*[np.arange(n) / n for n in self.obj.voxelNumbers], indexing="ij"), axis=-1).reshape(-1, 3)
+        images = np.stack(np.meshgrid(*[np.arange(-1, 2)] * 3, indexing="ij"), axis=-1).reshape(-1, 3)
+        expected = np.zeros(len(grid), dtype=bool)
+        for site in self.obj.sites[self.obj.sites["ion"] != self.obj.conductor].itertuples():
+            fracSite = np.array(site.coords) @ self.obj.inverseVectors
+            delta = (grid - fracSite) % 1
+            distances = np.linalg.norm((delta[:, None, :] + images[None, :, :]) @ self.obj.vectors, axis=-1).min(axis=1)
+            expected |= distances <= 1.
+
+        self.assertTrue(0 < mask.sum() < mask.size)
+        self.assertTrue(np.array_equal(mask.reshape(-1), expected))
+
+    def test_masked_maps(self):
+
+        mask = self.obj.create_core_mask(1.)
+
+        for populate in (self.obj.populate_map_bvse_jit, self.obj.populate_map_bvse_grouped, self.obj.populate_map_bvse_scatter):
+            populate(mode=1)
+            self.assertTrue(np.allclose(self.obj.map[~mask], self.reference[~mask]))
+            self.assertTrue(np.all(self.obj.map[mask] == self.obj.CORE_SENTINEL))
+
+    def test_mask_follows_site_updates(self):
+
+        self.obj.create_core_mask(1.)
+        self.obj.populate_map_bvse_jit(mode=1)
+        self.obj.modify_site("Pb1-1", coords=self.obj.sites.loc["Pb1-1", "coords"] + (0.4, 0.3, 0.2))
+        self.obj.remove_site("F1-0")
+
+        expected = bvStructure.BVStructure.from_file(TEST_FILE, bvse=True)
+        expected.initalise_map(0.25)
+        expected.modify_site("Pb1-1", coords=expected.sites.loc["Pb1-1", "coords"] + (0.4, 0.3, 0.2))
+        expected.remove_site("F1-0")
+        mask = expected.create_core_mask(1.)
+        expected.populate_map_bvse_jit(mode=1)
+
+        self.assertTrue(np.array_equal(self.obj.coreMask, mask))
+        self.assertTrue(np.allclose(self.obj.map, expected.map))
+
+    def test_mask_cleared(self):
+        self.obj.create_core_mask()
+        self.obj.setup_voxels(0.25)
+        self.assertIsNone(self.obj.coreMask)
+
+
+class TestFFTEngine(unittest.TestCase):
+
+    def setUp(self):
+        # Sites moved off the voxel grid, with a cation conductor so every term has sites
+        crystal = bvStructure.BVStructure.from_file(TEST_FILE, bvse=True)
+        species = [f"{ion.element}{abs(ion.ox_state)}{'+' if ion.ox_state > 0 else '-'}" for ion in crystal.sites["ion"]]
+        fracCoords = np.stack(crystal.sites["coords"].to_numpy()) @ crystal.inverseVectors + (0.013, 0.021, 0.034)
+
+        self.obj = bvStructure.BVStructure.from_structure(pmg.Structure(pmg.Lattice(crystal.vectors), species, fracCoords), "Na+", "shifted", bvse=True)
+        self.obj.prepare()
+        self.obj.setup_voxels(0.2)
+        self.outside = ~self.obj.create_core_mask(1.5)
+        self.obj.coreMask = None
+
+    def test_deposit_interpolates(self):
+
+        voxelNos = np.array((6, 8, 10))
+        fracCoords = np.array([[0.13, 0.52, 0.97], [0.5, 0.25, 0.]])
+        density = bvStructure.deposit_sites(voxelNos, fracCoords)
+        self.assertAlmostEqual(density.sum(), 2.)
+
+        # A site on a voxel puts all of its weight there, and a cubic is interpolated exactly
+        self.assertAlmostEqual(bvStructure.deposit_sites(voxelNos, fracCoords[1:])[3, 2, 0], 1.)
+        values = np.fromfunction(lambda h, k, l: h**3 - 2*k**2 + l, (voxelNos[0], voxelNos[1], voxelNos[2]))
+        single = bvStructure.deposit_sites(voxelNos, np.array([[0.4, 0.4, 0.4]]))
+        self.assertAlmostEqual(np.sum(single * values), 2.4**3 - 2*3.2**2 + 4.)
+
+    def test_cell_sites(self):
+        selectedSites = self.obj.bufferedSites[self.obj.bufferedSites["ion"] != self.obj.conductor]
+        cellSites = bvStructure.cell_site_array(self.obj._create_bond_site_array(selectedSites), self.obj.inverseVectors)
+        self.assertEqual(len(cellSites), np.sum([ion.ox_state < 0 for ion in self.obj.sites["ion"]]))
+
+    def test_matches_reference_away_from_sites(self):
+
+        for mode in range(3):
+            self.obj.populate_map_bvse_jit(mode=mode, effectiveCharge=False)
+            reference = self.obj.map.copy()
+            self.obj.populate_map_bvse_fft(mode=mode, effectiveCharge=False)
+            self.assertLess(np.abs(self.obj.map - reference)[self.outside].max(), 0.05)
+
+            self.obj.populate_map_bvsm_jit(mode=mode)
+            reference = self.obj.map.copy()
+            self.obj.populate_map_bvsm_fft(mode=mode)
+            self.assertLess(np.abs(self.obj.map - reference)[self.outside].max(), 0.005)
+
+
+class TestIncrementalUpdates(unittest.TestCase):
+
+    def setUp(self):
+        self.obj = bvStructure.BVStructure.from_file(TEST_FILE, bvse=True)
+        self.obj.prepare()
+        self.obj.setup_voxels(0.5)
+        self.obj.populate_map_bvse_jit(mode=1, effectiveCharge=False)
+
+    def assert_matches_full_map(self):
+        incremental = self.obj.map.copy()
+        self.obj.populate_map_bvse_jit(mode=1, effectiveCharge=False)
+        self.assertTrue(np.allclose(incremental, self.obj.map))
+
+    def test_remove_site(self):
+        self.obj.remove_site("Pb1-1")
+        self.assertNotIn("Pb1-1", self.obj.sites.index)
+        self.assert_matches_full_map()
+
+    def test_add_site(self):
+        self.obj.add_site("Pb1-2", "Pb1", Ion("Pb", 2), np.array([1.0, 2.0, 3.0]))
+        self.assert_matches_full_map()
+
+    def test_modify_site(self):
+        self.obj.modify_site("Pb1-0", ion=Ion("Pb", 4), coords=np.array([0.1, 0.2, 0.3]))
+        self.assertEqual(self.obj.sites.loc["Pb1-0", "ox_state"], 4)
+        self.assert_matches_full_map()
+
+    def test_modify_site_effective_charge(self):
+        self.obj.populate_map_bvse_jit(mode=1, effectiveCharge=True)
+        self.obj.modify_site("Pb1-0", coords=np.array([0.1, 0.2, 0.3]))
+        incremental = self.obj.map.copy()
+        self.obj.populate_map_bvse_jit(mode=1, effectiveCharge=True)
+        self.assertTrue(np.allclose(incremental, self.obj.map))
+
+    def test_move_lone_pair(self):
+        # The lead site is moved off its symmetric position, so it is given lone pairs
+        self.obj.sites.at["Pb1-0", "coords"] = self.obj.sites.at["Pb1-0", "coords"] + np.array((0.6, 0.3, 0.))
+        self.obj.initalise_map(0.5)
+        self.obj.create_lone_pairs()
+        self.obj.populate_map_bvse_jit(mode=1, effectiveCharge=True)
+        before = self.obj.map.copy()
+        with self.assertLogs(level="INFO") as logs:
+            self.obj.move_lone_pair("Pb1-0", np.array((0., 0., 1.)), 0.8)
+        self.assertIn("Moved the lone pairs of Pb1-0", "\n".join(logs.output))
+        incremental = self.obj.map.copy()
+        self.assertFalse(np.allclose(before, incremental))
+        self.obj.populate_map_bvse_jit(mode=1, effectiveCharge=True)
+        self.assertTrue(np.allclose(incremental, self.obj.map))
+
+    def test_remove_site_changes_effective_charges(self):
+
+        def na_structure(path:str) -> bvStructure.BVStructure:
+            # The sites are moved off the voxel grid, where the Coulombic energy of a cation conductor is singular
+            crystal = bvStructure.BVStructure.from_file(path, bvse=True, conductors=["Na+"])
+            shift = np.array((0.013, 0.021, 0.034)) @ crystal.vectors
+            crystal.sites["coords"] = [coords + shift for coords in crystal.sites["coords"]]
+            crystal.prepare()
+            crystal.setup_voxels(0.5)
+            return crystal
+
+        edited = na_structure(TEST_FILE)
+        edited.populate_map_bvse_jit(mode=1, effectiveCharge=True)
+        edited.remove_site("F1-1")
+
+        with tempfile.TemporaryDirectory() as tempDir:
+            path = Path(tempDir).joinpath("vacancy.inp")
+            path.write_text("".join(line for line in open(TEST_FILE).readlines() if "F1-1" not in line))
+            fresh = na_structure(str(path))
+
+        self.assertEqual(edited.chargeList.keys(), fresh.chargeList.keys())
+        for ion, charge in fresh.chargeList.items():
+            self.assertAlmostEqual(edited.chargeList[ion], charge)
+        fresh.populate_map_bvse_jit(mode=1, effectiveCharge=True)
+        self.assertTrue(np.allclose(edited.map, fresh.map))
+
+    def test_other_maps_not_updated(self):
+        self.obj.populate_map_bvsm_jit(mode=0)
+        self.obj.remove_site("Pb1-1")
+        self.assertIsNone(self.obj.mapSettings)
+
+
+class TestAllSiteBVS(unittest.TestCase):
+
+    def setUp(self):
+        self.obj = bvStructure.BVStructure.from_file(TEST_FILE)
+        self.obj.define_buffer_area()
+        self.obj.find_buffer_sites()
+
+    def test_matches_find_site_bvs(self):
+
+        scalarSums, vectorSums = self.obj.all_site_bvs()
+
+        for i, label in enumerate(self.obj.sites.index):
+            self.assertAlmostEqual(scalarSums[i], self.obj.find_site_bvs(label, vector=False))
+            self.assertTrue(np.allclose(vectorSums[i], self.obj.find_site_bvs(label, vector=True)))
+
+    def test_selected_sites(self):
+
+        scalarSums, vectorSums = self.obj.all_site_bvs()
+        selectedScalar, selectedVector = self.obj.all_site_bvs(self.obj.sites.iloc[[1, 2]])
+        self.assertTrue(np.allclose(selectedScalar, scalarSums[[1, 2]]))
+        self.assertTrue(np.allclose(selectedVector, vectorSums[[1, 2]]))
+
+    def test_lone_pairs_ignore_missing_parameters_of_other_sites(self):
+
+        getParam = self.obj.get_bv_param
+
+        # Parameters are missing for the fluorine sites only, which can not have lone pairs
+        def missing_for_fluorine(fixedIon, targetIon):
+            if targetIon == Ion("F", -1):
+                raise MissingParameterError(f"No parameters for {targetIon}")
+            return getParam(fixedIon, targetIon)
+
+        self.obj.get_bv_param = missing_for_fluorine
+        with self.assertRaises(MissingParameterError):
+            self.obj.all_site_bvs()
+
+        self.obj.create_lone_pairs()
+        self.assertTrue(self.obj.sites["lp"].any())
+
+
+class TestInstabilityIndex(unittest.TestCase):
+
+    A = 5.9306
+
+    def _fluorite(self, extraSites:list = None) -> bvStructure.BVStructure:
+        if extraSites is None:
+            extraSites = []
+        struct = pmg.Structure.from_spacegroup("Fm-3m", pmg.Lattice.cubic(self.A), ["Pb2+", "F-"], [[0, 0, 0], [0.25, 0.25, 0.25]])
+        for species, fracCoords in extraSites:
+            struct.append(species, fracCoords)
+        crystal = bvStructure.BVStructure.from_structure(struct, "F-", "PbF2")
+        crystal.define_buffer_area()
+        crystal.find_buffer_sites()
+        return crystal
+
+    def test_matches_hand_calculation(self):
+
+        # Within the 6 Å cutoff, each Pb has 8 F at a√3/4 and 24 at a√11/4, and each F has half as many Pb
+        r0, ib = 1.90916, 2.2075055187637966
+        s1, s2 = math.exp((r0 - self.A * math.sqrt(3) / 4) * ib), math.exp((r0 - self.A * math.sqrt(11) / 4) * ib)
+        leadDeviation, fluorineDeviation = 8*s1 + 24*s2 - 2, 4*s1 + 12*s2 - 1
+
+        crystal = self._fluorite()
+        self.assertAlmostEqual(crystal.rCutoff, 6.)
+        self.assertAlmostEqual(crystal.global_instability_index(), math.sqrt((4 * leadDeviation**2 + 8 * fluorineDeviation**2) / 12))
+
+    def test_close_contacts_left_out(self):
+
+        crystal = self._fluorite([("F-", [0.1, 0, 0])])
+        deviations = crystal.site_bvs_deviations()
+
+        # The extra fluorine and the lead it is 0.59 Å from have no meaningful sum
+        self.assertEqual(np.isnan(deviations).sum(), 2)
+        self.assertTrue(np.isnan(deviations[-1]))
+        self.assertAlmostEqual(crystal.global_instability_index(deviations), math.sqrt(np.nanmean(deviations**2)))
+        self.assertLess(crystal.global_instability_index(deviations), 1)
+
+    def test_bulk_gii(self):
+
+        with tempfile.TemporaryDirectory() as tempDir:
+            cifPath = Path(tempDir).joinpath("cif")
+            cifPath.mkdir()
+            struct = pmg.Structure.from_spacegroup("Fm-3m", pmg.Lattice.cubic(self.A), ["Pb2+", "F-"], [[0, 0, 0], [0.25, 0.25, 0.25]])
+            CifWriter(struct).write_file(cifPath.joinpath("PbF2.cif"))
+            cifPath.joinpath("broken.cif").write_text("not a cif")
+
+            # run.py writes its log to the working directory, and finds the parameter database there
+            shutil.copy(bvStructure.BVStructure.DB_LOCATION, tempDir)
+            process = subprocess.run([sys.executable, str(Path("run.py").resolve()), "bulk_gii", tempDir, "F-", "-p", "1"], cwd=tempDir, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            self.assertEqual(process.returncode, 0)
+
+            table = pd.read_csv(Path(tempDir).joinpath("gii.csv")).set_index("file")
+            self.assertEqual(table.loc["PbF2.cif", "status"], "ok")
+            self.assertEqual(table.loc["PbF2.cif", "sites"], 12)
+            self.assertAlmostEqual(table.loc["PbF2.cif", "gii"], self._fluorite().global_instability_index())
+            self.assertEqual(table.loc["broken.cif", "status"], "failed")
+
+
+class TestFromStructure(unittest.TestCase):
+
+    def setUp(self):
+        self.struct = pmg.Structure.from_spacegroup("Fm-3m", pmg.Lattice.cubic(5.9306), ["Pb2+", "F-"], [[0, 0, 0], [0.25, 0.25, 0.25]])
+
+    def test_matches_input_file(self):
+
+        with tempfile.TemporaryDirectory() as tempDir:
+            inpFile = Path(tempDir).joinpath("PbF2.inp")
+            inMemory = bvStructure.BVStructure.from_structure(self.struct, "F-", "PbF2", bvse=True, inpOutput=inpFile)
+            fromFile = bvStructure.BVStructure.from_file(inpFile, bvse=True)
+
+        self.assertEqual(len(inMemory.sites), 12)
+        self.assertTrue(np.allclose(inMemory.vectors, fromFile.vectors))
+        self.assertListEqual(list(inMemory.sites.index), list(fromFile.sites.index))
+        self.assertDictEqual(inMemory.sites.dtypes.to_dict(), fromFile.sites.dtypes.to_dict())
+
+        for structure in (inMemory, fromFile):
+            structure.initalise_map(0.5)
+            structure.populate_map_bvse_jit(mode=1)
+
+        self.assertTrue(np.allclose(inMemory.map, fromFile.map))
+
+
+class TestPartialOccupancy(unittest.TestCase):
+
+    def setUp(self):
+        self.lattice = pmg.Lattice.cubic(5.9306)
+
+    def _structure(self, cation, rCutoff:float = None):
+        struct = pmg.Structure.from_spacegroup("Fm-3m", self.lattice, [cation, "F-"], [[0, 0, 0], [0.25, 0.25, 0.25]])
+        structure = bvStructure.BVStructure.from_structure(struct, "F-", "PbF2", bvse=True)
+        if rCutoff is not None:
+            structure.rCutoff = rCutoff
+        structure.prepare()
+        structure.setup_voxels(0.5)
+        return structure
+
+    def test_input_file_occupancy(self):
+
+        struct = pmg.Structure.from_spacegroup("Fm-3m", self.lattice, [{"Pb2+": 0.5, "Sr2+": 0.5}, "F-"], [[0, 0, 0], [0.25, 0.25, 0.25]])
+
+        with tempfile.TemporaryDirectory() as tempDir:
+            inpFile = Path(tempDir).joinpath("mixed.inp")
+            bvStructure.BVStructure.from_structure(struct, "F-", "mixed", inpOutput=inpFile)
+            fromFile = bvStructure.BVStructure.from_file(inpFile)
+
+        self.assertEqual(len(fromFile.sites), 16)
+        self.assertTrue(np.allclose(fromFile.sites[fromFile.sites["ion"] != Ion("F", -1)]["occ"].to_numpy(dtype=float), 0.5))
+
+    def test_zero_occupancy_dropped(self):
+
+        struct = pmg.Structure.from_spacegroup("Fm-3m", self.lattice, ["Pb2+", "F-"], [[0, 0, 0], [0.25, 0.25, 0.25]])
+
+        with tempfile.TemporaryDirectory() as tempDir:
+            inpFile = Path(tempDir).joinpath("vacancy.inp")
+            bvStructure.BVStructure.from_structure(struct, "F-", "vacancy", inpOutput=inpFile)
+            lines = inpFile.read_text().splitlines()
+            lines[-1] = "\t".join(lines[-1].split("\t")[:8] + ["0.0"])
+            inpFile.write_text("\n".join(lines) + "\n")
+            fromFile = bvStructure.BVStructure.from_file(inpFile, bvse=True)
+
+        self.assertEqual(len(fromFile.sites), 11)
+        fromFile.initalise_map(0.5)
+        fromFile.populate_bvsm_fields()
+
+        with self.assertRaises(Exception):
+            fromFile.add_site("F9", "F9", Ion("F", -1), (1., 1., 1.), occ=0.)
+
+    def test_contributions_weighted_by_occupancy(self):
+
+        mixed = self._structure({"Pb2+": 0.5, "Sr2+": 0.5})
+        ordered = [self._structure(cation, mixed.rCutoff) for cation in ("Pb2+", "Sr2+")]
+
+        for structure in [mixed] + ordered:
+            structure.populate_map_bvse_jit(mode=0)
+            structure.populate_bvsm_fields()
+
+        self.assertTrue(np.allclose(mixed.map, (ordered[0].map + ordered[1].map) / 2))
+        self.assertTrue(np.allclose(mixed.bvsField, (ordered[0].bvsField + ordered[1].bvsField) / 2))
+
+        fluorine = (mixed.sites["ion"] == Ion("F", -1)).to_numpy()
+        self.assertTrue(np.allclose(mixed.all_site_bvs()[0][fluorine], (ordered[0].all_site_bvs()[0][-8:] + ordered[1].all_site_bvs()[0][-8:]) / 2))
@@ -0,0 +1,152 @@
+import unittest, tempfile
+import numpy as np
+import pymatgen.core as pmg
+import bvStructure
+from mapAnalysis import VoxelMap
+from pathlib import Path
+
+TEST_FILE = "test/betaPbF2-simplified.inp"
+
+class TestMapFiles(unittest.TestCase):
+
+    def setUp(self):
+        self.obj = bvStructure.BVStructure.from_file(TEST_FILE, bvse=True)
+        self.obj.initalise_map(0.5)
+        self.obj.populate_map_bvse_jit(mode=0)
+
+    def test_read_exported_maps(self):
+
+        with tempfile.TemporaryDirectory() as tempDir:
+            maps = {suffix: VoxelMap.from_file(self.obj.export_map(Path(tempDir).joinpath(f"map{suffix}"))) for suffix in (".cube", ".grd")}
+
+        for voxelMap in maps.values():
+            self.assertTrue(np.allclose(voxelMap.values, self.obj.map))
+            self.assertTrue(np.allclose(np.linalg.norm(voxelMap.vectors, axis=1), self.obj.params[:3]))
+
+        self.assertEqual(len(maps[".cube"].structure), len(self.obj.sites))
+        self.assertIsNone(maps[".grd"].structure)
+
+
+class TestLocalMinima(unittest.TestCase):
+
+    def setUp(self):
+        # A single well at the origin, so the minimum sits on the cell edge
+        grid = np.indices((24, 24, 24)) / 24
+        self.values = -np.prod(np.cos(np.pi * grid) ** 2, axis=0)
+        self.voxelMap = VoxelMap(self.values, np.eye(3) * 6)
+
+    def test_minimum_across_boundary(self):
+        indices, values = self.voxelMap.local_minima()
+        self.assertListEqual(indices.tolist(), [[0, 0, 0]])
+        self.assertAlmostEqual(values[0], -1)
+
+    def test_matches_neighbour_comparison(self):
+
+        values = np.random.default_rng(0).random((12, 10, 8))
+        expected = np.ones(values.shape, dtype=bool)
+        for shift in np.ndindex(3, 3, 3):
+            expected &= values <= np.roll(values, np.array(shift) - 1, axis=(0, 1, 2))
+
+        indices, _ = VoxelMap(values, np.eye(3)).local_minima()
+        self.assertSetEqual({tuple(index) for index in indices}, {tuple(index) for index in np.argwhere(expected)})
+
+    def test_close_minima_merged(self):
+
+        # A flat-bottomed well spread over both sides of the cell edge
+        values = np.zeros((24, 24, 24))
+        values[[0, 1, 23], 0, 0] = -1
+
+        table = VoxelMap(values, np.eye(3) * 6).find_sites(tolerance=0.6, window=0.5)
+        self.assertEqual(len(table), 1)
+        self.assertEqual(table["voxels"].iloc[0], 3)
+        self.assertAlmostEqual(table["energy"].iloc[0], -1)
+
+    def test_masked_cores_not_minima(self):
+
+        crystal = bvStructure.BVStructure.from_file(TEST_FILE, bvse=True)
+        crystal.initalise_map(0.2)
+        crystal.create_core_mask(1.0)
+        crystal.populate_map_bvse_jit(mode=0)
+
+        table = VoxelMap.from_structure(crystal).find_sites()
+        self.assertGreater(len(table), 0)
+        self.assertTrue((table["energy"] < crystal.CORE_SENTINEL).all())
+
+
+class TestSiteSymmetry(unittest.TestCase):
+
+    def test_equivalent_sites_grouped(self):
+
+        struct = pmg.Structure.from_spacegroup("Fm-3m", pmg.Lattice.cubic(5.9306), ["Pb2+", "F-"], [[0, 0, 0], [0.25, 0.25, 0.25]])
+        crystal = bvStructure.BVStructure.from_structure(struct, "F-", "PbF2", bvse=True)
+        crystal.initalise_map(0.5)
+        crystal.populate_map_bvse_jit(mode=1)
+
+        table = VoxelMap.from_structure(crystal).find_sites(window=0.01, symmetry=True)
+
+        # The fluoride sites are the lowest minima, and are all equivalent
+        self.assertEqual(len(table), 8)
+        self.assertEqual(table["group"].nunique(), 1)
+
+
+def _threshold_barrier(values:np.ndarray, start:tuple, end:tuple) -> float:
+    """
+        Finds the lowest barrier between two voxels of a periodic grid by adding voxels in order of value until the two
+        are connected, as an independent check of the path search.
+    """
+
+    parents = np.arange(values.size)
+    active = np.zeros(values.size, dtype=bool)
+    start, end = np.ravel_multi_index(start, values.shape), np.ravel_multi_index(end, values.shape)
+
+    def find(voxel):
+        while parents[voxel] != voxel:
+            voxel = parents[voxel]
+        return voxel
+
+    for voxel in np.argsort(values, axis=None):
+        active[voxel] = True
+        index = np.array(np.unravel_index(voxel, values.shape))
+        for step in np.vstack((np.eye(3, dtype=int), -np.eye(3, dtype=int))):
+            neighbour = np.ravel_multi_index((index + step) % values.shape, values.shape)
+            if active[neighbour]:
+                parents[find(neighbour)] = find(voxel)
+        if active[start] and active[end] and find(start) == find(end):
+            return values.flat[voxel]
+
+
+class TestMigrationPath(unittest.TestCase):
+
+    def setUp(self):
+        self.values = np.random.default_rng(1).random((6, 5, 4))
+        self.voxelMap = VoxelMap(self.values, np.diag([3., 2.5, 2.]))
+
+    def _check_steps(self, table):
+        indices = np.round(table[["a", "b", "c"]].to_numpy() * self.voxelMap.voxelNumbers).astype(int)
+        self.assertTrue((np.abs(np.diff(indices, axis=0)).sum(axis=1) == 1).all())
+        return indices
+
+    def test_barrier_between_points(self):
+
+        start, end = np.array([0.5, 0.2, 0.25]), np.array([0., 0.8, 0.75])
+        table = self.voxelMap.minimum_path(start, end)
+        indices = self._check_steps(table)
+
+        self.assertListEqual((indices[-1] % self.voxelMap.voxelNumbers).tolist(), self.voxelMap.nearest_voxel(end).tolist())
+        self.assertAlmostEqual(table["energy"].max(), _threshold_barrier(self.values, tuple(self.voxelMap.nearest_voxel(start)), tuple(self.voxelMap.nearest_voxel(end))))
+
+    def test_barrier_along_axis(self):
+
+        start = np.array([0.5, 0.2, 0.25])
+        startVoxel = self.voxelMap.nearest_voxel(start)
+
+        for axis in range(3):
+            table = self.voxelMap.minimum_path(start, axis=axis)
+            indices = self._check_steps(table)
+            self.assertEqual(abs(indices[-1] - indices[0])[axis], self.voxelMap.voxelNumbers[axis])
+
+            tiles = np.ones(3, dtype=int)
+            tiles[axis] = 2
+            endVoxel = startVoxel.copy()
+            endVoxel[axis] += self.voxelMap.voxelNumbers[axis]
+            self.assertAlmostEqual(table["energy"].max(), _threshold_barrier(np.tile(self.values, tiles), tuple(startVoxel), tuple(endVoxel)))
@@ -0,0 +1,60 @@
+import unittest, tempfile, threading
+import numpy as np
+import bvStructure
+import service
+from pathlib import Path
+
+TEST_FILE = "test/betaPbF2-simplified.inp"
+
+class TestMapService(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = service.create_server(port=0)
+        cls.port = cls.server.server_address[1]
+        cls.thread = threading.Thread(target=cls.server.serve_forever, daemon=True)
+        cls.thread.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+        cls.server.service.close()
+
+    def test_map_matches_direct(self):
+
+        result = service.submit("bvse", {"input_file": TEST_FILE, "resolution": 0.5, "mode": 1}, port=self.port)
+
+        crystal = bvStructure.BVStructure.from_file(TEST_FILE, bvse=True)
+        crystal.prepare(lonePairs=True)
+        crystal.setup_voxels(0.5)
+        crystal.populate_map_bvse_jit(mode=1, effectiveCharge=False)
+
+        self.assertTrue(np.array_equal(result["maps"][str(crystal.conductor)], crystal.map))
+
+    def test_paths_written(self):
+
+        with tempfile.TemporaryDirectory() as tempDir:
+            result = service.submit("bvsm", {"input_file": TEST_FILE, "output_file": str(Path(tempDir).joinpath("map.grd")), "resolution": 0.5}, port=self.port)
+            self.assertEqual(len(result["paths"]), 1)
+            self.assertTrue(Path(result["paths"][0]).exists())
+
+    def test_structure_reused(self):
+
+        job = {"input_file": TEST_FILE, "resolution": 0.5, "mode": 0}
+        service.submit("bvse", job, port=self.port)
+        structures = self.server.service.status()["structures"]
+        service.submit("bvse", dict(job, resolution=0.4), port=self.port)
+        self.assertEqual(self.server.service.status()["structures"], structures)
+
+    def test_maps_released(self):
+
+        service.submit("bvse", {"input_file": TEST_FILE, "resolution": 0.5, "mode": 1, "channels": True}, port=self.port)
+        for crystal in self.server.service.structures.values():
+            self.assertIsNone(crystal.map)
+            self.assertEqual(crystal.conductorMaps, {})
+            self.assertEqual(crystal.channelMaps, {})
+
+    def test_missing_file(self):
+        with self.assertRaises(Exception):
+            service.submit("bvse", {"input_file": "test/missing.inp"}, port=self.port)
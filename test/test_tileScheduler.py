@@ -0,0 +1,59 @@
+import unittest
+import numpy as np
+import bvStructure
+from tileScheduler import TileScheduler, tile_bounds
+
+TEST_FILE = "test/betaPbF2-simplified.inp"
+
+class TestTileBounds(unittest.TestCase):
+
+    def test_tiles_cover_grid_once(self):
+        voxelNumbers = np.array((10, 7, 5))
+        covered = np.zeros(voxelNumbers, dtype=int)
+
+        for lower, upper in tile_bounds(voxelNumbers, (4, 3, 5)):
+            covered[lower[0]:upper[0], lower[1]:upper[1], lower[2]:upper[2]] += 1
+
+        self.assertTrue((covered == 1).all())
+
+
+class TestTileScheduler(unittest.TestCase):
+
+    def setUp(self):
+        self.obj = bvStructure.BVStructure.from_file(TEST_FILE, bvse=True)
+        self.obj.prepare()
+        self.obj.setup_voxels(0.4)
+
+    def test_bvse_matches_single_map(self):
+
+        self.obj.populate_map_bvse_jit(mode=1, effectiveCharge=True)
+        reference = self.obj.map.copy()
+
+        for processes, jit in ((1, True), (2, True), (2, False)):
+            TileScheduler(processes, tileShape=(5, 7, 24), jit=jit).populate_map_bvse(self.obj, mode=1, effectiveCharge=True)
+            self.assertTrue(np.allclose(self.obj.map, reference, rtol=1e-12, atol=1e-12))
+            self.assertEqual(self.obj.mapSettings["method"], "bvse")
+
+    def test_bvsm_matches_single_map(self):
+
+        self.obj.populate_map_bvsm_jit(mode=1, penalty=0.05)
+        reference = self.obj.map.copy()
+
+        for jit in (True, False):
+            TileScheduler(2, jit=jit).populate_map_bvsm(self.obj, mode=1, penalty=0.05)
+            self.assertTrue(np.allclose(self.obj.map, reference, rtol=1e-12, atol=1e-12))
+
+    def test_scatter_tiles_match_single_map(self):
+
+        self.obj.populate_map_bvse_jit(mode=1, effectiveCharge=True)
+        reference = self.obj.map.copy()
+
+        # Small tiles, so most sites reach several tiles and are clipped to each
+        for processes in (1, 2):
+            TileScheduler(processes, tileShape=(5, 7, 24), engine="scatter").populate_map_bvse(self.obj, mode=1, effectiveCharge=True)
+            self.assertTrue(np.array_equal(self.obj.map, reference))
+
+        self.obj.populate_map_bvsm_jit(mode=1, penalty=0.05)
+        reference = self.obj.map.copy()
+        TileScheduler(2, tileShape=(5, 7, 24), engine="scatter").populate_map_bvsm(self.obj, mode=1, penalty=0.05)
+        self.assertTrue(np.array_equal(self.obj.map, reference))
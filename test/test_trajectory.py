@@ -0,0 +1,81 @@
+import unittest, tempfile
+import numpy as np
+import pymatgen.core as pmg
+import bvStructure
+from trajectory import TrajectoryMaps, read_frames
+from pathlib import Path
+
+TEST_FILE = "test/betaPbF2-simplified.inp"
+
+def _write_xdatcar(path:Path, elements:list, frames:list):
+    """
+        Writes fractional coordinate frames to a variable cell XDATCAR file.
+    """
+
+    names = list(dict.fromkeys(elements))
+    with open(path, "w") as f:
+        for i, (fracCoords, vectors) in enumerate(frames):
+            f.write("test\n1.0\n")
+            for vector in vectors:
+                f.write(" ".join(f"{value:.10f}" for value in vector) + "\n")
+            f.write(" ".join(names) + "\n" + " ".join(str(elements.count(name)) for name in names) + "\n")
+            f.write(f"Direct configuration= {i + 1}\n")
+            for coord in fracCoords:
+                f.write(" ".join(f"{value:.10f}" for value in coord) + "\n")
+
+
+class TestTrajectoryMaps(unittest.TestCase):
+
+    def setUp(self):
+        self.crystal = bvStructure.BVStructure.from_file(TEST_FILE, bvse=True)
+        self.elements = [ion.element for ion in self.crystal.sites["ion"]]
+        self.fracCoords = np.stack(self.crystal.sites["coords"].to_numpy()) @ self.crystal.inverseVectors
+
+        # A second frame with a displaced fluoride in a slightly larger cell
+        self.shifted = self.fracCoords.copy()
+        self.shifted[2] += (0.02, -0.01, 0.03)
+        self.frames = [(self.fracCoords, self.crystal.vectors), (self.shifted, self.crystal.vectors * 1.01)]
+
+        self.tempDir = tempfile.TemporaryDirectory()
+        self.path = Path(self.tempDir.name).joinpath("XDATCAR")
+        _write_xdatcar(self.path, self.elements, self.frames)
+
+    def tearDown(self):
+        self.tempDir.cleanup()
+
+    def _direct_map(self, fracCoords:np.ndarray, vectors:np.ndarray) -> np.ndarray:
+        species = [f"{ion.element}{abs(ion.ox_state)}{'+' if ion.ox_state > 0 else '-'}" for ion in self.crystal.sites["ion"]]
+        struct = pmg.Structure(pmg.Lattice(vectors), species, fracCoords)
+        crystal = bvStructure.BVStructure.from_structure(struct, "F-", "frame", bvse=True)
+        crystal.prepare(lonePairs=True)
+        crystal.setup_voxels(0.5)
+        crystal.populate_map_bvse_jit(mode=1)
+        return crystal.map
+
+    def test_read_xdatcar(self):
+
+        frames = list(read_frames(self.path))
+        self.assertEqual(len(frames), 2)
+        self.assertListEqual(frames[0][1], self.elements)
+        self.assertTrue(np.allclose(frames[1][2], self.shifted))
+        self.assertTrue(np.allclose(frames[1][3], self.crystal.vectors * 1.01))
+        self.assertEqual(len(list(read_frames(self.path, step=2))), 1)
+
+    def test_average_matches_direct_maps(self):
+
+        maps = TrajectoryMaps(self.crystal)
+        frameMaps = []
+        count = maps.bvse(read_frames(self.path), 0.5, mode=1, frameCallback=lambda label, crystal: frameMaps.append(crystal.map.copy()))
+        expected = [self._direct_map(fracCoords, vectors) for fracCoords, vectors in self.frames]
+
+        self.assertEqual(count, 2)
+        for frameMap, expectedMap in zip(frameMaps, expected):
+            self.assertTrue(np.allclose(frameMap, expectedMap))
+        self.assertTrue(np.allclose(maps.mean, np.mean(expected, axis=0)))
+        self.assertTrue(np.allclose(maps.std, np.std(expected, axis=0)))
+
+    def test_mismatched_frame(self):
+
+        _write_xdatcar(self.path, self.elements[::-1], self.frames)
+        with self.assertRaises(Exception):
+            TrajectoryMaps(self.crystal).bvse(read_frames(self.path), 0.5)
@@ -0,0 +1,185 @@
+import unittest, tempfile, os, shutil, subprocess, sys, time
+import pandas as pd
+import pymatgen.core as pmg
+from argparse import Namespace
+from multiprocessing import Process
+from unittest.mock import patch
+from pathlib import Path
+from pymatgen.io.cif import CifWriter
+from workQueue import WorkQueue
+from bvStructure import BVStructure
+import run
+
+RUN_FILE = Path("run.py").resolve()
+
+def _command(workDir:str|Path, *args) -> list:
+    """
+        Returns the command to run run.py in a working directory, which its log is written to. The parameter database
+        is found from the working directory, so a copy is placed there.
+    """
+    database = Path(workDir).joinpath(BVStructure.DB_LOCATION)
+    if not database.exists():
+        shutil.copy(BVStructure.DB_LOCATION, database)
+    return [sys.executable, str(RUN_FILE), *args]
+
+def _worker(queueDir:str, items:list, logDir:str):
+    queue = WorkQueue(queueDir, staleAfter=5)
+    with open(Path(logDir).joinpath(f"{os.getpid()}.log"), "w") as log:
+        for claim in queue.claims(items, poll=0.05):
+            with claim:
+                time.sleep(0.01)
+                if claim.is_current():
+                    log.write(f"{claim.item}\n")
+                    claim.complete()
+
+class TestWorkQueue(unittest.TestCase):
+
+    def setUp(self):
+        self.tempDir = tempfile.TemporaryDirectory()
+        self.queueDir = Path(self.tempDir.name).joinpath("queue")
+        self.queue = WorkQueue(self.queueDir, staleAfter=5)
+
+    def tearDown(self):
+        self.tempDir.cleanup()
+
+    def test_claim_is_exclusive(self):
+        claim = self.queue.claim("a.cif")
+        self.assertEqual(claim.generation, 0)
+        self.assertIsNone(self.queue.claim("a.cif"))
+
+        claim.complete()
+        self.assertTrue(self.queue.is_done("a.cif"))
+        self.assertIsNone(self.queue.claim("a.cif"))
+
+    def test_stale_claim_taken_over(self):
+        claim = self.queue.claim("a.cif")
+        os.utime(claim.path, (time.time() - 10, time.time() - 10))
+
+        takeover = self.queue.claim("a.cif")
+        self.assertEqual(takeover.generation, 1)
+        self.assertFalse(claim.is_current())
+        self.assertTrue(takeover.is_current())
+
+    def test_released_claim_retried_until_failed(self):
+        for generation in range(self.queue.maxAttempts):
+            with self.queue.claim("a.cif") as claim:
+                self.assertEqual(claim.generation, generation)
+
+        self.assertIsNone(self.queue.claim("a.cif"))
+        self.assertTrue(self.queue.is_done("a.cif"))
+
+    def test_processes_share_items(self):
+
+        items = [f"{i}.cif" for i in range(40)]
+        logDir = Path(self.tempDir.name).joinpath("logs")
+        logDir.mkdir()
+
+        workers = [Process(target=_worker, args=(str(self.queueDir), items, str(logDir))) for _ in range(4)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+        processed = []
+        for log in logDir.iterdir():
+            processed += log.read_text().split()
+
+        self.assertListEqual(sorted(processed), sorted(items))
+
+
+class TestBulkWorkers(unittest.TestCase):
+
+    def test_workers_process_every_structure_once(self):
+
+        lattice = pmg.Lattice.cubic(5.9306)
+
+        with tempfile.TemporaryDirectory() as tempDir:
+            cifPath = Path(tempDir).joinpath("cif")
+            cifPath.mkdir()
+            for cation in ("Pb", "Sr", "Ca"):
+                struct = pmg.Structure.from_spacegroup("Fm-3m", lattice, [f"{cation}2+", "F-"], [[0, 0, 0], [0.25, 0.25, 0.25]])
+                CifWriter(struct).write_file(cifPath.joinpath(f"{cation}F2.cif"))
+
+            command = _command(tempDir, "bulk_bvse", tempDir, "F-", "-r", "0.5", "-w")
+            workers = [subprocess.Popen(command, cwd=tempDir, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL) for _ in range(2)]
+            for worker in workers:
+                self.assertEqual(worker.wait(), 0)
+
+            resultPath = Path(tempDir).joinpath("result")
+            self.assertListEqual(sorted(folder.name for folder in resultPath.iterdir()), ["CaF2", "PbF2", "SrF2"])
+            for folder in resultPath.iterdir():
+                self.assertListEqual(sorted(resultFile.name for resultFile in folder.iterdir()), [f"{folder.name}.cif", f"{folder.name}.cube"])
+            self.assertEqual(len(list(Path(tempDir).joinpath("queue", "done").iterdir())), 3)
+
+    def test_workers_keep_same_formula_results(self):
+
+        with tempfile.TemporaryDirectory() as tempDir:
+            cifPath = Path(tempDir).joinpath("cif")
+            cifPath.mkdir()
+            for name, a in (("small", 5.9306), ("large", 6.2)):
+                struct = pmg.Structure.from_spacegroup("Fm-3m", pmg.Lattice.cubic(a), ["Pb2+", "F-"], [[0, 0, 0], [0.25, 0.25, 0.25]])
+                CifWriter(struct).write_file(cifPath.joinpath(f"{name}.cif"))
+
+            command = _command(tempDir, "bulk_bvse", tempDir, "F-", "-r", "0.5", "-w")
+            workers = [subprocess.Popen(command, cwd=tempDir, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL) for _ in range(2)]
+            for worker in workers:
+                self.assertEqual(worker.wait(), 0)
+
+            folder = Path(tempDir).joinpath("result", "PbF2")
+            self.assertListEqual(sorted(resultFile.name for resultFile in folder.iterdir()), ["PbF2-0.cif", "PbF2-0.cube", "PbF2.cif", "PbF2.cube"])
+
+
+class TestBulkSummary(unittest.TestCase):
+
+    def setUp(self):
+        self.tempDir = tempfile.TemporaryDirectory()
+        self.basePath = Path(self.tempDir.name)
+        self.cifPath = self.basePath.joinpath("cif")
+        self.cifPath.mkdir()
+        for cation in ("Pb", "Sr"):
+            struct = pmg.Structure.from_spacegroup("Fm-3m", pmg.Lattice.cubic(5.9306), [f"{cation}2+", "F-"], [[0, 0, 0], [0.25, 0.25, 0.25]])
+            CifWriter(struct).write_file(self.cifPath.joinpath(f"{cation}F2.cif"))
+
+    def tearDown(self):
+        self.tempDir.cleanup()
+
+    def test_summary_records_failures(self):
+
+        self.cifPath.joinpath("broken.cif").write_text("not a cif")
+        process = subprocess.run(_command(self.basePath, "bulk_bvse", str(self.basePath), "F-", "-r", "0.5"), cwd=self.basePath, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        self.assertEqual(process.returncode, 0)
+
+        summary = pd.read_csv(self.basePath.joinpath("summary.csv")).set_index("file")
+        self.assertListEqual(sorted(summary.index), ["PbF2.cif", "SrF2.cif", "broken.cif"])
+        self.assertEqual(summary.loc["PbF2.cif", "status"], "ok")
+        self.assertGreater(summary.loc["PbF2.cif", "voxels"], 0)
+        self.assertGreater(summary.loc["PbF2.cif", "map_seconds"], 0)
+        self.assertEqual(summary.loc["broken.cif", "status"], "failed")
+        self.assertFalse(pd.isna(summary.loc["broken.cif", "error"]))
+
+        if sys.platform.startswith("linux"):
+            self.assertTrue((summary.loc[["PbF2.cif", "SrF2.cif"], "peak_memory_mb"] > 0).all())
+            self.assertTrue((summary["peak_memory_mb"] <= summary["process_peak_memory_mb"]).all())
+
+    def test_worker_summaries(self):
+
+        command = _command(self.basePath, "bulk_bvse", str(self.basePath), "F-", "-r", "0.5", "-w")
+        workers = [subprocess.Popen(command, cwd=self.basePath, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL) for _ in range(2)]
+        for worker in workers:
+            self.assertEqual(worker.wait(), 0)
+
+        # Each worker writes its own summary, which together cover every structure
+        summary = pd.concat([pd.read_csv(summaryFile) for summaryFile in self.basePath.glob("summary-*.csv")])
+        self.assertListEqual(sorted(summary["file"]), ["PbF2.cif", "SrF2.cif"])
+        self.assertTrue((summary["status"] == "ok").all())
+
+    def test_no_map_written(self):
+
+        args = Namespace(conductor=["F-"], resolution=0.5, effective_charge=True, write_inp=False)
+        resultPath = self.basePath.joinpath("result")
+        resultPath.mkdir()
+
+        with patch("run._bvse_map", return_value={}):
+            row = run._bulk_structure(self.cifPath.joinpath("PbF2.cif"), resultPath, args, False, {}, None, None, {})
+
+        self.assertEqual(dict(zip(run.SUMMARY_COLUMNS, row))["status"], "empty")
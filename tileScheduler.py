@@ -0,0 +1,244 @@
+import logging, math, os
+import numpy as np
+from multiprocessing import Pool, shared_memory
+from bvStructure import BVStructure, bvse_tile, bvsm_tile, bvse_scatter_tile, bvsm_scatter_tile
+
+def tile_bounds(voxelNumbers:np.ndarray, tileShape:tuple) -> list:
+    """
+        Splits a grid of voxels into tiles of at most the given shape. Returns a list of the lower and upper (exclusive)
+        voxel index of each tile.
+    """
+
+    starts = [range(0, voxelNumbers[i], tileShape[i]) for i in range(3)]
+    bounds = []
+
+    for h in starts[0]:
+        for k in starts[1]:
+            for l in starts[2]:
+                lower = np.array((h, k, l), dtype=np.int64)
+                upper = np.minimum(lower + tileShape, voxelNumbers).astype(np.int64)
+                bounds.append((lower, upper))
+
+    return bounds
+
+def _tile_positions(voxelNos:np.ndarray, vectors:np.ndarray, lower:np.ndarray, upper:np.ndarray) -> np.ndarray:
+    """
+        Returns the cartesian positions of the voxels in a tile, with the shape [h][k][l][x, y, z]. The position is summed
+        over the axes in the same order as the JIT kernels.
+    """
+    fractions = [np.arange(lower[i], upper[i]) / voxelNos[i] for i in range(3)]
+    return fractions[0][:,None,None,None] * vectors[0] + fractions[1][None,:,None,None] * vectors[1] + fractions[2][None,None,:,None] * vectors[2]
+
+def bvse_tile_numpy(voxelNos:np.ndarray, vectors:np.ndarray, cutoff:float, mode:int, screeningFactor:float, bondIons:np.ndarray, coulIons:np.ndarray, lower:np.ndarray, upper:np.ndarray, resultMap:np.ndarray, mask:np.ndarray = None, sentinel:float = 0.):
+    """
+        Calculates the BVSE of the voxels in one tile of the map with NumPy, for hosts where JIT compilation is not
+        available. Arguments and results match bvse_tile. Each site is applied to the whole tile at once.
+    """
+
+    from scipy.special import erfc
+
+    positions = _tile_positions(voxelNos, vectors, lower, upper)
+    energies = np.zeros(positions.shape[:3])
+
+    if mode < 2 and bondIons.size > 0:
+        for ion in bondIons:
+            r2 = np.sum((ion[:3] - positions)**2, axis=-1)
+            inside = r2 <= cutoff**2
+            r = np.sqrt(r2[inside])
+            energies[inside] += ion[3] * (np.exp((ion[4] - r) * ion[5]) - 1)**2 - ion[3]
+
+    if mode > 0 and coulIons.size > 0:
+        for ion in coulIons:
+            r2 = np.sum((ion[:3] - positions)**2, axis=-1)
+            inside = r2 <= cutoff**2
+            r = np.sqrt(r2[inside])
+            energies[inside] += (ion[3] * ion[4]) / r * erfc(r / (screeningFactor * (ion[5] + ion[6])))
+
+    _store_tile(resultMap, energies, lower, upper, mask, sentinel)
+
+def bvsm_tile_numpy(voxelNos:np.ndarray, vectors:np.ndarray, cutoff:float, conductorOs:int, mode:int, bvIons:np.ndarray, penIons:np.ndarray, lower:np.ndarray, upper:np.ndarray, resultMap:np.ndarray, mask:np.ndarray = None, sentinel:float = 0.):
+    """
+        Calculates the BVSM of the voxels in one tile of the map with NumPy, for hosts where JIT compilation is not
+        available. Arguments and results match bvsm_tile.
+    """
+
+    positions = _tile_positions(voxelNos, vectors, lower, upper)
+    bvs = np.full(positions.shape[:3], 0. if mode < 2 else float(abs(conductorOs)))
+    penaltySum = np.zeros(positions.shape[:3])
+
+    if mode < 2 and bvIons.size > 0:
+        for ion in bvIons:
+            r2 = np.sum((ion[:3] - positions)**2, axis=-1)
+            inside = r2 <= cutoff**2
+            bvs[inside] += np.exp((ion[4] - np.sqrt(r2[inside])) * ion[3])
+
+    if mode > 0 and penIons.size > 0:
+        for ion in penIons:
+            r2 = np.sum((ion[:3] - positions)**2, axis=-1)
+            inside = r2 <= cutoff**2
+            penaltySum[inside] += ion[4] * (conductorOs * ion[3]) * (1 / r2[inside] - 1 / cutoff**2)
+
+    _store_tile(resultMap, np.abs(bvs - abs(conductorOs)) + penaltySum, lower, upper, mask, sentinel)
+
+def _store_tile(resultMap:np.ndarray, values:np.ndarray, lower:np.ndarray, upper:np.ndarray, mask:np.ndarray, sentinel:float):
+    """
+        Writes the values of a tile into the map, giving any masked voxels the sentinel value. The NumPy kernels work on
+        whole tiles, so masked voxels are calculated but not kept.
+    """
+
+    tile = (slice(lower[0], upper[0]), slice(lower[1], upper[1]), slice(lower[2], upper[2]))
+    if mask is not None:
+        values = np.where(mask[tile], sentinel, values)
+    resultMap[tile] = values
+
+
+class TileScheduler:
+    """
+        Calculates a single map on several processes, for hosts where numba's own threading can not be used. The grid of
+        voxels is split into tiles that are handed out to a pool of worker processes. The map and the site arrays are
+        placed in shared memory, which every worker attaches to when it starts, so each worker writes its tiles straight
+        into the map and only the tile bounds are ever sent between processes.
+    """
+
+    KERNELS = {
+        ("bvse", "gather"): bvse_tile,
+        ("bvse", "scatter"): bvse_scatter_tile,
+        ("bvse", "numpy"): bvse_tile_numpy,
+        ("bvsm", "gather"): bvsm_tile,
+        ("bvsm", "scatter"): bvsm_scatter_tile,
+        ("bvsm", "numpy"): bvsm_tile_numpy
+    }
+
+    def __init__(self, processes:int = None, tileShape:tuple = None, jit:bool = True, engine:str = "gather"):
+        """
+            Initialises a scheduler for a number of processes (defaulting to the number of CPUs). By default the grid is
+            split into slabs along the first two axes, giving each process several tiles to balance the load. The engine
+            is 'gather' for the voxel-centric kernels or 'scatter' for the site-centric kernels, which only write inside
+            their own tile, so no two processes ever add to the same voxel. Set jit to False to use the NumPy kernels.
+        """
+        self.processes = os.cpu_count() if processes is None else processes
+        self.tileShape = tileShape
+        self.engine = engine if jit else "numpy"
+
+    def _tile_shape(self, voxelNumbers:np.ndarray) -> np.ndarray:
+
+        if self.tileShape is not None:
+            return np.array(self.tileShape, dtype=np.int64)
+
+        # Aim for around four tiles per process, keeping whole rows along the last axis
+        side = max(1, math.ceil(math.sqrt(voxelNumbers[0] * voxelNumbers[1] / (4 * self.processes))))
+        return np.array((side, side, voxelNumbers[2]), dtype=np.int64)
+
+    def run(self, method:str, voxelNumbers:np.ndarray, vectors:np.ndarray, settings:tuple, siteArrays:tuple, mask:np.ndarray = None, sentinel:float = 0.) -> np.ndarray:
+        """
+            Calculates a map with the tile kernel for a method ('bvse' or 'bvsm'). The settings are the kernel arguments
+            between the lattice vectors and the site arrays, e.g. (cutoff, mode, screening factor) for BVSE. Voxels set in
+            the mask, if given, are skipped and given the sentinel value. Returns the map as an ordinary array.
+        """
+
+        kernel = self.KERNELS[(method, self.engine)]
+        voxelNumbers = np.asarray(voxelNumbers, dtype=np.int64)
+        bounds = tile_bounds(voxelNumbers, self._tile_shape(voxelNumbers))
+
+        if self.processes == 1:
+            resultMap = np.zeros(voxelNumbers)
+            for lower, upper in bounds:
+                kernel(voxelNumbers, vectors, *settings, *siteArrays, lower, upper, resultMap, mask, sentinel)
+            return resultMap
+
+        blocks = []
+        try:
+
+            mapBlock, mapSpec = _share(np.zeros(voxelNumbers))
+            blocks.append(mapBlock)
+            siteSpecs = []
+            for siteArray in siteArrays:
+                block, spec = _share(siteArray)
+                blocks.append(block)
+                siteSpecs.append(spec)
+
+            maskSpec = None
+            if mask is not None:
+                block, maskSpec = _share(mask)
+                blocks.append(block)
+
+            logging.info(f"Calculating {len(bounds)} tiles on {self.processes} processes")
+            with Pool(self.processes, initializer=_init_worker, initargs=(method, self.engine, voxelNumbers, vectors, settings, siteSpecs, mapSpec, maskSpec, sentinel)) as pool:
+                pool.map(_run_tile, bounds, chunksize=1)
+
+            return np.array(_attach(mapBlock, mapSpec))
+
+        finally:
+            for block in blocks:
+                block.close()
+                block.unlink()
+
+    def populate_map_bvse(self, crystal:BVStructure, mode = 1, effectiveCharge = True):
+        """
+            Populates a structure's map with BVSE data, giving the same map as populate_map_bvse_jit.
+        """
+
+        selectedSites = crystal.bufferedSites[crystal.bufferedSites["ion"] != crystal.conductor]
+        siteArrays = crystal.site_arrays(f"bvse-{int(effectiveCharge)}", lambda: (crystal._create_bond_site_array(selectedSites), crystal._create_coul_site_array(selectedSites, effectiveCharge)))
+
+        crystal.map = self.run("bvse", crystal.voxelNumbers, crystal.vectors, (crystal.rCutoff, mode, crystal.SCREENING_FACTOR), siteArrays, getattr(crystal, "coreMask", None), crystal.CORE_SENTINEL)
+        crystal.mapSettings = {"method": "bvse", "mode": mode, "effectiveCharge": effectiveCharge}
+        logging.info(f"Succesful map creation for {crystal.name}")
+
+    def populate_map_bvsm(self, crystal:BVStructure, mode = 1, penalty:float = 0.05):
+        """
+            Populates a structure's map with BVSM data, giving the same map as populate_map_bvsm_jit.
+        """
+
+        selectedSites = crystal.bufferedSites[crystal.bufferedSites["ion"] != crystal.conductor]
+        siteArrays = crystal.site_arrays(f"bvsm-{penalty}", lambda: (crystal._create_bv_array(selectedSites), crystal._create_bv_penalty_array(selectedSites, penalty)))
+
+        crystal.map = self.run("bvsm", crystal.voxelNumbers, crystal.vectors, (crystal.rCutoff, crystal.conductor.ox_state, mode), siteArrays, getattr(crystal, "coreMask", None), crystal.CORE_SENTINEL)
+        crystal.mapSettings = {"method": "bvsm", "mode": mode, "penalty": penalty}
+        logging.info(f"Succesful map creation for {crystal.name}")
+
+
+def _share(array:np.ndarray) -> tuple:
+    """
+        Copies an array into a new block of shared memory. Returns the block and the (name, shape, dtype) that a worker
+        needs to attach to it.
+    """
+    array = np.ascontiguousarray(array)
+    block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+    np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)[...] = array
+    return block, (block.name, array.shape, array.dtype.str)
+
+def _attach(block:shared_memory.SharedMemory, spec:tuple) -> np.ndarray:
+    """
+        Returns the array stored in a block of shared memory.
+    """
+    _, shape, dtype = spec
+    return np.ndarray(shape, dtype=np.dtype(dtype), buffer=block.buf)
+
+# The state of a worker process, set once by _init_worker
+_worker = {}
+
+def _init_worker(method:str, engine:str, voxelNumbers:np.ndarray, vectors:np.ndarray, settings:tuple, siteSpecs:list, mapSpec:tuple, maskSpec:tuple = None, sentinel:float = 0.):
+    """
+        Attaches a worker process to the shared map, site arrays and mask. The blocks are kept open for the life of the
+        worker.
+    """
+
+    blocks = [shared_memory.SharedMemory(name=spec[0]) for spec in siteSpecs + [mapSpec]]
+    _worker["blocks"] = blocks
+    _worker["kernel"] = TileScheduler.KERNELS[(method, engine)]
+    _worker["args"] = (voxelNumbers, vectors, *settings, *[_attach(block, spec) for block, spec in zip(blocks, siteSpecs)])
+    _worker["map"] = _attach(blocks[-1], mapSpec)
+    _worker["mask"] = None
+
+    if maskSpec is not None:
+        blocks.append(shared_memory.SharedMemory(name=maskSpec[0]))
+        _worker["mask"] = _attach(blocks[-1], maskSpec)
+    _worker["sentinel"] = sentinel
+
+def _run_tile(bounds:tuple):
+    """
+        Calculates one tile of the map in a worker process, writing it straight into the shared map.
+    """
+    lower, upper = bounds
+    _worker["kernel"](*_worker["args"], lower, upper, _worker["map"], _worker["mask"], _worker["sentinel"])
@@ -0,0 +1,167 @@
+import logging, time
+import numpy as np
+import pymatgen.core as pmg
+from itertools import islice
+from pathlib import Path
+from bvStructure import *
+
+FRAME_SUFFIXES = (".cif", ".vasp") # Suffixes of the structure files read from a folder of frames, as well as POSCAR and CONTCAR files
+
+def read_xdatcar(path:Path) -> tuple:
+    """
+        Reads the frames of a VASP XDATCAR file one at a time, so trajectories of any length can be streamed. Yields the
+        label, element of every atom, fractional coordinates and lattice vectors of each frame. Variable cell files, which
+        repeat the header before every frame, are supported.
+    """
+
+    vectors, elements = None, None
+
+    with open(path, "r") as f:
+        for line in f:
+
+            if line.strip() == "":
+                continue
+
+            if "configuration" not in line.lower():
+                # A header - this line is the comment, followed by the scale, lattice vectors, species and counts
+                scale = float(f.readline().split()[0])
+                vectors = np.array([f.readline().split()[:3] for _ in range(3)], dtype=float)
+
+                # A negative scale gives the cell volume instead
+                vectors *= scale if scale > 0 else (-scale / abs(np.linalg.det(vectors))) ** (1/3)
+
+                names = [name.split("_")[0].split("/")[0] for name in f.readline().split()]
+                counts = [int(count) for count in f.readline().split()]
+                elements = [name for name, count in zip(names, counts) for _ in range(count)]
+                continue
+
+            if elements is None:
+                raise Exception(f"The XDATCAR file {path} has a frame before its header")
+
+            coords = np.array([f.readline().split()[:3] for _ in range(len(elements))], dtype=float)
+            if line.strip().lower().startswith("cartesian"):
+                coords = coords @ np.linalg.inv(vectors)
+
+            yield line.split("=")[-1].strip(), elements, coords, vectors
+
+def read_frame_folder(path:Path) -> tuple:
+    """
+        Reads the structure files in a folder as frames, in order of file name. Yields the same values as read_xdatcar,
+        labelling each frame with its file name.
+    """
+
+    files = sorted(file for file in path.iterdir() if file.suffix in FRAME_SUFFIXES or file.name.startswith(("POSCAR", "CONTCAR")))
+
+    for file in files:
+        struct = pmg.Structure.from_file(file)
+        if not struct.is_ordered:
+            raise Exception(f"The frame {file.name} has partially occupied sites, which are not supported in trajectories")
+        yield file.stem, [site.specie.symbol for site in struct.sites], struct.frac_coords, np.array(struct.lattice.matrix)
+
+def read_frames(path:str|Path, start:int = 0, stop:int = None, step:int = 1) -> tuple:
+    """
+        Reads frames from an XDATCAR file or a folder of structure files, keeping every step-th frame from start up to
+        (but excluding) stop.
+    """
+
+    path = Path(path)
+
+    if path.is_dir():
+        frames = read_frame_folder(path)
+    elif path.is_file():
+        frames = read_xdatcar(path)
+    else:
+        raise Exception(f"No trajectory could be found at {path}")
+
+    return islice(frames, start, stop, step)
+
+
+class TrajectoryMaps:
+    """
+        Makes maps over the frames of a trajectory with a single structure, so the bond valence parameters, effective
+        charges and site types are only found once. Each frame only moves the sites and finds the buffered sites again. \n
+
+        The mean and standard deviation of the maps are kept as running totals, so only one frame is held in memory at
+        a time. Every frame shares the grid of the first, so for a changing cell the maps are averaged over fractional
+        coordinates.
+    """
+
+    def __init__(self, crystal:BVStructure):
+        """
+            Initialises the maps for a structure, which gives the species and order of the sites in every frame. Frames
+            must list their atoms in the same order as the structure's sites.
+        """
+
+        self.crystal = crystal
+        self.elements = [ion.element for ion in crystal.sites["ion"]]
+        self.count = 0
+        self.mean = None
+        self._squares = None
+        self.frameTimes = []
+
+    def _set_frame(self, label:str, elements:list, fracCoords:np.ndarray, vectors:np.ndarray):
+
+        if list(elements) != self.elements:
+            raise Exception(f"The atoms of frame {label} do not match the sites of {self.crystal.name}")
+
+        self.crystal.set_frame(fracCoords @ vectors, vectors)
+
+    def add(self, valueMap:np.ndarray):
+        """
+            Adds a map to the running mean and standard deviation.
+        """
+
+        self.count += 1
+
+        if self.mean is None:
+            self.mean = valueMap.copy()
+            self._squares = np.zeros(valueMap.shape)
+            return
+
+        # Welford's update, which stays accurate over many frames
+        delta = valueMap - self.mean
+        self.mean += delta / self.count
+        self._squares += delta * (valueMap - self.mean)
+
+    @property
+    def std(self) -> np.ndarray:
+        """
+            The standard deviation of the maps added so far.
+        """
+        return np.sqrt(self._squares / self.count)
+
+    def bvse(self, frames, resolution:float, mode:int = 1, effectiveCharge:bool = True, frameCallback = None) -> int:
+        """
+            Makes a BVSE map of every frame, adding it to the running mean and standard deviation. If a callback is given,
+            it is called with the label of each frame and the structure after its map is made, e.g. to export per-frame
+            maps. Returns the number of frames added.
+        """
+        return self._run(frames, resolution, mode, lambda: self.crystal.populate_map_bvse_jit(mode=mode, effectiveCharge=effectiveCharge), frameCallback)
+
+    def bvsm(self, frames, resolution:float, mode:int = 1, penalty:float = 0.05, frameCallback = None) -> int:
+        """
+            Makes a BVSM map of every frame in the same way as bvse. Returns the number of frames added.
+        """
+        return self._run(frames, resolution, mode, lambda: self.crystal.populate_map_bvsm_jit(mode=mode, penalty=penalty), frameCallback)
+
+    def _run(self, frames, resolution:float, mode:int, populate, frameCallback) -> int:
+
+        for label, elements, fracCoords, vectors in frames:
+
+            start = time.perf_counter()
+            self._set_frame(label, elements, fracCoords, vectors)
+            self.crystal.prepare(lonePairs=mode > 0)
+
+            if self.mean is None:
+                self.crystal.setup_voxels(resolution)
+
+            populate()
+            self.add(self.crystal.map)
+            self.frameTimes.append(time.perf_counter() - start)
+
+            if frameCallback is not None:
+                frameCallback(label, self.crystal)
+
+            logging.info(f"Frame {label} added to the average of {self.crystal.name} ({self.count} frames)")
+
+        return self.count
@@ -0,0 +1,188 @@
+import json, logging, os, socket, threading, time
+from pathlib import Path
+
+class Claim:
+    """
+        A claim on one item of a work queue, held by a single worker. While the claim is used as a context manager, a
+        background thread touches the claim file so other workers can see it is still alive. If the claim is left without
+        being completed, it is released so another worker can pick the item up straight away.
+    """
+
+    def __init__(self, queue, item:str, generation:int, path:Path):
+        self.queue = queue
+        self.item = item
+        self.generation = generation
+        self.path = path
+        self.completed = False
+        self._stop = threading.Event()
+        self._thread = None
+
+    def __enter__(self):
+        self._thread = threading.Thread(target=self._beat, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        self._stop.set()
+        self._thread.join()
+        if not self.completed:
+            self.release()
+        return False
+
+    def _beat(self):
+        while not self._stop.wait(self.queue.staleAfter / 4):
+            self.heartbeat()
+
+    def heartbeat(self):
+        """
+            Marks the claim as alive by updating the modification time of the claim file.
+        """
+        try:
+            os.utime(self.path)
+        except FileNotFoundError:
+            pass
+
+    def is_current(self) -> bool:
+        """
+            Checks that no other worker has taken over the item since it was claimed, and that it is not finished.
+        """
+        return self.queue._latest_generation(self.item) == self.generation and not self.queue.is_done(self.item)
+
+    def complete(self, status:str = "done") -> bool:
+        """
+            Marks the item as finished. Returns False if another worker had already finished it.
+        """
+        self.completed = self.queue._mark_done(self.item, self.generation, status)
+        return self.completed
+
+    def release(self):
+        """
+            Gives up the claim, by making the claim file look stale to every other worker.
+        """
+        try:
+            os.utime(self.path, (0, 0))
+        except FileNotFoundError:
+            pass
+
+
+class WorkQueue:
+    """
+        A queue of named items shared between independent processes, possibly on different machines, through a shared
+        filesystem. Workers claim an item by exclusively creating a numbered claim file for it, so only one worker can
+        hold each generation of a claim. Claims are kept alive with heartbeats; a claim whose heartbeat is older than
+        staleAfter seconds is taken over by creating the next generation. Finished items are recorded with a done marker,
+        and an item whose claims have gone stale maxAttempts times is recorded as failed. The clocks of the machines
+        should agree to well within staleAfter.
+
+        The queue directory has the layout:
+
+            claims/<item>/<generation>.claim - Claim files, holding the worker that made them \n
+            done/<item> - Done markers, holding the worker, generation and status \n
+    """
+
+    def __init__(self, queueDir:str|Path, staleAfter:float = 600., maxAttempts:int = 3):
+        """
+            Initialises the queue in a directory, creating the directory if needed.
+        """
+        self.queueDir = Path(queueDir)
+        self.claimDir = self.queueDir.joinpath("claims")
+        self.doneDir = self.queueDir.joinpath("done")
+        self.claimDir.mkdir(parents=True, exist_ok=True)
+        self.doneDir.mkdir(parents=True, exist_ok=True)
+        self.staleAfter = staleAfter
+        self.maxAttempts = maxAttempts
+        self.worker = f"{socket.gethostname()}-{os.getpid()}"
+
+    def is_done(self, item:str) -> bool:
+        """
+            Checks whether an item has been finished by any worker.
+        """
+        return self.doneDir.joinpath(item).is_file()
+
+    def _latest_generation(self, item:str) -> int:
+        """
+            Returns the generation of the newest claim on an item, or -1 if it has never been claimed.
+        """
+        itemDir = self.claimDir.joinpath(item)
+        if not itemDir.is_dir():
+            return -1
+        generations = [int(path.stem) for path in itemDir.glob("*.claim")]
+        return max(generations, default=-1)
+
+    def _mark_done(self, item:str, generation:int, status:str) -> bool:
+        """
+            Creates the done marker of an item. Only the first worker to do so succeeds.
+        """
+        try:
+            fd = os.open(self.doneDir.joinpath(item), os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return False
+
+        with os.fdopen(fd, "w") as f:
+            json.dump({"worker": self.worker, "generation": generation, "status": status, "time": time.time()}, f)
+        return True
+
+    def claim(self, item:str) -> Claim|None:
+        """
+            Tries to claim an item. Returns None if the item is finished, or is held by a worker that is still alive.
+        """
+
+        if self.is_done(item):
+            return None
+
+        generation = self._latest_generation(item)
+
+        # An existing claim can only be taken over once its heartbeat is stale
+        if generation >= 0:
+            try:
+                age = time.time() - self.claimDir.joinpath(item, f"{generation}.claim").stat().st_mtime
+            except FileNotFoundError:
+                return None
+
+            if age < self.staleAfter:
+                return None
+
+            if generation + 1 >= self.maxAttempts:
+                if self._mark_done(item, generation, "failed"):
+                    logging.error(f"{item} has been abandoned {generation + 1} times and is marked as failed")
+                return None
+
+            logging.warning(f"Taking over the stale claim on {item} (generation {generation})")
+
+        itemDir = self.claimDir.joinpath(item)
+        itemDir.mkdir(exist_ok=True)
+        path = itemDir.joinpath(f"{generation + 1}.claim")
+
+        # Only one worker can create each generation of claim file
+        try:
+            fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return None
+
+        with os.fdopen(fd, "w") as f:
+            f.write(self.worker)
+
+        return Claim(self, item, generation + 1, path)
+
+    def claims(self, items:list, poll:float = 5.):
+        """
+            Yields claims on the items until every item is finished. When every unfinished item is held by another
+            worker, waits for poll seconds before checking again, so that stale claims are picked up. Each claim should
+            be used as a context manager and completed once its item is processed.
+        """
+
+        pending = list(items)
+
+        while len(pending) > 0:
+
+            claimed = False
+            for item in pending:
+                claim = self.claim(item)
+                if claim is not None:
+                    claimed = True
+                    yield claim
+
+            pending = [item for item in pending if not self.is_done(item)]
+
+            if len(pending) > 0 and not claimed:
+                time.sleep(poll)